@@ -5,13 +5,19 @@ import serial
 import serial.tools.list_ports
 import cv2
 import PySimpleGUI as sg
-import pyautogui
-import numpy as np
 import keyboard
 import time
-from flask import Flask
 from threading import Thread
-import socket
+from capture import FrameGrabber
+from capture_profile import resolve_profile
+from cursor import open_cursor_output
+from imu_reader import IMUReader, open_imu_serial
+from detector_process import ProcessSpotDetector, detector_kind, make_detector
+from preview import PreviewThrottle, PreviewRenderer, encode_ppm
+from engine import TrackingEngine, EngineParams
+from glare_mask import GlareMask
+from relay import run_flask_app
+from metrics import METRICS, now
 
 # ===================================================================
 # --- 設定項目 (Initial Settings) ---
@@ -31,15 +37,32 @@ SENSITIVITY_Y = -10.0 # Y軸（垂直方向）の感度
 DEAD_ZONE = 0.5       # IMUの動きを無視する閾値
 DELTA_THRESH = 0.5    # カメラの動きを「わずかに動いている」とみなす閾値
 # --- カメラ設定 ---
+CAMERA_SOURCE = 0           # カメラ番号・動画ファイルのパス・'synthetic'(合成映像) のいずれか
+CAPTURE_PROFILE = ''        # カメラの取得設定。'' (ドライバ既定) / 'auto' (計測して遅れの小さい設定を選ぶ) / '640x480@60/MJPG#1'
+CAPTURE_TARGET = '640x480@30' # 'auto' のときに満たすべき解像度とFPS
 BRIGHT_SPOT_THRESHOLD = 200 # 追跡対象とみなす輝度の閾値
 SAFETY_MARGIN_PERCENT = 0.1 # カメラ映像の端を除外する割合
+ROI_TRACKING = True         # 前回位置の周囲だけを探索する (見失ったら全体を探索)
+SUBPIXEL_DETECTION = False  # 縮小画像で候補を探し、輝度重心でサブピクセル位置を求める (ROI_TRACKINGより優先)
+BLOB_TRACKING = False       # 輝点をすべて検出してIDで追跡し、反射などに飛び移らない (上の2つより優先)
+GLARE_MASK = ''             # 照明などの映り込みのマスク (PNG)。python headless.py --calibrate-glare 5 で作る
+DETECT_IN_PROCESS = False   # 輝点検出を別プロセスで行う (GUIやWebサーバーが忙しくてもトラッキングが遅れにくい)
+
+# --- カーソル出力設定 ---
+CURSOR_BACKEND = 'auto'     # 'auto' / 'xtest' (Linux) / 'pyautogui' / 'record' (動かさない)
+CURSOR_RATE = 0             # カーソルの更新レート (Hz, 例: 144)。0ならカメラのフレームごとに動かす
+CURSOR_MODE = 'interpolate' # フレーム間の 'interpolate' (補間, 1フレーム遅れ) / 'extrapolate' (外挿)
 
 # --- センサーフュージョン設定 ---
 ALPHA_NORMAL = 0.4      # 通常時のカメラ追従度
 ALPHA_STATIONARY = 0.1  # 静止時のノイズ抑制強度
+FILTER = 'ema'          # 平滑化方式: 'ema' (上の2つのalpha) / 'one_euro' / 'kalman' (filters.py)
+LATENCY_COMPENSATION = False # カメラの撮影時刻以降のIMUの動きをカメラ位置に足す (IMU使用時のみ)
+CAMERA_LATENCY = 0.03        # 撮影からフレーム取得までの遅れ (秒)
 
 # --- UI・デバッグ設定 ---
 UI_ENABLED = True # FalseにするとGUIウィンドウを表示しません
+PREVIEW_FPS = 15  # プレビュー映像の更新レートの上限 (トラッキングのレートとは独立)
 
 # ===================================================================
 # --- プログラム本体 (ここから下は原則として変更不要です) ---
@@ -47,9 +70,6 @@ UI_ENABLED = True # FalseにするとGUIウィンドウを表示しません
 
 # --- グローバル変数 ---
 mouse_control_active = True
-pyautogui.FAILSAFE = False
-fused_screen_x, fused_screen_y = pyautogui.size()[0] / 2, pyautogui.size()[1] / 2
-last_cam_x, last_cam_y = fused_screen_x, fused_screen_y
 
 def find_serial_port():
     """利用可能なシリアルポートを探してPicoと思われるポートを返す"""
@@ -68,17 +88,6 @@ def find_serial_port():
         return ports[0].device
     return None
 
-def get_ip_address():
-    """ローカルIPアドレスを取得する"""
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        ip = s.getsockname()[0]
-        s.close()
-        return ip
-    except Exception:
-        return "127.0.0.1"
-
 def toggle_mouse_control(event=None):
     """マウス制御の有効/無効を切り替える"""
     global mouse_control_active
@@ -88,61 +97,38 @@ def toggle_mouse_control(event=None):
 
 keyboard.on_press_key("esc", toggle_mouse_control)
 
-def run_flask_app(ser_instance):
-    """Webサーバーを起動してシリアル通信を中継する"""
-    app = Flask(__name__)
-    @app.route('/send/<data>')
-    def send_data(data):
-        if ser_instance and ser_instance.is_open:
-            if data in ['1', '2']:
-                try:
-                    ser_instance.write(data.encode('utf-8'))
-                    print(f"📨 [Web] デバイスに '{data}' を送信しました。")
-                    return f"<h1>'{data}' をデバイスに送信しました</h1>"
-                except serial.SerialException as e:
-                    return f"<h1>送信エラー</h1><p>{e}</p>", 500
-            else:
-                return "<h1>無効なリクエストです</h1>", 400
-        else:
-            return "<h1>送信エラー</h1><p>サーバー側でシリアルデバイスが接続されていません。</p>", 503
-    local_ip = get_ip_address()
-    print("\n" + "="*50)
-    print("🚀 Webサーバーが起動しました。")
-    print(f"   URLにアクセスしてクリック操作ができます:")
-    print(f"   - http://{local_ip}:{FLASK_PORT}/send/1 (左クリック相当)")
-    print(f"   - http://{local_ip}:{FLASK_PORT}/send/2 (右クリック相当)")
-    print("="*50 + "\n")
-    app.run(host='0.0.0.0', port=FLASK_PORT, debug=False, use_reloader=False)
-
 def main():
-    global fused_screen_x, fused_screen_y, last_cam_x, last_cam_y
-
-    # --- パラメータをローカル変数にコピー ---
-    p_sens_x = SENSITIVITY_X
-    p_sens_y = SENSITIVITY_Y
-    p_dead_zone = DEAD_ZONE
-    p_bright_thresh = BRIGHT_SPOT_THRESHOLD
-    p_alpha_normal = ALPHA_NORMAL
-    p_alpha_stationary = ALPHA_STATIONARY
-    delta_threshold = DELTA_THRESH
-    noise_flag=False
-    # --- Webカメラの初期化 ---
-    cap = cv2.VideoCapture(0)
+    # --- パラメータの初期値 ---
+    params = EngineParams(
+        sens_x=SENSITIVITY_X, sens_y=SENSITIVITY_Y, dead_zone=DEAD_ZONE,
+        bright_thresh=BRIGHT_SPOT_THRESHOLD, alpha_normal=ALPHA_NORMAL,
+        alpha_stationary=ALPHA_STATIONARY, delta_threshold=DELTA_THRESH, filter=FILTER,
+        latency_compensation=LATENCY_COMPENSATION, camera_latency=CAMERA_LATENCY)
+    last_frame_seq = 0
+    # --- Webカメラの初期化 (取得は専用スレッドで行う) ---
+    cap = FrameGrabber(CAMERA_SOURCE, profile=resolve_profile(CAMERA_SOURCE, CAPTURE_PROFILE, CAPTURE_TARGET))
     if not cap.isOpened():
         sg.popup_error("エラー: Webカメラを開けませんでした。")
         return
+    cap.start()
+    glare = GlareMask.load(GLARE_MASK, int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    if glare is not None: print(f"✅ 映り込みのマスクを読み込みました: {GLARE_MASK} (画面の {glare.masked_fraction:.1%} を無視)")
+    kind = detector_kind(SUBPIXEL_DETECTION, ROI_TRACKING, BLOB_TRACKING)
+    spot_detector = ProcessSpotDetector(kind, glare=glare) if DETECT_IN_PROCESS else make_detector(kind, glare)
 
     # --- シリアルポートの初期化 ---
     ser = None
+    imu_reader = None
     port_to_use = SERIAL_PORT
     if port_to_use.lower() == 'auto':
         port_to_use = find_serial_port()
     if port_to_use:
         try:
-            ser = serial.Serial(port=port_to_use, baudrate=BAUD_RATE, timeout=0.1)
+            ser = open_imu_serial(port_to_use, BAUD_RATE)
             print(f"✅ IMU接続成功: '{port_to_use}' @ {BAUD_RATE} bps")
             time.sleep(2)
             ser.flushInput()
+            imu_reader = IMUReader(ser).start() # 受信は専用スレッドで行う
         except serial.SerialException as e:
             print(f"⚠️ 警告: IMUポート '{port_to_use}' を開けません。カメラのみで動作します。\n   {e}")
             ser = None
@@ -150,42 +136,46 @@ def main():
         print("⚠️ 警告: IMUが見つかりません。カメラのみで動作します。")
 
     # --- Webサーバーをバックグラウンドで起動 ---
-    flask_thread = Thread(target=run_flask_app, args=(ser,), daemon=True)
+    flask_thread = Thread(target=run_flask_app, args=(imu_reader, None, FLASK_PORT), daemon=True)
     flask_thread.start()
 
     # --- 画面とカメラのサイズ設定 ---
     cam_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     cam_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    CAM_X_MIN = cam_width * SAFETY_MARGIN_PERCENT
-    CAM_X_MAX = cam_width * (1 - SAFETY_MARGIN_PERCENT)
-    CAM_Y_MIN = cam_height * SAFETY_MARGIN_PERCENT
-    CAM_Y_MAX = cam_height * (1 - SAFETY_MARGIN_PERCENT)
-    SCREEN_WIDTH, SCREEN_HEIGHT = pyautogui.size()
+    cursor = open_cursor_output(CURSOR_BACKEND, CURSOR_RATE, CURSOR_MODE)
+    SCREEN_WIDTH, SCREEN_HEIGHT = cursor.size()
+    engine = TrackingEngine(cam_width, cam_height, SCREEN_WIDTH, SCREEN_HEIGHT,
+                            margin=SAFETY_MARGIN_PERCENT, params=params, detector=spot_detector, mirror=True)
 
     # --- GUIウィンドウの初期化 ---
     window = None
+    preview_throttle = PreviewThrottle(PREVIEW_FPS)
+    preview = PreviewRenderer()
+    preview_time = METRICS.histogram('preview', "プレビュー画像の描画・転送の時間")
+    show_preview = False
     if UI_ENABLED:
         #sg.theme('Black')
         
         # --- UIレイアウト定義 ---
         video_column = [
             [sg.Text('状態: 起動中...', key='-STATUS-', size=(40, 1), justification='center', text_color='lightgreen')],
-            [sg.Image(filename='', key='-IMAGE-')]
+            [sg.Image(filename='', key='-IMAGE-')],
+            [sg.Checkbox('プレビューを表示する', default=True, key='-PREVIEW-')]
         ]
 
         param_column = [
             [sg.Checkbox('IMUセンサーを利用する', default=False, key='-USE_IMU-', disabled=ser is None, enable_events=True)],
             [sg.Frame('IMU設定', [
-                [sg.Text('感度 X', size=(10,1)), sg.Slider(range=(-100.0, 100.0), default_value=p_sens_x, resolution=0.1, orientation='h', key='-SENS_X-', enable_events=True, size=(20,15))],
-                [sg.Text('感度 Y', size=(10,1)), sg.Slider(range=(-100.0, 100.0), default_value=p_sens_y, resolution=0.1, orientation='h', key='-SENS_Y-', enable_events=True, size=(20,15))],
-                [sg.Text('静止閾値', size=(10,1)), sg.Slider(range=(75.0, 80.0), default_value=p_dead_zone, resolution=0.1, orientation='h', key='-DEAD_ZONE-', enable_events=True, size=(20,15))]
+                [sg.Text('感度 X', size=(10,1)), sg.Slider(range=(-100.0, 100.0), default_value=params.sens_x, resolution=0.1, orientation='h', key='-SENS_X-', enable_events=True, size=(20,15))],
+                [sg.Text('感度 Y', size=(10,1)), sg.Slider(range=(-100.0, 100.0), default_value=params.sens_y, resolution=0.1, orientation='h', key='-SENS_Y-', enable_events=True, size=(20,15))],
+                [sg.Text('静止閾値', size=(10,1)), sg.Slider(range=(75.0, 80.0), default_value=params.dead_zone, resolution=0.1, orientation='h', key='-DEAD_ZONE-', enable_events=True, size=(20,15))]
             ], key='-IMU_FRAME-')],
             [sg.Frame('カメラ・フュージョン設定', [
                 [sg.Checkbox('ノイズ抑制モード', default=False, key='-USE_DELAY-', disabled=ser is None, enable_events=True)],
-                [sg.Text('輝度しきい値', size=(10,1)), sg.Slider(range=(50, 255), default_value=p_bright_thresh, resolution=1, orientation='h', key='-BRIGHT-', enable_events=True, size=(20,15))],
-                [sg.Text('追従度（ここでスムーズに動くかどうかが決まる）', size=(10,1)), sg.Slider(range=(0.1, 1.0), default_value=p_alpha_normal, resolution=0.05, orientation='h', key='-ALPHA_N-', enable_events=True, size=(20,15))],
-                [sg.Text('ノイズ抑制（動かないときのブレを抑える）', size=(10,1)), sg.Slider(range=(0.1, 0.5), default_value=p_alpha_stationary, resolution=0.01, orientation='h', key='-ALPHA_S-', enable_events=True, size=(20,15))],
-                [sg.Text('カメラ動作閾値', size=(10,1)), sg.Slider(range=(0, 10), default_value=delta_threshold, resolution=0.01, orientation='h', key='-CAM-', enable_events=True, size=(20,15))]
+                [sg.Text('輝度しきい値', size=(10,1)), sg.Slider(range=(50, 255), default_value=params.bright_thresh, resolution=1, orientation='h', key='-BRIGHT-', enable_events=True, size=(20,15))],
+                [sg.Text('追従度（ここでスムーズに動くかどうかが決まる）', size=(10,1)), sg.Slider(range=(0.1, 1.0), default_value=params.alpha_normal, resolution=0.05, orientation='h', key='-ALPHA_N-', enable_events=True, size=(20,15))],
+                [sg.Text('ノイズ抑制（動かないときのブレを抑える）', size=(10,1)), sg.Slider(range=(0.1, 0.5), default_value=params.alpha_stationary, resolution=0.01, orientation='h', key='-ALPHA_S-', enable_events=True, size=(20,15))],
+                [sg.Text('カメラ動作閾値', size=(10,1)), sg.Slider(range=(0, 10), default_value=params.delta_threshold, resolution=0.01, orientation='h', key='-CAM-', enable_events=True, size=(20,15))]
             ])],
             [sg.VPush()],
             [sg.Button('終了', size=(10, 1))]
@@ -197,6 +187,7 @@ def main():
     print("プログラムを開始しました。ESCキーでマウス制御を一時停止/再開できます。")
 
     # --- メインループ ---
+    control_was_active = mouse_control_active
     try:
         while True:
             if UI_ENABLED:
@@ -205,116 +196,68 @@ def main():
                     break
                 
                 # --- UIからパラメータを更新 ---
-                p_sens_x = values['-SENS_X-']
-                p_sens_y = values['-SENS_Y-']
-                p_dead_zone = values['-DEAD_ZONE-']
-                p_bright_thresh = values['-BRIGHT-']
-                p_alpha_normal = values['-ALPHA_N-']
-                p_alpha_stationary = values['-ALPHA_S-']
+                params.sens_x = values['-SENS_X-']
+                params.sens_y = values['-SENS_Y-']
+                params.dead_zone = values['-DEAD_ZONE-']
+                params.bright_thresh = values['-BRIGHT-']
+                params.alpha_normal = values['-ALPHA_N-']
+                params.alpha_stationary = values['-ALPHA_S-']
                 use_imu = values['-USE_IMU-']
-                noise_flag=values['-USE_DELAY-']
-                delta_threshold=values['-CAM-']
+                params.noise_flag = values['-USE_DELAY-']
+                params.delta_threshold = values['-CAM-']
+                # 最小化中・プレビューOFFのときは画像のエンコード自体を行わない
+                show_preview = values['-PREVIEW-'] and window.TKroot.state() != 'iconic'
                 # IMUが無効なら関連スライダーも無効化
                 window['-IMU_FRAME-'].update(visible=use_imu)
 
             else: # UI無効時のダミー変数
                 use_imu = ser is not None
+            params.use_imu = use_imu and imu_reader is not None
 
-            # --- 1. カメラデータの取得 ---
-            ret, frame = cap.read()
+            # --- 1. カメラデータの取得 (最新フレームのみ) ---
+            ret, frame, frame_time, frame_seq = cap.read(last_seq=last_frame_seq, timeout=0.05 if UI_ENABLED else 1.0)
             if not ret: break
-            frame = cv2.flip(frame, 1)
-
-            # --- 2. IMUデータの取得 ---
-            delta_h, delta_p, is_imu_moving = 0.0, 0.0, False
-            if ser and use_imu and ser.in_waiting > 0:
-                try:
-                    line = ser.readline().decode('utf-8', 'ignore').strip()
-                    if line:
-                        parts = line.split(',')
-                        if len(parts) == 6:
-                            delta_h, delta_p = float(parts[0]), float(parts[2])
-                            if abs(delta_h) > p_dead_zone or abs(delta_p) > p_dead_zone:
-                                is_imu_moving = True
-                except (UnicodeDecodeError, ValueError, IndexError):
-                    pass
-
-            # --- 3. カメラ画像処理 ---
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            (_, maxVal, _, maxLoc) = cv2.minMaxLoc(gray)
-            is_cam_tracking = maxVal >= p_bright_thresh
-            
-            camera_screen_x, camera_screen_y = last_cam_x, last_cam_y
-            if is_cam_tracking:
-                cam_x_raw, cam_y_raw = maxLoc
-                camera_screen_x = np.interp(cam_x_raw, [CAM_X_MIN, CAM_X_MAX], [0, SCREEN_WIDTH - 1])
-                camera_screen_y = np.interp(cam_y_raw, [CAM_Y_MIN, CAM_Y_MAX], [0, SCREEN_HEIGHT - 1])
-
-            # --- 4. 状況判断とセンサーフュージョン ---
-            if mouse_control_active:
-                if use_imu and ser: # --- センサーフュージョンモード ---
-                    if not is_cam_tracking and is_imu_moving:
-                        status_text, status_color = "状態: IMU予測モード", "magenta"
-                        fused_screen_x += delta_h * p_sens_x
-                        fused_screen_y += delta_p * p_sens_y
-                        cv2.putText(frame, "IMU PREDICTION", (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 1, (255,0,255), 2)
-                    elif is_cam_tracking:
-                        cam_delta = np.sqrt((camera_screen_x - last_cam_x)**2 + (camera_screen_y - last_cam_y)**2)
-                        is_cam_moving_slightly = cam_delta > delta_threshold
-                        if not is_imu_moving and is_cam_moving_slightly:
-                            status_text, status_color = "状態: ノイズ抑制モード", "orange"
-                            alpha = p_alpha_stationary
-                            cv2.circle(frame, maxLoc, 20, (0, 165, 255), 2)
-                        else:
-                            status_text, status_color = "状態: 通常追跡モード", "cyan"
-                            alpha = p_alpha_normal
-                            cv2.circle(frame, maxLoc, 20, (255, 255, 0), 2)
-                        fused_screen_x = (1 - alpha) * fused_screen_x + alpha * camera_screen_x
-                        fused_screen_y = (1 - alpha) * fused_screen_y + alpha * camera_screen_y
-                    else:
-                        status_text, status_color = "状態: 追跡対象なし", "red"
-                
-                else: # --- カメラ単独モード ---
-                    if is_cam_tracking:
-                        cam_delta = np.sqrt((camera_screen_x - last_cam_x)**2 + (camera_screen_y - last_cam_y)**2)
-                        is_cam_moving_slightly = cam_delta > delta_threshold
-                        if noise_flag:
-                            status_text, status_color = "状態: 単独ノイズ抑制モード", "orange"
-                            alpha = p_alpha_stationary
-                            
-                        else:
-                            status_text, status_color = "状態: カメラ単独モード", "lime"
-                            alpha = p_alpha_normal
-                        fused_screen_x = (1 - alpha) * fused_screen_x + alpha * camera_screen_x
-                        fused_screen_y = (1 - alpha) * fused_screen_y + alpha * camera_screen_y
-                        cv2.circle(frame, maxLoc, 20, (0, 255, 0), 2)
-                    
-
-                    else:
-                        status_text, status_color = "状態: 追跡対象なし", "red"
-            else:
-                status_text, status_color = "状態: 一時停止中 (ESCキーで再開)", "yellow"
+            if frame_seq == last_frame_seq: continue # 新しいフレームが無ければ再処理しない
+            last_frame_seq = frame_seq # 左右反転は engine の座標変換で行う (フレームはコピーしない)
+
+            # --- 2. IMUデータの取得 (前フレーム以降の全サンプルの合計) ---
+            delta_h, delta_p = 0.0, 0.0
+            if imu_reader:
+                imu = imu_reader.drain() # IMU未使用時も読み捨ててバックログを溜めない
+                if params.use_imu:
+                    delta_h, delta_p = imu.delta_h, imu.delta_p
+
+            # --- 3. 輝点検出 & 4. 状況判断とセンサーフュージョン ---
+            control_active = mouse_control_active
+            if control_active and not control_was_active:
+                cursor.reset() # 一時停止中に手で動かしたカーソルを、再開後の最初の結果で必ず動かす
+            control_was_active = control_active
+            target = engine.step(frame, delta_h, delta_p, active=control_active,
+                                 timestamp=frame_time, imu_history=imu_reader)
 
             # --- 5. マウス移動 & UI更新 ---
-            if mouse_control_active:
-                final_x = np.clip(fused_screen_x, 0, SCREEN_WIDTH - 1)
-                final_y = np.clip(fused_screen_y, 0, SCREEN_HEIGHT - 1)
-                pyautogui.moveTo(final_x, final_y)
+            if target is not None:
+                cursor.move(target[0], target[1])
 
             if UI_ENABLED:
+                status_text, status_color = engine.status
                 window['-STATUS-'].update(status_text, text_color=status_color)
-                display_frame = cv2.resize(frame, (640, 480))
-                imgbytes = cv2.imencode('.png', display_frame)[1].tobytes()
-                window['-IMAGE-'].update(data=imgbytes)
-            
-            last_cam_x, last_cam_y = camera_screen_x, camera_screen_y
+                if show_preview and preview_throttle.due():
+                    preview_start = now()
+                    window['-IMAGE-'].update(data=encode_ppm(preview.render(frame, engine)))
+                    preview_time.since(preview_start)
 
     finally:
         print("\nクリーンアップ処理を実行しています...")
         cap.release()
+        if DETECT_IN_PROCESS: spot_detector.close()
+        if glare is not None and glare.changed: glare.save(GLARE_MASK); print(f"映り込みのマスクを更新しました: {GLARE_MASK}")
+        if imu_reader: imu_reader.stop()
         if ser and ser.is_open: ser.close(); print("シリアルポートを閉じました。")
+        cursor.close()
         if UI_ENABLED and window: window.close()
         keyboard.unhook_all()
+        if kind == 'roi': print(f"ROI探索ヒット率: {spot_detector.hit_ratio:.1%} (全体探索 {spot_detector.full_scans} 回)")
         print("終了しました。")
 
 if __name__ == '__main__':
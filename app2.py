@@ -7,13 +7,20 @@ from PIL import Image, ImageTk
 import serial
 import serial.tools.list_ports
 import cv2
-import pyautogui
 import numpy as np
 import keyboard
 import time
-from flask import Flask
 from threading import Thread
-import socket
+from capture import FrameGrabber
+from capture_profile import resolve_profile
+from cursor import open_cursor_output
+from imu_reader import IMUReader, open_imu_serial
+from detector_process import ProcessSpotDetector, detector_kind, make_detector
+from preview import PreviewThrottle, PreviewRenderer, PREVIEW_SIZE
+from engine import TrackingEngine, EngineParams
+from glare_mask import GlareMask
+from relay import run_flask_app
+from metrics import METRICS, now
 
 # ===================================================================
 # --- 設定項目 (Initial Settings) ---
@@ -33,12 +40,31 @@ SENSITIVITY_Y = -10.0    # Y軸（垂直方向）の感度
 DEAD_ZONE = 0.5          # IMUの動きを無視する閾値
 DELTA_THRESH = 0.5       # カメラの動きを「わずかに動いている」とみなす閾値
 # --- カメラ設定 ---
+CAMERA_SOURCE = 0           # カメラ番号・動画ファイルのパス・'synthetic'(合成映像) のいずれか
+CAPTURE_PROFILE = ''        # カメラの取得設定。'' (ドライバ既定) / 'auto' (計測して遅れの小さい設定を選ぶ) / '640x480@60/MJPG#1'
+CAPTURE_TARGET = '640x480@30' # 'auto' のときに満たすべき解像度とFPS
 BRIGHT_SPOT_THRESHOLD = 200 # 追跡対象とみなす輝度の閾値
 SAFETY_MARGIN_PERCENT = 0.1 # カメラ映像の端を除外する割合
+ROI_TRACKING = True         # 前回位置の周囲だけを探索する (見失ったら全体を探索)
+SUBPIXEL_DETECTION = False  # 縮小画像で候補を探し、輝度重心でサブピクセル位置を求める (ROI_TRACKINGより優先)
+BLOB_TRACKING = False       # 輝点をすべて検出してIDで追跡し、反射などに飛び移らない (上の2つより優先)
+GLARE_MASK = ''             # 照明などの映り込みのマスク (PNG)。python headless.py --calibrate-glare 5 で作る
+DETECT_IN_PROCESS = False   # 輝点検出を別プロセスで行う (GUIやWebサーバーが忙しくてもトラッキングが遅れにくい)
+
+# --- カーソル出力設定 ---
+CURSOR_BACKEND = 'auto'     # 'auto' / 'xtest' (Linux) / 'pyautogui' / 'record' (動かさない)
+CURSOR_RATE = 0             # カーソルの更新レート (Hz, 例: 144)。0ならカメラのフレームごとに動かす
+CURSOR_MODE = 'interpolate' # フレーム間の 'interpolate' (補間, 1フレーム遅れ) / 'extrapolate' (外挿)
 
 # --- センサーフュージョン設定 ---
 ALPHA_NORMAL = 0.4       # 通常時のカメラ追従度
 ALPHA_STATIONARY = 0.1   # 静止時のノイズ抑制強度
+FILTER = 'ema'           # 平滑化方式: 'ema' (上の2つのalpha) / 'one_euro' / 'kalman' (filters.py)
+LATENCY_COMPENSATION = False # カメラの撮影時刻以降のIMUの動きをカメラ位置に足す (IMU使用時のみ)
+CAMERA_LATENCY = 0.03    # 撮影からフレーム取得までの遅れ (秒)
+
+# --- UI設定 ---
+PREVIEW_FPS = 15         # プレビュー映像の更新レートの上限 (トラッキングのレートとは独立)
 
 # ===================================================================
 # --- グローバル関数 (Global Functions) ---
@@ -61,17 +87,6 @@ def find_serial_port():
         return ports[0].device
     return None
 
-def get_ip_address():
-    """ローカルIPアドレスを取得する"""
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        ip = s.getsockname()[0]
-        s.close()
-        return ip
-    except Exception:
-        return "127.0.0.1"
-
 # ===================================================================
 # --- アプリケーションクラス (Application Class) ---
 # ===================================================================
@@ -83,10 +98,16 @@ class App:
 
         # --- グローバル変数をインスタンス変数として初期化 ---
         self.mouse_control_active = True
-        pyautogui.FAILSAFE = False
-        self.fused_screen_x, self.fused_screen_y = pyautogui.size()[0] / 2, pyautogui.size()[1] / 2
-        self.last_cam_x, self.last_cam_y = self.fused_screen_x, self.fused_screen_y
+        self.control_was_active = True # 前回の更新時の mouse_control_active
+        self.params = EngineParams(filter=FILTER, latency_compensation=LATENCY_COMPENSATION,
+                                   camera_latency=CAMERA_LATENCY)
+        self.engine = None
         self.ser = None
+        self.imu_reader = None
+        self.last_frame_seq = 0
+        self.last_status = None # 直前に表示した (状態テキスト, 色)
+        self.preview_throttle = PreviewThrottle(PREVIEW_FPS)
+        self.preview_time = METRICS.histogram('preview', "プレビュー画像の描画・転送の時間")
 
         # --- Tkinter変数の設定 ---
         self.use_imu_var = tk.BooleanVar(value=False) # ★ 変更点: デフォルトをFalseに
@@ -128,7 +149,14 @@ class App:
         self.status_label = ttk.Label(video_frame, text="状態: 起動中...", font=("Helvetica", 12), foreground="lightgreen")
         self.status_label.pack(pady=5)
         
-        self.image_label = ttk.Label(video_frame)
+        # プレビュー用の PhotoImage とバッファは1つだけ作り、毎フレーム中身を書き換える
+        preview_w, preview_h = PREVIEW_SIZE
+        self.preview = PreviewRenderer(PREVIEW_SIZE)
+        self.preview_rgba = np.zeros((preview_h, preview_w, 4), dtype=np.uint8)
+        # RGBAならPILの画像がNumPyバッファとメモリを共有する (RGBだとコピーになる)
+        self.preview_image = Image.frombuffer('RGBA', PREVIEW_SIZE, self.preview_rgba, 'raw', 'RGBA', 0, 1)
+        self.preview_photo = ImageTk.PhotoImage(self.preview_image)
+        self.image_label = ttk.Label(video_frame, image=self.preview_photo)
         self.image_label.pack()
 
         # --- セパレータ ---
@@ -225,20 +253,27 @@ class App:
             self.imu_frame.pack_forget()
 
     def init_camera(self):
-        """Webカメラを初期化する"""
-        self.cap = cv2.VideoCapture(0)
+        """Webカメラを初期化する (取得は専用スレッドで行う)"""
+        self.cap = FrameGrabber(CAMERA_SOURCE, profile=resolve_profile(CAMERA_SOURCE, CAPTURE_PROFILE, CAPTURE_TARGET))
         if not self.cap.isOpened():
             messagebox.showerror("エラー", "Webカメラを開けませんでした。")
             self.root.destroy()
             return
-        
+        self.cap.start()
         cam_width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
         cam_height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        self.CAM_X_MIN = cam_width * SAFETY_MARGIN_PERCENT
-        self.CAM_X_MAX = cam_width * (1 - SAFETY_MARGIN_PERCENT)
-        self.CAM_Y_MIN = cam_height * SAFETY_MARGIN_PERCENT
-        self.CAM_Y_MAX = cam_height * (1 - SAFETY_MARGIN_PERCENT)
-        self.SCREEN_WIDTH, self.SCREEN_HEIGHT = pyautogui.size()
+        self.glare = GlareMask.load(GLARE_MASK, cam_width, cam_height)
+        if self.glare is not None:
+            print(f"✅ 映り込みのマスクを読み込みました: {GLARE_MASK} (画面の {self.glare.masked_fraction:.1%} を無視)")
+        kind = detector_kind(SUBPIXEL_DETECTION, ROI_TRACKING, BLOB_TRACKING)
+        self.spot_detector = (ProcessSpotDetector(kind, glare=self.glare) if DETECT_IN_PROCESS
+                              else make_detector(kind, self.glare))
+        
+        self.cursor = open_cursor_output(CURSOR_BACKEND, CURSOR_RATE, CURSOR_MODE)
+        screen_width, screen_height = self.cursor.size()
+        self.engine = TrackingEngine(cam_width, cam_height, screen_width, screen_height,
+                                     margin=SAFETY_MARGIN_PERCENT, params=self.params,
+                                     detector=self.spot_detector, mirror=True)
 
     def init_serial(self):
         """シリアルポートを初期化する"""
@@ -248,10 +283,11 @@ class App:
         
         if port_to_use:
             try:
-                self.ser = serial.Serial(port=port_to_use, baudrate=BAUD_RATE, timeout=0.1)
+                self.ser = open_imu_serial(port_to_use, BAUD_RATE)
                 print(f"✅ IMU接続成功: '{port_to_use}' @ {BAUD_RATE} bps")
                 time.sleep(2)
                 self.ser.flushInput()
+                self.imu_reader = IMUReader(self.ser).start() # 受信は専用スレッドで行う
                 self.use_imu_check.config(state=tk.NORMAL)
                 # ★ 変更点: IMUが接続されても、デフォルトでは有効にしない
                 # self.use_imu_var.set(True) # この行を削除
@@ -266,36 +302,9 @@ class App:
             self.use_imu_var.set(False)
         self.toggle_imu_frame()
 
-    def run_flask_app(self):
-        """Webサーバーを起動してシリアル通信を中継する"""
-        app = Flask(__name__)
-        @app.route('/send/<data>')
-        def send_data(data):
-            if self.ser and self.ser.is_open:
-                if data in ['1', '2']:
-                    try:
-                        self.ser.write(data.encode('utf-8'))
-                        print(f"📨 [Web] デバイスに '{data}' を送信しました。")
-                        return f"<h1>'{data}' をデバイスに送信しました</h1>"
-                    except serial.SerialException as e:
-                        return f"<h1>送信エラー</h1><p>{e}</p>", 500
-                else:
-                    return "<h1>無効なリクエストです</h1>", 400
-            else:
-                return "<h1>送信エラー</h1><p>サーバー側でシリアルデバイスが接続されていません。</p>", 503
-        
-        local_ip = get_ip_address()
-        print("\n" + "="*50)
-        print("🚀 Webサーバーが起動しました。")
-        print(f"   URLにアクセスしてクリック操作ができます:")
-        print(f"   - http://{local_ip}:{FLASK_PORT}/send/1 (左クリック相当)")
-        print(f"   - http://{local_ip}:{FLASK_PORT}/send/2 (右クリック相当)")
-        print("="*50 + "\n")
-        app.run(host='0.0.0.0', port=FLASK_PORT, debug=False, use_reloader=False)
-
     def start_flask_server(self):
         """Flaskサーバーを別スレッドで起動する"""
-        flask_thread = Thread(target=self.run_flask_app, daemon=True)
+        flask_thread = Thread(target=run_flask_app, args=(self.imu_reader, None, FLASK_PORT), daemon=True)
         flask_thread.start()
 
     def toggle_mouse_control(self, event=None):
@@ -304,102 +313,63 @@ class App:
         status = '再開' if self.mouse_control_active else '一時停止'
         print(f"\n[操作] マウス制御を{status}しました。(ESCキーで切り替え)")
 
+    def read_params(self):
+        """Tkinter変数の値をエンジンのパラメータに反映する"""
+        p = self.params
+        p.sens_x = self.sens_x_var.get()
+        p.sens_y = self.sens_y_var.get()
+        p.dead_zone = self.dead_zone_var.get()
+        p.bright_thresh = self.bright_thresh_var.get()
+        p.alpha_normal = self.alpha_n_var.get()
+        p.alpha_stationary = self.alpha_s_var.get()
+        p.delta_threshold = self.cam_delta_thresh_var.get()
+        p.use_imu = self.use_imu_var.get() and self.imu_reader is not None
+        p.noise_flag = self.noise_flag_var.get()
+
     def update(self):
         """メインの更新処理ループ"""
-        # --- 1. カメラデータの取得 ---
-        ret, frame = self.cap.read()
-        if not ret:
-            self.root.after(10, self.update)
+        # --- 1. カメラデータの取得 (最新フレームのみ) ---
+        ret, frame, frame_time, frame_seq = self.cap.read(last_seq=self.last_frame_seq, timeout=0)
+        if not ret or frame_seq == self.last_frame_seq:
+            # 新しいフレームが無ければ再処理せず、次の更新を待つ
+            self.root.after(5, self.update)
             return
-        frame = cv2.flip(frame, 1)
+        self.last_frame_seq = frame_seq # 左右反転は engine の座標変換で行う (フレームはコピーしない)
 
-        # --- 2. IMUデータの取得 ---
-        delta_h, delta_p, is_imu_moving = 0.0, 0.0, False
-        if self.ser and self.use_imu_var.get() and self.ser.in_waiting > 0:
-            try:
-                line = self.ser.readline().decode('utf-8', 'ignore').strip()
-                if line:
-                    parts = line.split(',')
-                    if len(parts) == 6: # 元のコードに合わせてインデックス0と2を使用
-                        delta_h, delta_p = float(parts[0]), float(parts[2])
-                        if abs(delta_h) > self.dead_zone_var.get() or abs(delta_p) > self.dead_zone_var.get():
-                            is_imu_moving = True
-            except (UnicodeDecodeError, ValueError, IndexError):
-                pass
-        
-        # --- 3. カメラ画像処理 ---
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        (_, maxVal, _, maxLoc) = cv2.minMaxLoc(gray)
-        is_cam_tracking = maxVal >= self.bright_thresh_var.get()
+        # --- UIからパラメータを更新 ---
+        self.read_params()
+
+        # --- 2. IMUデータの取得 (前フレーム以降の全サンプルの合計) ---
+        delta_h, delta_p = 0.0, 0.0
+        if self.imu_reader:
+            imu = self.imu_reader.drain() # IMU未使用時も読み捨ててバックログを溜めない
+            if self.params.use_imu:
+                delta_h, delta_p = imu.delta_h, imu.delta_p
         
-        camera_screen_x, camera_screen_y = self.last_cam_x, self.last_cam_y
-        if is_cam_tracking:
-            cam_x_raw, cam_y_raw = maxLoc
-            camera_screen_x = np.interp(cam_x_raw, [self.CAM_X_MIN, self.CAM_X_MAX], [0, self.SCREEN_WIDTH - 1])
-            camera_screen_y = np.interp(cam_y_raw, [self.CAM_Y_MIN, self.CAM_Y_MAX], [0, self.SCREEN_HEIGHT - 1])
-
-        # --- 4. 状況判断とセンサーフュージョン ---
-        status_text, status_color = "", ""
-        if self.mouse_control_active:
-            # --- センサーフュージョンモード ---
-            if self.use_imu_var.get() and self.ser:
-                if not is_cam_tracking and is_imu_moving:
-                    status_text, status_color = "状態: IMU予測モード", "magenta"
-                    self.fused_screen_x += delta_h * self.sens_x_var.get()
-                    self.fused_screen_y += delta_p * self.sens_y_var.get()
-                    cv2.putText(frame, "IMU PREDICTION", (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 0, 255), 2)
-                elif is_cam_tracking:
-                    cam_delta = np.sqrt((camera_screen_x - self.last_cam_x)**2 + (camera_screen_y - self.last_cam_y)**2)
-                    is_cam_moving_slightly = cam_delta > self.cam_delta_thresh_var.get()
-                    
-                    if not is_imu_moving and is_cam_moving_slightly:
-                        status_text, status_color = "状態: ノイズ抑制モード", "orange"
-                        alpha = self.alpha_s_var.get()
-                        cv2.circle(frame, maxLoc, 20, (0, 165, 255), 2)
-                    else:
-                        status_text, status_color = "状態: 通常追跡モード", "cyan"
-                        alpha = self.alpha_n_var.get()
-                        cv2.circle(frame, maxLoc, 20, (255, 255, 0), 2)
-                    self.fused_screen_x = (1 - alpha) * self.fused_screen_x + alpha * camera_screen_x
-                    self.fused_screen_y = (1 - alpha) * self.fused_screen_y + alpha * camera_screen_y
-                else:
-                    status_text, status_color = "状態: 追跡対象なし", "red"
-            
-            # --- カメラ単独モード ---
-            else:
-                if is_cam_tracking:
-                    if self.noise_flag_var.get():
-                        status_text, status_color = "状態: 単独ノイズ抑制モード", "orange"
-                        alpha = self.alpha_s_var.get()
-                    else:
-                        status_text, status_color = "状態: カメラ単独モード", "lime"
-                        alpha = self.alpha_n_var.get()
-                    self.fused_screen_x = (1 - alpha) * self.fused_screen_x + alpha * camera_screen_x
-                    self.fused_screen_y = (1 - alpha) * self.fused_screen_y + alpha * camera_screen_y
-                    cv2.circle(frame, maxLoc, 20, (0, 255, 0), 2)
-                else:
-                    status_text, status_color = "状態: 追跡対象なし", "red"
-        else:
-            status_text, status_color = "状態: 一時停止中 (ESCキーで再開)", "yellow"
+        # --- 3. 輝点検出 & 4. 状況判断とセンサーフュージョン ---
+        control_active = self.mouse_control_active
+        if control_active and not self.control_was_active:
+            self.cursor.reset() # 一時停止中に手で動かしたカーソルを、再開後の最初の結果で必ず動かす
+        self.control_was_active = control_active
+        target = self.engine.step(frame, delta_h, delta_p, active=control_active,
+                                   timestamp=frame_time, imu_history=self.imu_reader)
 
         # --- 5. マウス移動 & UI更新 ---
-        if self.mouse_control_active:
-            final_x = np.clip(self.fused_screen_x, 0, self.SCREEN_WIDTH - 1)
-            final_y = np.clip(self.fused_screen_y, 0, self.SCREEN_HEIGHT - 1)
-            pyautogui.moveTo(final_x, final_y)
-
-        # UIの更新
-        self.status_label.config(text=status_text, foreground=status_color)
-        
-        # OpenCVの画像をTkinter用に変換
-        display_frame = cv2.resize(frame, (640, 480))
-        cv2image = cv2.cvtColor(display_frame, cv2.COLOR_BGR2RGBA)
-        img = Image.fromarray(cv2image)
-        imgtk = ImageTk.PhotoImage(image=img)
-        self.image_label.imgtk = imgtk
-        self.image_label.configure(image=imgtk)
+        if target is not None:
+            self.cursor.move(target[0], target[1])
+
+        # UIの更新 (状態が変わったときだけTkに反映する)
+        status = self.engine.status
+        if status != self.last_status:
+            self.status_label.config(text=status[0], foreground=status[1])
+            self.last_status = status
         
-        self.last_cam_x, self.last_cam_y = camera_screen_x, camera_screen_y
+        # OpenCVの画像を既存の PhotoImage に書き込む (レート制限あり・最小化中は省略)
+        if self.preview_throttle.due() and self.root.state() != 'iconic':
+            preview_start = now()
+            cv2.cvtColor(self.preview.render(frame, self.engine), cv2.COLOR_BGR2RGBA, dst=self.preview_rgba)
+            self.preview_photo.paste(self.preview_image)
+            self.preview_time.since(preview_start)
 
         # 次のフレームの更新をスケジュール
         self.root.after(10, self.update)
@@ -407,13 +377,25 @@ class App:
     def on_closing(self):
         """ウィンドウが閉じられる際のクリーンアップ処理"""
         print("\nクリーンアップ処理を実行しています...")
-        if hasattr(self, 'cap') and self.cap.isOpened():
+        if hasattr(self, 'cap'):
             self.cap.release()
+        if DETECT_IN_PROCESS and hasattr(self, 'spot_detector'):
+            self.spot_detector.close()
+        if getattr(self, 'glare', None) is not None and self.glare.changed:
+            self.glare.save(GLARE_MASK)
+            print(f"映り込みのマスクを更新しました: {GLARE_MASK}")
+        if hasattr(self, 'cursor'):
+            self.cursor.close()
+        if self.imu_reader:
+            self.imu_reader.stop()
         if self.ser and self.ser.is_open:
             self.ser.close()
             print("シリアルポートを閉じました。")
         keyboard.unhook_all()
         self.root.destroy()
+        # ヒット率は ROI探索の検出器だけが持つ (BlobTracker などには無い)
+        if detector_kind(SUBPIXEL_DETECTION, ROI_TRACKING, BLOB_TRACKING) == 'roi' and hasattr(self, 'spot_detector'):
+            print(f"ROI探索ヒット率: {self.spot_detector.hit_ratio:.1%} (全体探索 {self.spot_detector.full_scans} 回)")
         print("終了しました。")
 
 if __name__ == '__main__':
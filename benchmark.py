@@ -0,0 +1,1367 @@
+# ===================================================================
+# --- ベンチマーク (Benchmarks) ---
+# Webカメラ・Picoが無くても、合成フレームで処理速度と精度を測定する。
+#
+#   python benchmark.py detect              # 輝点検出方式の比較
+#   python benchmark.py engine              # フュージョン処理の1回あたりのコスト (旧実装との比較)
+#   python benchmark.py cursor              # カーソル出力方式ごとの呼び出し回数/秒
+#   xvfb-run python benchmark.py cursor --check # XTest でカーソルが指定位置に動くかを確認する
+#   python benchmark.py filter              # 平滑化フィルタごとの遅れとブレ (同じ入力で比較)
+#   python benchmark.py latency             # カメラの遅れをIMUで補償したときの効果
+#   python benchmark.py imu                 # IMU受信データの解析速度 (CSV とバイナリ)
+#   python benchmark.py relay               # 中継サーバーの負荷試験 (コマンド/秒と p99)
+#   python benchmark.py scaling             # トラッカーを増やしたときの合計処理フレーム数/秒
+#   python benchmark.py split               # 検出を別プロセスにしたときのループの揺らぎ (GUI・HTTP負荷下)
+#   python benchmark.py capture             # カメラの取得設定ごとのフレームの古さ (疑似ドライバ)
+#   python benchmark.py alloc               # 1フレームあたりのメモリ確保量 (tracemalloc)
+#   python benchmark.py blobs               # 複数の輝点があるときの飛び移りと、輝点数による処理時間
+#   python benchmark.py glare               # 照明・モニターの映り込みを学習したマスクの効果
+#   python benchmark.py suite --json out.json
+#                                           # 各段の単体性能と、合成映像+疑似IMUでの通し性能
+# ===================================================================
+import argparse
+import http.client
+import multiprocessing
+import queue
+import json
+import logging
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from threading import Thread, Event, Barrier
+
+import cv2
+import numpy as np
+
+from blob_tracker import BlobTracker, find_blobs
+from capture import SyntheticSource, FrameGrabber
+from capture_profile import (FakeCamera, apply_profile, candidate_profiles, choose_profile, format_profile,
+                             parse_target, probe_profiles, read_back)
+from cursor import RecordingSink, XTestSink, PyAutoGUISink
+from detector import find_bright_spot, ROISpotDetector, PyramidSpotDetector
+from detector_process import ProcessSpotDetector, make_detector, DETECTOR_KINDS
+from engine import TrackingEngine, EngineParams, draw_overlay
+from filters import FILTERS
+from glare_mask import GlareMask
+from preview import PreviewRenderer, PREVIEW_SIZE
+from imu_reader import IMUReader, open_imu_serial, parse_imu_line, encode_packet
+from relay import CommandRelay, create_app, open_udp_socket, serve_udp, SERVER_THREADS
+
+RESOLUTIONS = [(640, 480), (1280, 720), (1920, 1080)]
+SCREEN_SIZE = (1920, 1080)
+
+
+def percentile(values, q):
+    """values の q パーセンタイル (最近傍法)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100.0 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def latency_summary(samples):
+    """秒単位の計測値から p50 / p99 / 平均 (ミリ秒) をまとめる"""
+    return {
+        'count': len(samples),
+        'mean_ms': sum(samples) / len(samples) * 1000 if samples else 0.0,
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+    }
+
+
+def make_frames(width, height, count, spot_radius=4):
+    """合成フレームと点の真値 (x, y) のリストを作る"""
+    source = SyntheticSource(width, height, spot_radius=spot_radius, realtime=False)
+    return [(source.render(i), source.spot_position(i)) for i in range(count)]
+
+
+# ===================================================================
+# --- 輝点検出 (detect) ---
+# ===================================================================
+
+class _FullFrameDetector:
+    """従来方式 (画像全体の cvtColor + minMaxLoc)"""
+
+    def detect(self, frame, threshold):
+        return find_bright_spot(frame)
+
+
+def bench_detect(args):
+    print(f"{'解像度':>10} {'方式':>8} {'ms/frame':>9} {'平均誤差(px)':>12} {'最大誤差(px)':>12}")
+    for width, height in RESOLUTIONS:
+        frames = make_frames(width, height, args.frames)
+        detectors = [
+            ('full', _FullFrameDetector()),
+            ('roi', ROISpotDetector()),
+            ('pyramid', PyramidSpotDetector()),
+        ]
+        for name, detector in detectors:
+            errors = []
+            start = time.perf_counter()
+            for frame, (gx, gy) in frames:
+                _, (x, y) = detector.detect(frame, args.threshold)
+                errors.append(((x - gx) ** 2 + (y - gy) ** 2) ** 0.5)
+            elapsed = time.perf_counter() - start
+            print(f"{width:>5}x{height:<4} {name:>8} {elapsed / len(frames) * 1000:9.3f} "
+                  f"{sum(errors) / len(errors):12.3f} {max(errors):12.3f}")
+
+
+# ===================================================================
+# --- フュージョン処理 (engine) ---
+# ===================================================================
+
+class _LegacyFusion:
+    """エンジン導入前の app.py のフュージョン処理 (NumPyのスカラー演算版)"""
+
+    def __init__(self, cam_width, cam_height, screen_width, screen_height, params, margin=0.1):
+        self.p = params
+        self.cam_x_min, self.cam_x_max = cam_width * margin, cam_width * (1 - margin)
+        self.cam_y_min, self.cam_y_max = cam_height * margin, cam_height * (1 - margin)
+        self.screen_width, self.screen_height = screen_width, screen_height
+        self.fused_x, self.fused_y = screen_width / 2, screen_height / 2
+        self.last_cam_x, self.last_cam_y = self.fused_x, self.fused_y
+
+    def fuse(self, max_val, max_loc, delta_h, delta_p, active=True):
+        p = self.p
+        is_imu_moving = abs(delta_h) > p.dead_zone or abs(delta_p) > p.dead_zone
+        is_cam_tracking = max_val >= p.bright_thresh
+        camera_screen_x, camera_screen_y = self.last_cam_x, self.last_cam_y
+        if is_cam_tracking:
+            camera_screen_x = np.interp(max_loc[0], [self.cam_x_min, self.cam_x_max], [0, self.screen_width - 1])
+            camera_screen_y = np.interp(max_loc[1], [self.cam_y_min, self.cam_y_max], [0, self.screen_height - 1])
+        if p.use_imu:
+            if not is_cam_tracking and is_imu_moving:
+                self.fused_x += delta_h * p.sens_x
+                self.fused_y += delta_p * p.sens_y
+            elif is_cam_tracking:
+                cam_delta = np.sqrt((camera_screen_x - self.last_cam_x)**2 + (camera_screen_y - self.last_cam_y)**2)
+                if not is_imu_moving and cam_delta > p.delta_threshold:
+                    alpha = p.alpha_stationary
+                else:
+                    alpha = p.alpha_normal
+                self.fused_x = (1 - alpha) * self.fused_x + alpha * camera_screen_x
+                self.fused_y = (1 - alpha) * self.fused_y + alpha * camera_screen_y
+        elif is_cam_tracking:
+            alpha = p.alpha_stationary if p.noise_flag else p.alpha_normal
+            self.fused_x = (1 - alpha) * self.fused_x + alpha * camera_screen_x
+            self.fused_y = (1 - alpha) * self.fused_y + alpha * camera_screen_y
+        final = (np.clip(self.fused_x, 0, self.screen_width - 1), np.clip(self.fused_y, 0, self.screen_height - 1))
+        self.last_cam_x, self.last_cam_y = camera_screen_x, camera_screen_y
+        return final
+
+
+def make_detection_trace(count, cam_width=640, cam_height=480, seed=0):
+    """検出結果とIMU移動量の疑似データ列 (max_val, max_loc, delta_h, delta_p) を作る"""
+    rng = random.Random(seed)
+    trace = []
+    x, y = cam_width / 2, cam_height / 2
+    for _ in range(count):
+        x = min(max(x + rng.gauss(0, 6), 0), cam_width - 1)
+        y = min(max(y + rng.gauss(0, 6), 0), cam_height - 1)
+        max_val = 255.0 if rng.random() > 0.15 else 120.0 # 15% は見失う
+        delta_h = rng.gauss(0, 0.6)
+        delta_p = rng.gauss(0, 0.6)
+        trace.append((max_val, (int(x), int(y)), delta_h, delta_p))
+    return trace
+
+
+def bench_engine(args):
+    trace = make_detection_trace(args.ticks)
+    print(f"{'モード':>24} {'旧実装 us/tick':>14} {'エンジン us/tick':>16} {'最大差(px)':>10}")
+    for use_imu, noise_flag in [(True, False), (False, False), (False, True)]:
+        params = EngineParams(use_imu=use_imu, noise_flag=noise_flag)
+        legacy = _LegacyFusion(640, 480, 1920, 1080, params)
+        engine = TrackingEngine(640, 480, 1920, 1080, params=params)
+
+        start = time.perf_counter()
+        legacy_out = [legacy.fuse(*t) for t in trace]
+        legacy_time = time.perf_counter() - start
+        start = time.perf_counter()
+        engine_out = [engine.fuse(*t) for t in trace]
+        engine_time = time.perf_counter() - start
+
+        max_diff = max(max(abs(a[0] - b[0]), abs(a[1] - b[1])) for a, b in zip(legacy_out, engine_out))
+        label = 'IMUフュージョン' if use_imu else ('カメラ単独(ノイズ抑制)' if noise_flag else 'カメラ単独')
+        print(f"{label:>24} {legacy_time / len(trace) * 1e6:14.2f} {engine_time / len(trace) * 1e6:16.2f} {max_diff:10.2e}")
+
+
+# ===================================================================
+# --- 平滑化フィルタ (filter) ---
+# ===================================================================
+
+# (秒数, 速さ[px/s]) の区間: 静止 → 速いフリック → 静止 → ゆっくり → 静止 ...
+FILTER_SEGMENTS = [(1.5, 0.0), (0.3, 2000.0), (1.5, 0.0), (1.0, 300.0), (1.5, 0.0),
+                   (0.3, -2000.0), (1.5, 0.0), (1.0, -300.0), (1.5, 0.0)] * 5
+
+
+def make_filter_trace(fps=30.0, cam_noise=0.3, imu_noise=0.05, imu_gain_error=0.05, seed=0):
+    """フィルタ比較用の入力列を作る
+
+    真の画面座標が FILTER_SEGMENTS に従って水平に動く。カメラの輝点位置には
+    cam_noise [カメラpx] の、IMUの移動量には imu_noise [度] のノイズと感度誤差を加える。
+    戻り値は (時刻, 真のx, 真のy, カメラx, カメラy, delta_h, delta_p, 区間の速さ) のリスト。
+    """
+    rng = random.Random(seed)
+    params = EngineParams()
+    engine = TrackingEngine(640, 480, SCREEN_SIZE[0], SCREEN_SIZE[1], params=params)
+    x, y = SCREEN_SIZE[0] / 2, SCREEN_SIZE[1] / 2
+    dt = 1.0 / fps
+    t = 0.0
+    trace = []
+    for duration, speed in FILTER_SEGMENTS:
+        for _ in range(int(round(duration * fps))):
+            step = speed * dt
+            x += step
+            t += dt
+            cam_x = (x - engine._x_offset) / engine._x_scale + rng.gauss(0, cam_noise)
+            cam_y = (y - engine._y_offset) / engine._y_scale + rng.gauss(0, cam_noise)
+            delta_h = step / params.sens_x * (1 + imu_gain_error) + rng.gauss(0, imu_noise)
+            delta_p = rng.gauss(0, imu_noise)
+            trace.append((t, x, y, cam_x, cam_y, delta_h, delta_p, speed))
+    return trace
+
+
+def evaluate_filter(trace, params, move_settle=0.1, still_settle=0.5):
+    """同じ入力列に対する遅れ (移動中の誤差) とブレ (静止中のフレーム間の動き) を求める
+
+    区間の切り替わり直後 (移動は move_settle 秒、静止は still_settle 秒) は集計しない。
+    """
+    engine = TrackingEngine(640, 480, SCREEN_SIZE[0], SCREEN_SIZE[1], params=params)
+    moving_lag, still_steps = [], []
+    segment_speed, segment_start = None, 0.0
+    last = None
+    for t, true_x, true_y, cam_x, cam_y, delta_h, delta_p, speed in trace:
+        if speed != segment_speed:
+            segment_speed, segment_start = speed, t
+        out = engine.fuse(255, (cam_x, cam_y), delta_h, delta_p, timestamp=t)
+        elapsed = t - segment_start
+        if speed and elapsed >= move_settle:
+            moving_lag.append((true_x - out[0]) / speed) # 真値に何秒遅れているか
+        elif not speed and elapsed >= still_settle:
+            still_steps.append(math.hypot(out[0] - last[0], out[1] - last[1]))
+        last = out
+    return {
+        'lag_ms': sum(moving_lag) / len(moving_lag) * 1000,
+        'jitter_px': (sum(s * s for s in still_steps) / len(still_steps)) ** 0.5,
+    }
+
+
+def bench_filter(args):
+    trace = make_filter_trace(args.fps, args.cam_noise, args.imu_noise)
+    print(f"入力: {len(trace)} フレーム @ {args.fps:g} fps, カメラノイズ {args.cam_noise} px, IMUノイズ {args.imu_noise} 度")
+    print(f"{'フィルタ':>10} {'IMU':>5} {'遅れ ms':>9} {'ブレ px(RMS)':>13}")
+    for use_imu in (False, True):
+        for name in FILTERS:
+            result = evaluate_filter(trace, EngineParams(use_imu=use_imu, filter=name))
+            print(f"{name:>10} {'あり' if use_imu else 'なし':>5} {result['lag_ms']:9.1f} {result['jitter_px']:13.3f}")
+
+
+# ===================================================================
+# --- カメラ遅れの補償 (latency) ---
+# ===================================================================
+
+def segment_position(t, start_x=SCREEN_SIZE[0] / 2):
+    """FILTER_SEGMENTS に従って動く点の、時刻 t での水平位置と速さ"""
+    x = start_x
+    for duration, speed in FILTER_SEGMENTS:
+        if t <= duration:
+            return x + speed * t, speed
+        x += speed * duration
+        t -= duration
+    return x, 0.0
+
+
+def evaluate_latency(params, fps=30.0, imu_rate=100.0, camera_latency=0.04, cam_noise=0.3,
+                     imu_noise=0.01, move_settle=0.1, seed=0):
+    """撮影から camera_latency 秒遅れて届くカメラと、遅れの無いIMUで追跡したときの遅れ
+
+    カメラの輝点位置は「フレーム取得時刻 - camera_latency」の真値にノイズを加えたもの、
+    IMUは imu_rate Hz で受信時刻付きの移動量を送る。移動中の平均の遅れ [ms] を返す。
+    """
+    rng = random.Random(seed)
+    engine = TrackingEngine(640, 480, SCREEN_SIZE[0], SCREEN_SIZE[1], params=params)
+    imu_reader = IMUReader(None)
+    y = SCREEN_SIZE[1] / 2
+    cam_y = (y - engine._y_offset) / engine._y_scale
+    duration = sum(d for d, _ in FILTER_SEGMENTS)
+    imu_time = 0.0
+    imu_prev, _ = segment_position(0.0)
+    lags = []
+    for k in range(1, int(duration * fps)):
+        frame_time = k / fps
+        # フレーム取得時刻までに届いたIMUのサンプル
+        while imu_time + 1.0 / imu_rate <= frame_time:
+            imu_time += 1.0 / imu_rate
+            x, _ = segment_position(imu_time)
+            delta_h = (x - imu_prev) / params.sens_x + rng.gauss(0, imu_noise)
+            imu_prev = x
+            imu_reader.feed_line(f"{delta_h:.5f},0.0,{rng.gauss(0, imu_noise):.5f},0.0,0.0,0.0", imu_time)
+        imu = imu_reader.drain()
+        seen_x, _ = segment_position(frame_time - camera_latency)
+        cam_x = (seen_x - engine._x_offset) / engine._x_scale + rng.gauss(0, cam_noise)
+        out = engine.fuse(255, (cam_x, cam_y + rng.gauss(0, cam_noise)), imu.delta_h, imu.delta_p,
+                          timestamp=frame_time, imu_history=imu_reader)
+        true_x, speed = segment_position(frame_time)
+        # 区間の始まり直後は除く (速さが切り替わった直後の過渡応答)
+        if speed and segment_position(frame_time - move_settle)[1] == speed:
+            lags.append((true_x - out[0]) / speed)
+    return sum(lags) / len(lags) * 1000
+
+
+def bench_latency(args):
+    print(f"カメラ {args.fps:g} fps (遅れ {args.camera_latency * 1000:.0f} ms), IMU {args.imu_rate:g} Hz")
+    print(f"{'フィルタ':>10} {'補償なし ms':>12} {'補償あり ms':>12}")
+    for name in FILTERS:
+        lags = []
+        for compensation in (False, True):
+            params = EngineParams(use_imu=True, filter=name, latency_compensation=compensation,
+                                  camera_latency=args.camera_latency)
+            lags.append(evaluate_latency(params, args.fps, args.imu_rate, args.camera_latency))
+        print(f"{name:>10} {lags[0]:12.1f} {lags[1]:12.1f}")
+
+
+# ===================================================================
+# --- IMU受信データの解析 (imu) ---
+# ===================================================================
+
+def bench_imu(args):
+    args.per_read = args.per_read or [1, 10, 100]
+    rng = random.Random(0)
+    values = [(rng.gauss(0, 2), rng.gauss(0, 2)) for _ in range(args.samples)]
+    print(f"{'形式':>8} {'1回の受信':>10} {'us/sample':>10} {'samples/s':>12} {'誤差':>9}")
+    for wire_format in ('csv', 'binary'):
+        stream = [imu_sample(i, h, p, wire_format) for i, (h, p) in enumerate(values)]
+        for per_read in args.per_read:
+            chunks = [b''.join(stream[i:i + per_read]) for i in range(0, len(stream), per_read)]
+            reader = IMUReader(None, wire_format=wire_format)
+            start = time.perf_counter()
+            for chunk in chunks:
+                reader.feed_bytes(chunk, 0.0)
+            elapsed = time.perf_counter() - start
+            total = reader.drain()
+            error = abs(total.delta_h - sum(h for h, _ in values)) # CSVは小数4桁、バイナリはfloat32に丸める
+            print(f"{wire_format:>8} {per_read:>10} {elapsed / len(values) * 1e6:10.3f} "
+                  f"{len(values) / elapsed:12.0f} {error:9.2e}")
+
+
+# ===================================================================
+# --- カーソル出力 (cursor) ---
+# ===================================================================
+
+def make_cursor_trace(count):
+    """エンジンが出力するカーソル座標の列 (静止時の微小な揺れを含む)"""
+    engine = TrackingEngine(640, 480, SCREEN_SIZE[0], SCREEN_SIZE[1], params=EngineParams(use_imu=True))
+    targets = (engine.fuse(*t) for t in make_detection_trace(count))
+    return [t for t in targets if t is not None]
+
+
+def check_landing(sink, count=20, seed=0):
+    """画面内のランダムな位置に move() し、position() で読み戻した位置が違った回数を返す"""
+    width, height = sink.size()
+    rng = random.Random(seed)
+    misses = 0
+    for _ in range(count):
+        x, y = rng.uniform(0, width - 1), rng.uniform(0, height - 1)
+        sink.move(x, y)
+        if tuple(sink.position()) != (int(round(x)), int(round(y))):
+            misses += 1
+    return misses
+
+
+def bench_cursor(args):
+    trace = make_cursor_trace(args.moves)
+    sinks = [('record', lambda: RecordingSink(SCREEN_SIZE, keep=False)),
+             ('xtest', XTestSink), ('pyautogui', PyAutoGUISink)]
+    failed = False
+    print(f"{'方式':>10} {'calls/s':>12} {'送信 calls/s':>12} {'省略率':>8} {'着地':>6}")
+    for name, factory in sinks:
+        if name == 'xtest' and not os.environ.get('DISPLAY'):
+            print(f"{name:>10} 省略 (DISPLAY が無い。xvfb-run で実行すると確認できる)")
+            continue
+        try:
+            sink = factory()
+        except Exception as e: # ライブラリやXサーバーが無い環境では飛ばす
+            print(f"{name:>10} 利用不可 ({e})")
+            failed |= args.check and name == 'xtest' # DISPLAY があるのに XTest が使えない
+            continue
+        move = sink.move
+        start = time.perf_counter()
+        for x, y in trace:
+            move(x, y)
+        elapsed = time.perf_counter() - start
+        # 省略の効果を除いた、1回の送信そのもののコスト
+        sink_move_to = sink._move_to
+        raw_count = min(len(trace), args.raw_moves)
+        start = time.perf_counter()
+        for i in range(raw_count):
+            sink_move_to(i % 200 + 100, i % 100 + 100)
+        raw_elapsed = time.perf_counter() - start
+        misses = check_landing(sink)
+        sink.close()
+        failed |= args.check and misses > 0
+        print(f"{name:>10} {len(trace) / elapsed:12.0f} {raw_count / raw_elapsed:12.0f} "
+              f"{sink.skipped / len(trace):8.1%} {'OK' if not misses else f'NG {misses}':>6}")
+    return 1 if failed else 0
+
+
+# ===================================================================
+# --- 中継サーバーの負荷試験 (relay) ---
+# 同じプロセス内でサーバーを起動し、複数のクライアントスレッドから送り続ける。
+# クライアントもGILを共有するため、値は別マシンから送る場合より控えめに出る。
+# ===================================================================
+
+class _NullSerial:
+    """書き込まれたバイト数を数えるだけのシリアルポート"""
+
+    is_open = True
+
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        return len(data)
+
+
+def start_relay_server(server, app):
+    """空きポートでHTTPサーバーを起動し、(ポート, 停止関数) を返す"""
+    if server == 'waitress':
+        from waitress.server import create_server
+        srv = create_server(app, host='127.0.0.1', port=0, threads=SERVER_THREADS)
+        Thread(target=srv.run, daemon=True).start()
+        return srv.effective_port, srv.close
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR) # リクエストごとのログを出さない
+    srv = make_server('127.0.0.1', 0, app, threaded=True)
+    Thread(target=srv.serve_forever, daemon=True).start()
+    return srv.server_port, srv.shutdown
+
+
+def relay_client(mode, address, requests_count, batch, barrier, latencies):
+    """1クライアント分の送信ループ。各リクエストの往復時間を latencies に追加する"""
+    if mode == 'udp':
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(1.0)
+        payload = ('1' * batch).encode('ascii')
+        barrier.wait()
+        for _ in range(requests_count):
+            start = time.perf_counter()
+            sock.sendto(payload, address)
+            try:
+                sock.recv(64)
+            except socket.timeout: # 失われた分は数えない
+                continue
+            latencies.append(time.perf_counter() - start)
+        sock.close()
+        return
+    conn = http.client.HTTPConnection(*address) # keep-alive で1本の接続を使い回す
+    body = '1' * batch
+    headers = {'Content-Type': 'text/plain'}
+    barrier.wait()
+    for _ in range(requests_count):
+        start = time.perf_counter()
+        if mode == 'get':
+            conn.request('GET', '/send/1')
+        else:
+            conn.request('POST', '/send', body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        if response.status == 200:
+            latencies.append(time.perf_counter() - start)
+    conn.close()
+
+
+def run_relay_load(server, mode, clients, requests_count, batch):
+    """server で mode の送信を clients 本並行して行い、結果をまとめる"""
+    ser = _NullSerial()
+    relay = CommandRelay(ser)
+    app = create_app(ser, relay=relay)
+    port, stop = start_relay_server(server, app)
+    udp_sock = None
+    if mode == 'udp':
+        udp_sock = open_udp_socket('127.0.0.1', 0)
+        Thread(target=serve_udp, args=([relay], udp_sock), daemon=True).start()
+        port = udp_sock.getsockname()[1]
+    batch = 1 if mode == 'get' else batch
+    barrier = Barrier(clients + 1)
+    results = [[] for _ in range(clients)]
+    threads = [Thread(target=relay_client, args=(mode, ('127.0.0.1', port), requests_count, batch, barrier, r))
+               for r in results]
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull): # GET の送信ログを捨てる
+        for t in threads:
+            t.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+    if udp_sock is not None:
+        udp_sock.close()
+    stop()
+    latencies = [v for r in results for v in r]
+    summary = latency_summary(latencies)
+    summary['commands_per_s'] = ser.written / elapsed
+    summary['requests_per_s'] = len(latencies) / elapsed
+    return summary
+
+
+def bench_relay(args):
+    servers = args.server or ['waitress', 'werkzeug']
+    modes = args.mode or ['get', 'batch', 'udp']
+    print(f"クライアント {args.clients} 本 x {args.requests} 回, バッチ {args.batch} 件")
+    print(f"{'サーバー':>10} {'方式':>6} {'commands/s':>12} {'requests/s':>11} {'p50 ms':>8} {'p99 ms':>8}")
+    for server in servers:
+        for mode in modes:
+            if mode == 'udp' and server != servers[0]:
+                continue # UDPはHTTPサーバーの種類に依存しない
+            try:
+                r = run_relay_load(server, mode, args.clients, args.requests, args.batch)
+            except ImportError as e:
+                print(f"{server:>10} 利用不可 ({e})")
+                break
+            name = '-' if mode == 'udp' else server
+            print(f"{name:>10} {mode:>6} {r['commands_per_s']:12.0f} {r['requests_per_s']:11.0f} "
+                  f"{r['p50_ms']:8.2f} {r['p99_ms']:8.2f}")
+
+
+# ===================================================================
+# --- ベンチマークスイート (suite) ---
+# ===================================================================
+
+class _FrameListSource:
+    """事前に生成したフレームを順に返すキャプチャ (生成コストを計測に含めない)"""
+
+    def __init__(self, frames, fps, loop=False):
+        self.frames = frames
+        self.fps = fps
+        self.loop = loop # 最後まで返したら先頭に戻る
+        self.index = 0
+        self._next_due = time.monotonic()
+
+    def read(self):
+        if self.index >= len(self.frames):
+            if not self.loop:
+                return False, None
+            self.index = 0
+        if self.fps:
+            now = time.monotonic()
+            if self._next_due > now:
+                time.sleep(self._next_due - now)
+            self._next_due = max(self._next_due, now) + 1.0 / self.fps
+        frame = self.frames[self.index][0]
+        self.index += 1
+        return True, frame
+
+    def get(self, prop):
+        height, width = self.frames[0][0].shape[:2]
+        return {cv2.CAP_PROP_FRAME_WIDTH: float(width), cv2.CAP_PROP_FRAME_HEIGHT: float(height)}.get(prop, 0.0)
+
+    def isOpened(self):
+        return True
+
+    def release(self):
+        pass
+
+
+def imu_sample(seq, delta_h, delta_p, wire_format='csv'):
+    """IMUの1サンプルを送信形式 ('csv' / 'binary') のバイト列にする"""
+    if wire_format == 'binary':
+        return encode_packet(seq, delta_h, delta_p)
+    return f"{delta_h:.4f},0.0,{delta_p:.4f},0.0,0.0,0.0\n".encode('ascii')
+
+
+def simulate_imu(ser, frames, fps, rate, stop_event, wire_format='csv'):
+    """BNO055の出力を模したサンプルを rate Hz でシリアルに書き込む
+
+    点の移動量 (カメラ座標) を delta_h / delta_p に換算して送る。
+    """
+    per_frame = max(1, int(rate / fps))
+    interval = 1.0 / rate
+    next_due = time.monotonic()
+    prev = frames[0][1]
+    seq = 0
+    for _, (gx, gy) in frames:
+        dx, dy = (gx - prev[0]) / per_frame, (gy - prev[1]) / per_frame
+        prev = (gx, gy)
+        for _ in range(per_frame):
+            if stop_event.is_set():
+                return
+            # 左右反転した映像で追跡するので水平方向は符号を反転する
+            ser.write(imu_sample(seq, -dx * 0.2, dy * -0.1, wire_format))
+            seq += 1
+            next_due += interval
+            delay = next_due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+
+def bench_stages(width, height, frames, threshold):
+    """各処理段を単体で計測する"""
+    stages = {}
+
+    for name, detector in [('detect_full', None), ('detect_roi', ROISpotDetector()),
+                           ('detect_pyramid', PyramidSpotDetector())]:
+        samples = []
+        for frame, _ in frames:
+            start = time.perf_counter()
+            if detector is None:
+                find_bright_spot(frame)
+            else:
+                detector.detect(frame, threshold)
+            samples.append(time.perf_counter() - start)
+        stages[name] = latency_summary(samples)
+
+    line = "0.1234,0.0,-0.5678,0.0,0.0,0.0"
+    samples = []
+    for _ in range(len(frames) * 10):
+        start = time.perf_counter()
+        parse_imu_line(line)
+        samples.append(time.perf_counter() - start)
+    stages['imu_parse'] = latency_summary(samples)
+
+    engine = TrackingEngine(width, height, *SCREEN_SIZE, params=EngineParams(use_imu=True))
+    trace = make_detection_trace(len(frames) * 10, width, height)
+    samples = []
+    for t in trace:
+        start = time.perf_counter()
+        engine.fuse(*t)
+        samples.append(time.perf_counter() - start)
+    stages['fuse'] = latency_summary(samples)
+    return stages
+
+
+def bench_end_to_end(width, height, frames, fps, imu_rate, threshold, imu_format='csv'):
+    """合成映像と疑似IMU (loop://) で取得→検出→フュージョンを通しで計測する"""
+    truth = {id(frame): gt for frame, gt in frames}
+    grabber = FrameGrabber(_FrameListSource(frames, fps)).start()
+    ser = open_imu_serial('loop://', 115200, timeout=0.05)
+    reader = IMUReader(ser).start()
+    stop_event = Event()
+    writer = Thread(target=simulate_imu, args=(ser, frames, fps or 30.0, imu_rate, stop_event, imu_format),
+                    daemon=True)
+    writer.start()
+
+    params = EngineParams(use_imu=True, bright_thresh=threshold)
+    engine = TrackingEngine(width, height, *SCREEN_SIZE, params=params, mirror=True)
+    stage_samples = {'frame_age': [], 'imu_drain': [], 'detect': [], 'fuse': [], 'total': []}
+    errors = []
+    processed = 0
+    last_seq = 0
+    start_time = time.perf_counter()
+    while True:
+        ret, frame, frame_time, seq = grabber.read(last_seq=last_seq, timeout=1.0)
+        if not ret:
+            break
+        if seq == last_seq:
+            continue
+        last_seq = seq
+        t0 = time.perf_counter()
+        stage_samples['frame_age'].append(time.monotonic() - frame_time)
+        gx, gy = truth[id(frame)]
+        imu = reader.drain()
+        t2 = time.perf_counter()
+        max_val, max_loc = engine.detector.detect(frame, params.bright_thresh)
+        t3 = time.perf_counter()
+        target = engine.fuse(max_val, max_loc, imu.delta_h, imu.delta_p)
+        t4 = time.perf_counter()
+        for name, value in (('imu_drain', t2 - t0), ('detect', t3 - t2), ('fuse', t4 - t3), ('total', t4 - t0)):
+            stage_samples[name].append(value)
+        tx, ty = engine.map_to_screen(gx, gy)
+        errors.append(((target[0] - tx) ** 2 + (target[1] - ty) ** 2) ** 0.5)
+        processed += 1
+    elapsed = time.perf_counter() - start_time
+
+    stop_event.set()
+    writer.join(timeout=1.0)
+    reader.stop()
+    ser.close()
+    grabber.release()
+    return {
+        'frames_offered': len(frames),
+        'frames_processed': processed,
+        'frames_dropped': grabber.dropped,
+        'fps': processed / elapsed if elapsed else 0.0,
+        'imu_samples': reader.total_samples,
+        'imu_parse_errors': reader.parse_errors,
+        'stages': {name: latency_summary(v) for name, v in stage_samples.items()},
+        'tracking_error_px': {
+            'mean': sum(errors) / len(errors) if errors else 0.0,
+            'p50': percentile(errors, 50),
+            'p99': percentile(errors, 99),
+        },
+    }
+
+
+# ===================================================================
+# --- トラッカー数によるスケーリング (scaling) ---
+# headless.Tracker と同じ処理 (取得→IMU→検出→フュージョン) を N 組同時に動かす。
+# ===================================================================
+
+def scaling_worker(width, height, fps, imu_rate, duration, ready, go, results):
+    """トラッカー1台分の処理を duration 秒行い、結果を results に入れる
+
+    スレッドからもプロセスからも呼べるよう、引数はキューとイベントだけにしている。
+    """
+    frames = make_frames(width, height, 120)
+    grabber = FrameGrabber(_FrameListSource(frames, fps, loop=True))
+    ser = open_imu_serial('loop://', 115200, timeout=0.05)
+    reader = IMUReader(ser).start()
+    engine = TrackingEngine(width, height, *SCREEN_SIZE, params=EngineParams(use_imu=True), mirror=True)
+    stop_event = Event()
+
+    def write_imu():
+        seq = 0
+        while not stop_event.wait(1.0 / imu_rate):
+            ser.write(imu_sample(seq, 0.01, 0.0))
+            seq += 1
+
+    ready.put(True)
+    go.wait()
+    grabber.start()
+    Thread(target=write_imu, daemon=True).start()
+    samples = []
+    processed = 0
+    last_seq = 0
+    end_time = time.monotonic() + duration
+    while time.monotonic() < end_time:
+        ret, frame, frame_time, seq = grabber.read(last_seq=last_seq, timeout=1.0)
+        if not ret:
+            break
+        if seq == last_seq:
+            continue
+        last_seq = seq
+        start = time.perf_counter()
+        imu = reader.drain()
+        engine.step(frame, imu.delta_h, imu.delta_p, timestamp=frame_time, imu_history=reader)
+        samples.append(time.perf_counter() - start)
+        processed += 1
+    stop_event.set()
+    reader.stop()
+    ser.close()
+    grabber.release()
+    results.put({'frames': processed, 'dropped': grabber.dropped, 'step_p99_ms': percentile(samples, 99) * 1000})
+
+
+def run_scaling(count, mode, width, height, fps, imu_rate, duration):
+    """トラッカー count 台をスレッド (mode='thread') かプロセス ('process') で同時に動かす"""
+    if mode == 'process':
+        ready, results, go = multiprocessing.Queue(), multiprocessing.Queue(), multiprocessing.Event()
+        workers = [multiprocessing.Process(target=scaling_worker, daemon=True,
+                                           args=(width, height, fps, imu_rate, duration, ready, go, results))
+                   for _ in range(count)]
+    else:
+        ready, results, go = queue.Queue(), queue.Queue(), Event()
+        workers = [Thread(target=scaling_worker, daemon=True,
+                          args=(width, height, fps, imu_rate, duration, ready, go, results))
+                   for _ in range(count)]
+    for worker in workers:
+        worker.start()
+    for _ in workers: # 全員のフレーム生成が終わってから一斉に始める
+        ready.get()
+    go.set()
+    reports = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    total = sum(r['frames'] for r in reports)
+    return {
+        'fps_total': total / duration,
+        'fps_min': min(r['frames'] for r in reports) / duration,
+        'dropped': sum(r['dropped'] for r in reports),
+        'step_p99_ms': max(r['step_p99_ms'] for r in reports),
+    }
+
+
+def bench_scaling(args):
+    width, height = (int(v) for v in args.resolution.lower().split('x'))
+    counts = args.count or [1, 2, 4, 8]
+    fps = f"{args.fps:g} fps" if args.fps else "最大レート"
+    print(f"{width}x{height}, カメラ {fps}, IMU {args.imu_rate:g} Hz, {args.duration:g} 秒 (CPU {os.cpu_count()} 個)")
+    print(f"{'方式':>8} {'台数':>4} {'合計 fps':>10} {'最低 fps/台':>11} {'取りこぼし':>10} {'step p99 ms':>12}")
+    for mode in args.mode or ['thread', 'process']:
+        for count in counts:
+            r = run_scaling(count, mode, width, height, args.fps, args.imu_rate, args.duration)
+            print(f"{mode:>8} {count:>4} {r['fps_total']:10.1f} {r['fps_min']:11.1f} {r['dropped']:10d} "
+                  f"{r['step_p99_ms']:12.2f}")
+
+
+# ===================================================================
+# --- 検出の別プロセス化 (split) ---
+# GUIのイベント処理 (Pythonのスレッド) とWebサーバーへのリクエストで負荷をかけながら、
+# トラッキングループの周期の揺らぎを、検出を同じプロセスで行う場合と比べる。
+# ===================================================================
+
+def _gui_load(stop_event, busy=0.005, idle=0.005):
+    """GUIのイベント処理・プレビュー更新を模したPythonの処理 (busy 秒処理して idle 秒休む)"""
+    while not stop_event.is_set():
+        end = time.perf_counter() + busy
+        while time.perf_counter() < end:
+            sum(i * i for i in range(200))
+        time.sleep(idle)
+
+
+def _http_load(port, connections, stop_event):
+    """別プロセスから中継サーバーに送り続ける (クライアント側の負荷は計測対象に含めない)"""
+    def client():
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        while not stop_event.is_set():
+            conn.request('POST', '/send', body='1', headers={'Content-Type': 'text/plain'})
+            conn.getresponse().read()
+    threads = [Thread(target=client, daemon=True) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    stop_event.wait()
+
+
+def measure_loop(detector, frames, fps, duration, threshold):
+    """取得→検出→フュージョンのループを duration 秒回し、周期の揺らぎをまとめる"""
+    height, width = frames[0][0].shape[:2]
+    grabber = FrameGrabber(_FrameListSource(frames, fps, loop=True)).start()
+    engine = TrackingEngine(width, height, *SCREEN_SIZE, params=EngineParams(bright_thresh=threshold),
+                            detector=detector, mirror=True)
+    period = 1.0 / fps
+    steps, deviations = [], []
+    last_done = None
+    last_seq = 0
+    end_time = time.monotonic() + duration
+    while time.monotonic() < end_time:
+        ret, frame, frame_time, seq = grabber.read(last_seq=last_seq, timeout=1.0)
+        if not ret:
+            break
+        if seq == last_seq:
+            continue
+        last_seq = seq
+        start = time.perf_counter()
+        engine.step(frame, timestamp=frame_time)
+        done = time.perf_counter()
+        steps.append(done - start)
+        if last_done is not None: # 前のフレームの処理完了からの間隔と、本来の周期との差
+            deviations.append(abs(done - last_done - period))
+        last_done = done
+    grabber.release()
+    return {
+        'frames': len(steps),
+        'dropped': grabber.dropped,
+        'step_p50_ms': percentile(steps, 50) * 1000,
+        'step_p99_ms': percentile(steps, 99) * 1000,
+        'jitter_p99_ms': percentile(deviations, 99) * 1000,
+        'jitter_max_ms': max(deviations, default=0.0) * 1000,
+    }
+
+
+def bench_split(args):
+    width, height = (int(v) for v in args.resolution.lower().split('x'))
+    frames = make_frames(width, height, 120)
+    print(f"{width}x{height}, {args.fps:g} fps, 検出方式 {args.kind}, {args.duration:g} 秒 (CPU {os.cpu_count()} 個)")
+    print(f"{'負荷':>10} {'検出':>8} {'frames':>7} {'取りこぼし':>10} {'step p50':>9} {'step p99':>9} "
+          f"{'揺らぎ p99':>10} {'揺らぎ max':>10}  (ms)")
+
+    ser = _NullSerial()
+    port, stop_server = start_relay_server('waitress', create_app(ser))
+    context = multiprocessing.get_context('spawn')
+    for load in ('none', 'gui', 'gui+http'):
+        stop_load = Event()
+        http_stop = context.Event()
+        loaders = []
+        if load != 'none':
+            loaders = [Thread(target=_gui_load, args=(stop_load,), daemon=True) for _ in range(args.gui_threads)]
+        if load == 'gui+http':
+            loaders.append(context.Process(target=_http_load, args=(port, args.http_clients, http_stop), daemon=True))
+        for loader in loaders:
+            loader.start()
+        for where in ('thread', 'process'):
+            if where == 'process':
+                detector = ProcessSpotDetector(args.kind)
+                detector.detect(frames[0][0], args.threshold) # 起動を待ってから計測する
+            else:
+                detector = make_detector(args.kind)
+            r = measure_loop(detector, frames, args.fps, args.duration, args.threshold)
+            if where == 'process':
+                detector.close()
+            print(f"{load:>10} {where:>8} {r['frames']:7d} {r['dropped']:10d} {r['step_p50_ms']:9.2f} "
+                  f"{r['step_p99_ms']:9.2f} {r['jitter_p99_ms']:10.2f} {r['jitter_max_ms']:10.2f}")
+        stop_load.set()
+        http_stop.set()
+        for loader in loaders:
+            loader.join(timeout=2.0)
+    stop_server()
+    print(f"中継サーバーが受けたコマンド: {ser.written}")
+
+
+# ===================================================================
+# --- 1フレームあたりのメモリ確保 (alloc) ---
+# 反転・グレースケール化・プレビューで毎回画像を確保していた従来の処理と、
+# 座標変換での反転・使い回すバッファでの処理を、tracemalloc で比べる
+# (NumPy の配列の確保は tracemalloc で追跡される)。
+# ===================================================================
+
+def legacy_frame_path(frame, engine, threshold, preview):
+    """従来の処理: フレームを反転コピーし、グレースケール画像を確保し、反転画像に描いて縮小する"""
+    mirrored = cv2.flip(frame, 1)
+    gray = cv2.cvtColor(mirrored, cv2.COLOR_BGR2GRAY)
+    (_, max_val, _, max_loc) = cv2.minMaxLoc(gray)
+    engine.fuse(max_val, max_loc)
+    if preview:
+        draw_overlay(mirrored, engine)
+        return cv2.resize(mirrored, PREVIEW_SIZE, interpolation=cv2.INTER_NEAREST)
+    return None
+
+
+def measure_allocations(process, frames, repeat=3):
+    """process(frame, index) を全フレームに行い、1フレーム内で確保された最大バイト数のリストと、
+    最初の1周の後に増えたバイト数 (使い回しができていれば 0 付近) を返す"""
+    for index, (frame, _) in enumerate(frames): # 1周目はバッファの確保を含むので計測しない
+        process(frame, index)
+    peaks = np.zeros(repeat * len(frames), dtype=np.int64) # 計測中に増えないよう先に確保する
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for k in range(repeat * len(frames)):
+        index = k % len(frames)
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        process(frames[index][0], index)
+        peaks[k] = tracemalloc.get_traced_memory()[1] - before
+    growth = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    return peaks.tolist(), growth
+
+
+def bench_alloc(args):
+    width, height = (int(v) for v in args.resolution.lower().split('x'))
+    frames = make_frames(width, height, args.frames)
+    print(f"{width}x{height}, プレビュー {args.preview_every} フレームに1回 "
+          f"(1フレームの大きさ {frames[0][0].nbytes // 1024} KiB)")
+    print(f"{'処理':>18} {'確保 p50':>10} {'確保 max':>10} {'増加':>8} {'時間 p50':>9}  (KiB / ms)")
+
+    def make_engine(mirror, roi):
+        return TrackingEngine(width, height, *SCREEN_SIZE, params=EngineParams(bright_thresh=args.threshold),
+                              detector=ROISpotDetector(enabled=roi), mirror=mirror)
+
+    renderer = PreviewRenderer()
+    legacy = make_engine(False, False)
+    full = make_engine(True, False)
+    roi = make_engine(True, True)
+    paths = [
+        ('従来 (反転コピー)', lambda frame, i: legacy_frame_path(frame, legacy, args.threshold,
+                                                           i % args.preview_every == 0)),
+        ('座標変換+バッファ', lambda frame, i: (full.step(frame), i % args.preview_every == 0
+                                          and renderer.render(frame, full))),
+        ('同上 + ROI探索', lambda frame, i: (roi.step(frame), i % args.preview_every == 0
+                                          and renderer.render(frame, roi))),
+    ]
+    for name, process in paths:
+        times = []
+        for index, (frame, _) in enumerate(frames):
+            start = time.perf_counter()
+            process(frame, index)
+            times.append(time.perf_counter() - start)
+        peaks, growth = measure_allocations(process, frames)
+        print(f"{name:>18} {percentile(peaks, 50) / 1024:10.1f} {max(peaks) / 1024:10.1f} {growth / 1024:8.1f} "
+              f"{percentile(times, 50) * 1000:9.3f}")
+
+
+# ===================================================================
+# --- 複数の輝点 (blobs) ---
+# 2つのLEDが交差しながら動き (明るさは毎フレーム揺らぐ)、途中から窓の反射が写り込む映像で、
+# 最も明るい画素を追う検出器と BlobTracker の飛び移りの回数を比べる。
+# ===================================================================
+
+def make_blob_frames(width, height, count, fps=30.0, reflection_from=30, seed=0):
+    """2つのLEDと反射の合成フレームと、各フレームのLEDの真値 [(x, y), (x, y)] のリストを作る"""
+    rng = random.Random(seed)
+    frames = []
+    for i in range(count):
+        frame = np.zeros((height, width, 3), dtype=np.uint8)
+        phase = math.sin(2.0 * math.pi * i / fps / 3.0)
+        leds = [(width * (0.5 + 0.35 * phase), height * 0.45), (width * (0.5 - 0.35 * phase), height * 0.55)]
+        for x, y in leds:
+            value = rng.randint(235, 255) # LEDのちらつき
+            cv2.circle(frame, (int(round(x * 16)), int(round(y * 16))), 6 * 16, (value,) * 3, -1, cv2.LINE_AA, 4)
+        if i >= reflection_from:
+            cv2.circle(frame, (int(width * 0.8), int(height * 0.15)), 8, (255, 255, 255), -1)
+        frames.append((frame, leds))
+    return frames
+
+
+def count_switches(positions, truths):
+    """追っている位置に最も近いLEDが入れ替わった回数 (見失ったフレームは数えない)"""
+    switches = 0
+    last = None
+    for position, leds in zip(positions, truths):
+        if position is None:
+            continue
+        nearest = min(range(len(leds)), key=lambda k: math.dist(position, leds[k]))
+        if math.dist(position, leds[nearest]) > 20: # どちらのLEDでもない (反射)
+            nearest = -1
+        if last is not None and nearest != last:
+            switches += 1
+        last = nearest
+    return switches
+
+
+def bench_blobs(args):
+    width, height = (int(v) for v in args.resolution.lower().split('x'))
+    frames = make_blob_frames(width, height, args.frames)
+    truths = [leds for _, leds in frames]
+    print(f"{width}x{height}, {args.frames} フレーム (LED 2つ + {30} フレーム目から反射)")
+    print(f"{'検出方式':>16} {'飛び移り':>8} {'見失い':>6}")
+    for name, detector in [('full', ROISpotDetector(enabled=False)), ('roi', ROISpotDetector()),
+                           ('pyramid', PyramidSpotDetector()), ('blob', BlobTracker())]:
+        positions = []
+        for frame, _ in frames:
+            max_val, max_loc = detector.detect(frame, args.threshold)
+            positions.append(max_loc if max_val >= args.threshold else None)
+        print(f"{name:>16} {count_switches(positions, truths):8d} {positions.count(None):6d}")
+    tracker = BlobTracker()
+    slots = [[], []]
+    for frame, _ in frames:
+        tracker.update(frame, args.threshold)
+        for slot in range(2):
+            max_val, max_loc = tracker.result(slot)
+            slots[slot].append(max_loc if max_val >= args.threshold else None)
+    switches = ' / '.join(str(count_switches(p, truths)) for p in slots)
+    print(f"{'blob (2ポインタ)':>16} {switches:>8} {' / '.join(str(p.count(None)) for p in slots):>6}")
+
+    print(f"\n{'輝点数':>6} {'検出数':>6} {'find_blobs ms':>14} {'update ms':>10}")
+    rng = random.Random(1)
+    for count in args.blobs or [1, 4, 16, 64, 256]:
+        frame = np.zeros((height, width), dtype=np.uint8)
+        for _ in range(count):
+            cv2.circle(frame, (rng.randrange(width), rng.randrange(height)), rng.randint(1, 4), 255, -1)
+        tracker = BlobTracker()
+        find_times, update_times = [], []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            centroids, _, _ = find_blobs(frame, args.threshold, max_blobs=tracker.max_blobs)
+            find_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            tracker.update(frame, args.threshold)
+            update_times.append(time.perf_counter() - start)
+        print(f"{count:6d} {len(centroids):6d} {percentile(find_times, 50) * 1000:14.3f} "
+              f"{percentile(update_times, 50) * 1000:10.3f}")
+
+
+# ===================================================================
+# --- 映り込みのマスク (glare) ---
+# LEDより明るい天井の照明とモニターが写った映像で、マスク無しとポインタを映さずに
+# 学習したマスク有りの検出器を比べる。途中でモニターが消える (照明の変化への追従)。
+# ===================================================================
+
+def make_glare_frames(width, height, count, fps=30.0, monitor_off=None, seed=0):
+    """照明・モニター・動くLEDの合成フレームと、各フレームのLEDの真値 (x, y) のリストを作る
+
+    count が 0 のフレームでなく、LEDを映さない学習用のフレームが欲しい場合は fps=0 にする。
+    """
+    rng = np.random.default_rng(seed)
+    lamp = (int(width * 0.1), 0, int(width * 0.35), int(height * 0.12))
+    monitor = (int(width * 0.65), int(height * 0.2), int(width * 0.9), int(height * 0.45))
+    frames = []
+    for i in range(count):
+        frame = rng.integers(0, 40, (height, width, 3), dtype=np.uint8) # 暗い背景とノイズ
+        cv2.rectangle(frame, lamp[:2], lamp[2:], (255, 255, 255), -1)
+        if monitor_off is None or i < monitor_off:
+            value = int(rng.integers(245, 256)) # モニターのちらつき
+            cv2.rectangle(frame, monitor[:2], monitor[2:], (value,) * 3, -1)
+        led = None
+        if fps:
+            t = i / fps
+            led = (width * (0.5 + 0.3 * math.sin(2.0 * math.pi * t / 4.0)),
+                   height * (0.6 + 0.25 * math.sin(2.0 * math.pi * t / 2.5)))
+            value = int(rng.integers(225, 241)) # LEDは照明・モニターより暗い
+            cv2.circle(frame, (int(round(led[0] * 16)), int(round(led[1] * 16))), 5 * 16, (value,) * 3, -1,
+                       cv2.LINE_AA, 4)
+        frames.append((frame, led))
+    return frames
+
+
+def bench_glare(args):
+    width, height = (int(v) for v in args.resolution.lower().split('x'))
+    calibration = [frame for frame, _ in make_glare_frames(width, height, args.calibration, fps=0, seed=1)]
+    frames = make_glare_frames(width, height, args.frames, monitor_off=args.frames // 2)
+
+    def calibrated():
+        glare = GlareMask(width, height, update_interval=args.update_interval)
+        for frame in calibration:
+            glare.add_calibration_frame(frame, args.threshold)
+        glare.finish_calibration()
+        return glare
+
+    glare = calibrated()
+    print(f"{width}x{height}, 学習 {args.calibration} フレーム → 画面の {glare.masked_fraction:.1%} をマスク "
+          f"(走査する矩形 {len(glare.rects) if glare.rects is not None else '-'} 個)")
+    covered = sum(1 for _, (x, y) in frames if not glare.valid[int(y), int(x)])
+    print(f"評価 {args.frames} フレーム ({args.frames // 2} フレーム目でモニターが消える。"
+          f"LEDが学習したマスクに重なるフレーム {covered})")
+    print(f"{'検出方式':>8} {'マスク':>6} {'正しく検出':>10} {'誤検出':>6} {'見失い':>6} {'平均誤差 px':>11}")
+    monitor = (int(height * 0.3), int(width * 0.8))
+    unmasked_at = None
+    for kind in ('full', 'roi', 'pyramid', 'blob'):
+        for masked in (False, True):
+            mask = calibrated() if masked else None
+            detector = make_detector(kind, mask)
+            hits, lost, errors = 0, 0, []
+            for i, (frame, led) in enumerate(frames):
+                max_val, max_loc = detector.detect(frame, args.threshold)
+                if mask is not None and unmasked_at is None and not mask.core[monitor]:
+                    unmasked_at = i
+                if max_val < args.threshold:
+                    lost += 1
+                    continue
+                error = math.dist(max_loc, led)
+                if error <= 10:
+                    hits += 1
+                    errors.append(error)
+            mean = f"{sum(errors) / len(errors):11.2f}" if errors else f"{'-':>11}"
+            print(f"{kind:>8} {'有' if masked else '無':>6} {hits:10d} {len(frames) - hits - lost:6d} {lost:6d} {mean}")
+    if unmasked_at is not None:
+        print(f"モニターが消えてからマスクが外れるまで: {unmasked_at - args.frames // 2} フレーム")
+
+    # --- 画像全体の探索時間 (マスクの面積ごと。矩形に分けてグレースケール化するかは GlareMask が選ぶ) ---
+    print(f"\n{'マスク':>6} {'矩形':>4} {'矩形ごと':>12} {'マスク無し ms':>13} {'マスク画像 ms':>13} {'GlareMask ms':>13}")
+    frame = frames[0][0]
+    gray = np.empty((height, width), dtype=np.uint8)
+    for fraction in args.fraction or [glare.masked_fraction, 0.25, 0.5]:
+        mask = glare
+        if mask.masked_fraction != fraction: # 画面の中ほどの1つの矩形 (大きなモニターや窓)
+            side = math.sqrt(fraction)
+            mask = GlareMask(width, height, dilate=0)
+            x0, y0 = int(width * (1 - side) / 2), int(height * (1 - side) / 2)
+            mask.core[y0:y0 + int(height * side), x0:x0 + int(width * side)] = 255
+            mask._rebuild()
+        times = {}
+        for name, search in [('none', lambda: find_bright_spot(frame, gray)),
+                             ('valid', lambda: find_bright_spot(frame, gray, mask.valid)),
+                             ('glare', lambda: mask.find_bright_spot(frame, gray))]:
+            samples = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                search()
+                samples.append(time.perf_counter() - start)
+            times[name] = percentile(samples, 50) * 1000
+        print(f"{mask.masked_fraction:6.1%} {len(mask.rects):4d} {'する' if mask.scan_by_rect else 'しない':>12} "
+              f"{times['none']:13.3f} {times['valid']:13.3f} {times['glare']:13.3f}")
+
+
+# ===================================================================
+# --- カメラの取得設定 (Capture Profile) ---
+# 疑似ドライバ (capture_profile.FakeCamera) で、ドライバ既定の設定と計測して選んだ
+# 設定のそれぞれについて、動きが起きてから処理ループがそれを写したフレームを処理し終える
+# までの遅れを測る (撮影を待つ時間・ドライバ内の待ち・処理時間を含む)。
+# ===================================================================
+
+def measure_event_latency(cap, duration, work, events=2000):
+    """FrameGrabber で cap を読み、1フレームごとに work 秒の処理をする
+
+    一様に散らばった時刻に動きが起きたとして、その後に撮影されたフレームの処理が
+    終わるまでの時間 (秒) のリストと、処理したフレーム数を返す。
+    """
+    grabber = FrameGrabber(cap)
+    captured = {}
+    grabber.on_frame = lambda frame, timestamp: captured.__setitem__(timestamp, cap.last_timestamp)
+    grabber.start()
+    processed = [] # (撮影時刻, 処理を終えた時刻)
+    last_seq = 0
+    begin = time.monotonic()
+    deadline = begin + duration
+    while time.monotonic() < deadline:
+        ret, frame, timestamp, last_seq = grabber.read(last_seq, timeout=1.0)
+        if not ret:
+            break
+        end = time.perf_counter() + work # 検出などの処理の代わり
+        while time.perf_counter() < end:
+            pass
+        processed.append((captured.pop(timestamp, timestamp), time.monotonic()))
+    grabber.release()
+    if not processed:
+        return [], 0
+    latencies = []
+    last_capture = processed[-1][0]
+    for _ in range(events):
+        event = random.uniform(begin + 0.2, last_capture) # 起動直後は除く
+        finish = next(done for shot, done in processed if shot >= event)
+        latencies.append(finish - event)
+    return latencies, len(processed)
+
+
+def bench_capture(args):
+    target = parse_target(args.target)
+    print(f"目標 {args.target}, 処理 {args.work * 1000:g} ms/フレーム, {args.duration:g} 秒")
+    print("--- 候補の計測 ---")
+    results = probe_profiles(FakeCamera, candidate_profiles(target), frames=args.frames)
+    rows = [('ドライバ既定', None), ('選んだ設定', choose_profile(results, target).profile)]
+    if args.max_fps:
+        capped = [r for r in results if r.actual.fps <= args.max_fps]
+        if capped:
+            rows.append((f"上限 {args.max_fps:g} fps", choose_profile(capped, target).profile))
+    print(f"\n{'設定':>12} {'採用された設定':>22} {'frames':>7} {'遅れ p50':>9} {'遅れ p99':>9}  (ms)")
+    for label, profile in rows:
+        cap = FakeCamera()
+        actual = apply_profile(cap, profile) if profile else read_back(cap)
+        latencies, frames = measure_event_latency(cap, args.duration, args.work)
+        print(f"{label:>12} {format_profile(actual):>22} {frames:7d} {percentile(latencies, 50) * 1000:9.1f} "
+              f"{percentile(latencies, 99) * 1000:9.1f}")
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite(args):
+    resolutions = RESOLUTIONS
+    if args.resolution:
+        resolutions = [tuple(int(v) for v in r.lower().split('x')) for r in args.resolution]
+    report = {
+        'commit': _git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'machine': platform.machine(),
+        'results': [],
+    }
+    for width, height in resolutions:
+        frames = make_frames(width, height, args.frames)
+        stages = bench_stages(width, height, frames, args.threshold)
+        e2e = bench_end_to_end(width, height, frames, args.fps, args.imu_rate, args.threshold, args.imu_format)
+        report['results'].append({'resolution': f"{width}x{height}", 'stages': stages, 'end_to_end': e2e})
+
+        print(f"\n=== {width}x{height} ===")
+        print(f"{'段':>16} {'p50 ms':>9} {'p99 ms':>9}")
+        for name, summary in stages.items():
+            print(f"{name:>16} {summary['p50_ms']:9.3f} {summary['p99_ms']:9.3f}")
+        print(f"--- 通し (カメラ {args.fps or '最大'} fps, IMU {args.imu_rate} Hz) ---")
+        for name, summary in e2e['stages'].items():
+            print(f"{name:>16} {summary['p50_ms']:9.3f} {summary['p99_ms']:9.3f}")
+        error = e2e['tracking_error_px']
+        print(f"処理 {e2e['fps']:.1f} fps (取りこぼし {e2e['frames_dropped']}), "
+              f"IMU {e2e['imu_samples']} サンプル, "
+              f"追跡誤差 平均 {error['mean']:.1f} px / p99 {error['p99']:.1f} px")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n結果を保存しました: {args.json}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="トラッキング処理のベンチマーク")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('detect', help="輝点検出方式の速度と精度を比較する")
+    p.add_argument('--frames', type=int, default=200)
+    p.add_argument('--threshold', type=int, default=200)
+    p.set_defaults(func=bench_detect)
+
+    p = sub.add_parser('engine', help="フュージョン処理のコストを旧実装と比較する")
+    p.add_argument('--ticks', type=int, default=100000)
+    p.set_defaults(func=bench_engine)
+
+    p = sub.add_parser('imu', help="IMU受信データの解析速度を形式ごとに比較する")
+    p.add_argument('--samples', type=int, default=100000)
+    p.add_argument('--per-read', type=int, action='append', help="1回の受信に含まれるサンプル数 (複数指定可)")
+    p.set_defaults(func=bench_imu, per_read=None)
+
+    p = sub.add_parser('cursor', help="カーソル出力方式の呼び出し回数/秒を比較する")
+    p.add_argument('--moves', type=int, default=20000, help="エンジン出力の座標列の長さ")
+    p.add_argument('--raw-moves', type=int, default=2000, help="省略なしで送る回数")
+    p.add_argument('--check', action='store_true',
+                   help="カーソルが指定位置に動かなかった (query_pointer で確認) 場合に終了コード 1 を返す")
+    p.set_defaults(func=bench_cursor)
+
+    p = sub.add_parser('filter', help="平滑化フィルタの遅れとブレを同じ入力で比較する")
+    p.add_argument('--fps', type=float, default=30.0)
+    p.add_argument('--cam-noise', type=float, default=0.3, help="輝点位置のノイズ (カメラpx, 標準偏差)")
+    p.add_argument('--imu-noise', type=float, default=0.05, help="IMUの移動量のノイズ (度, 標準偏差)")
+    p.set_defaults(func=bench_filter)
+
+    p = sub.add_parser('latency', help="カメラの遅れをIMUで補償したときの遅れを比較する")
+    p.add_argument('--fps', type=float, default=30.0)
+    p.add_argument('--imu-rate', type=float, default=100.0)
+    p.add_argument('--camera-latency', type=float, default=0.04, help="撮影からフレーム取得までの遅れ (秒)")
+    p.set_defaults(func=bench_latency)
+
+    p = sub.add_parser('relay', help="中継サーバーの負荷試験 (コマンド/秒と p99)")
+    p.add_argument('--clients', type=int, default=8, help="並行して送るクライアント数")
+    p.add_argument('--requests', type=int, default=500, help="クライアントごとのリクエスト数")
+    p.add_argument('--batch', type=int, default=16, help="batch / udp で1回に送るコマンド数")
+    p.add_argument('--server', action='append', choices=('waitress', 'werkzeug'), help="HTTPサーバー (複数指定可)")
+    p.add_argument('--mode', action='append', choices=('get', 'batch', 'udp'), help="送信方式 (複数指定可)")
+    p.set_defaults(func=bench_relay)
+
+    p = sub.add_parser('scaling', help="トラッカーを増やしたときの処理性能を計測する")
+    p.add_argument('--count', type=int, action='append', help="同時に動かすトラッカー数 (複数指定可)")
+    p.add_argument('--mode', action='append', choices=('thread', 'process'), help="並列化の方式 (複数指定可)")
+    p.add_argument('--resolution', default='640x480', metavar='WxH')
+    p.add_argument('--fps', type=float, default=60.0, help="合成カメラのフレームレート (0で最大)")
+    p.add_argument('--imu-rate', type=float, default=100.0)
+    p.add_argument('--duration', type=float, default=3.0, help="1回の計測時間 (秒)")
+    p.set_defaults(func=bench_scaling)
+
+    p = sub.add_parser('split', help="検出を別プロセスにしたときのループの揺らぎを負荷をかけて比較する")
+    p.add_argument('--resolution', default='1280x720', metavar='WxH')
+    p.add_argument('--fps', type=float, default=60.0)
+    p.add_argument('--kind', choices=DETECTOR_KINDS, default='roi', help="検出方式")
+    p.add_argument('--threshold', type=int, default=200)
+    p.add_argument('--duration', type=float, default=3.0, help="1条件あたりの計測時間 (秒)")
+    p.add_argument('--gui-threads', type=int, default=2, help="GUIの処理を模すスレッド数")
+    p.add_argument('--http-clients', type=int, default=4, help="中継サーバーに送り続ける接続数")
+    p.set_defaults(func=bench_split)
+
+    p = sub.add_parser('alloc', help="1フレームあたりのメモリ確保量を従来の処理と比較する")
+    p.add_argument('--resolution', default='1280x720', metavar='WxH')
+    p.add_argument('--frames', type=int, default=120)
+    p.add_argument('--preview-every', type=int, default=4, help="プレビューを作るフレームの間隔")
+    p.add_argument('--threshold', type=int, default=200)
+    p.set_defaults(func=bench_alloc)
+
+    p = sub.add_parser('blobs', help="複数の輝点があるときの飛び移りと、輝点数による処理時間を計測する")
+    p.add_argument('--resolution', default='1280x720', metavar='WxH')
+    p.add_argument('--frames', type=int, default=300)
+    p.add_argument('--threshold', type=int, default=200)
+    p.add_argument('--blobs', type=int, action='append', help="処理時間を測る輝点数 (複数指定可)")
+    p.add_argument('--repeat', type=int, default=50, help="輝点数ごとの計測回数")
+    p.set_defaults(func=bench_blobs)
+
+    p = sub.add_parser('glare', help="照明・モニターの映り込みを学習したマスクの効果を計測する")
+    p.add_argument('--resolution', default='1280x720', metavar='WxH')
+    p.add_argument('--frames', type=int, default=600)
+    p.add_argument('--calibration', type=int, default=60, help="学習に使うフレーム数 (LEDを映さない)")
+    p.add_argument('--update-interval', type=int, default=10, help="動作中にマスクを学習し直すフレーム間隔")
+    p.add_argument('--threshold', type=int, default=200)
+    p.add_argument('--repeat', type=int, default=200, help="探索時間の計測回数")
+    p.add_argument('--fraction', type=float, action='append', help="探索時間を測るマスクの面積の割合 (複数指定可)")
+    p.set_defaults(func=bench_glare)
+
+    p = sub.add_parser('capture', help="カメラの取得設定ごとのフレームの古さを疑似ドライバで比較する")
+    p.add_argument('--target', default='640x480@60', help="目標 (幅x高さ@FPS)")
+    p.add_argument('--work', type=float, default=0.012, help="1フレームあたりの処理時間 (秒)")
+    p.add_argument('--max-fps', type=float, default=0, help="FPSの上限を付けて選んだ設定も比較する (0で比較しない)")
+    p.add_argument('--frames', type=int, default=30, help="候補の計測で読むフレーム数")
+    p.add_argument('--duration', type=float, default=3.0, help="1条件あたりの計測時間 (秒)")
+    p.set_defaults(func=bench_capture)
+
+    p = sub.add_parser('suite', help="各段の単体性能と通し性能を計測する")
+    p.add_argument('--frames', type=int, default=300)
+    p.add_argument('--resolution', action='append', metavar='WxH', help="計測する解像度 (複数指定可)")
+    p.add_argument('--fps', type=float, default=30.0, help="合成カメラのフレームレート (0で最大)")
+    p.add_argument('--imu-rate', type=float, default=100.0, help="疑似IMUの送信レート (Hz)")
+    p.add_argument('--imu-format', choices=('csv', 'binary'), default='csv', help="疑似IMUの送信形式")
+    p.add_argument('--threshold', type=int, default=200)
+    p.add_argument('--json', help="結果をJSONで保存する")
+    p.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,236 @@
+# ===================================================================
+# --- 複数輝点の追跡 (Blob Tracker) ---
+# 閾値以上の明るい領域 (ブロブ) を2値化と輪郭抽出の1回の走査ですべて取り出し、
+# フレーム間で既存のトラックに対応付けて、ポインタごとに変わらないIDを付ける。
+# LEDが2つある・窓の反射が写り込む、といった場合でも、最も明るい画素を追う
+# 検出器のようにカーソルが別の輝点へ飛び移らない。
+#
+# 1フレームの処理は 2値化 + 輪郭抽出 (画素数に比例) と、輪郭の面積の大きい
+# max_blobs 個だけのモーメント計算、最大 max_tracks × max_blobs の距離行列による
+# 対応付けなので、輝点やノイズが増えても画像全体を何度も走査することはない。
+# (cv2.connectedComponentsWithStats は全画素にラベルを書くため 1280x720 で約30倍遅い)
+#
+#   tracker = BlobTracker()
+#   engine = TrackingEngine(..., detector=tracker)    # 最初に確定したポインタを追う
+#
+#   # 1台のカメラで複数のポインタを動かす場合 (エンジンごとにスロットを指定する)
+#   engines = [TrackingEngine(..., detector=tracker.pointer(slot)) for slot in range(2)]
+# ===================================================================
+import cv2
+import numpy as np
+
+from detector import reuse_buffer
+from metrics import METRICS
+
+_TRACK_EVENTS = METRICS.counter('blob_tracks', "輝点のトラックの作成・消滅の回数", label_name='event')
+
+
+def find_blobs(gray, threshold, min_area=2, max_blobs=16, binary=None, valid=None):
+    """閾値以上の画素のまとまりを取り出し (centroids, areas, boxes) を返す
+
+    centroids は (N, 2) の重心 (x, y)、areas は (N,) の画素数、boxes は (N, 4) の
+    外接矩形 (x, y, 幅, 高さ)。輪郭の面積の大きい順に max_blobs 個まで調べ、
+    min_area 未満のものはノイズとして捨てる。重心と画素数はその輪郭の内側の画素だけで
+    求める (外接矩形が重なる隣の輝点の画素は含めない)。
+    binary (gray と同じ大きさの uint8 配列) を渡すと2値化の出力先に使う。
+    valid (glare_mask.GlareMask.valid) を渡すと 0 の画素を除く。
+    """
+    binary = cv2.threshold(gray, threshold - 1, 255, cv2.THRESH_BINARY, dst=binary)[1]
+    if valid is not None:
+        cv2.bitwise_and(binary, valid, dst=binary)
+    contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if len(contours) > max_blobs: # ノイズの多いフレームでも Python のループは max_blobs 回まで
+        sizes = np.fromiter(map(cv2.contourArea, contours), dtype=np.float64, count=len(contours))
+        contours = [contours[i] for i in np.argpartition(sizes, -max_blobs)[-max_blobs:]]
+    boxes = np.empty((len(contours), 4), dtype=np.int32)
+    centroids = np.empty((len(contours), 2))
+    areas = np.empty(len(contours), dtype=np.int32)
+    for i, contour in enumerate(contours):
+        x, y, w, h = boxes[i] = cv2.boundingRect(contour)
+        inside = np.zeros((h, w), dtype=np.uint8) # この輪郭の内側 (2値画像と重ねて穴を除く)
+        cv2.drawContours(inside, [contour], 0, 255, -1, offset=(-x, -y))
+        cv2.bitwise_and(inside, binary[y:y + h, x:x + w], dst=inside)
+        m = cv2.moments(inside, binaryImage=True)
+        areas[i] = m['m00']
+        centroids[i] = (x + m['m10'] / m['m00'], y + m['m01'] / m['m00']) if m['m00'] else (x, y)
+    keep = areas >= min_area
+    return centroids[keep], areas[keep], boxes[keep]
+
+
+class Track:
+    """1つの輝点の追跡状態"""
+
+    __slots__ = ('id', 'x', 'y', 'vx', 'vy', 'area', 'box', 'hits', 'missed', 'slot')
+
+    def __init__(self, track_id, x, y, area, box):
+        self.id = track_id
+        self.x, self.y = x, y
+        self.vx = self.vy = 0.0  # 1フレームあたりの移動量 (予測用)
+        self.area = area
+        self.box = box           # 外接矩形 (x, y, 幅, 高さ)
+        self.hits = 1            # 対応付けできたフレーム数
+        self.missed = 0          # 連続して見つからなかったフレーム数
+        self.slot = None         # ポインタの番号 (確定するまで None)
+
+    def __repr__(self):
+        return f"Track(id={self.id}, slot={self.slot}, x={self.x:.1f}, y={self.y:.1f}, area={self.area})"
+
+
+class BlobTracker:
+    """閾値以上の輝点をすべて検出し、フレーム間で同じ輝点に同じIDを付ける
+
+    新しい輝点は min_hits フレーム続けて見つかると確定し、空いている最小の
+    ポインタ番号 (slot) を得る。max_missed フレーム続けて見失うと消え、番号が空く。
+    対応付けは予測位置 (前回位置 + 速度) から近い順の貪欲法で、gate ピクセルより
+    離れた輝点とは対応付けない。
+
+    detect() は ROISpotDetector と同じ (maxVal, maxLoc) を返し、slot 0 のポインタの
+    重心 (サブピクセル) と輝度の最大値になる。見失っている間は maxVal が 0。
+    """
+
+    def __init__(self, min_area=2, max_blobs=16, max_tracks=8, gate=80.0, min_hits=2, max_missed=5,
+                 velocity_smoothing=0.5, glare=None):
+        self.min_area = min_area                     # これより小さい成分はノイズとして捨てる (画素数)
+        self.max_blobs = max_blobs                   # 1フレームで扱う輝点の上限
+        self.max_tracks = max_tracks                 # 同時に追跡する輝点の上限
+        self.gate = gate                             # 対応付けを許す予測位置からの距離 (ピクセル)
+        self.min_hits = min_hits                     # 確定までに必要な連続検出フレーム数
+        self.max_missed = max_missed                 # これを超えて見失ったトラックは消す
+        self.velocity_smoothing = velocity_smoothing # 速度推定の平滑化係数
+        self.glare = glare                           # 映り込みのマスク (glare_mask.GlareMask)
+        self.tracks = []
+        self.generation = 0 # update() の回数 (pointer() の各ビューが新しいフレームかを判別する)
+        self._next_id = 1
+        self._gray = None
+        self._binary = None
+        self._current = None # 直近の update() のグレースケール画像
+
+    def reset(self):
+        _TRACK_EVENTS.inc(len(self.tracks), label='lost')
+        self.tracks = []
+
+    def pointers(self):
+        """確定していて今のフレームで見えているトラックを slot の順に返す"""
+        return sorted((t for t in self.tracks if t.slot is not None and t.missed == 0), key=lambda t: t.slot)
+
+    def update(self, frame, threshold):
+        """1フレーム分の輝点を検出してトラックを更新し、pointers() を返す"""
+        if frame.ndim == 3:
+            self._gray = reuse_buffer(self._gray, frame.shape[:2])
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self._gray)
+        else:
+            gray = frame
+        self._binary = reuse_buffer(self._binary, gray.shape)
+        glare = self.glare
+        valid = None if glare is None or glare.empty else glare.valid
+        centroids, areas, boxes = find_blobs(gray, threshold, self.min_area, self.max_blobs, self._binary, valid)
+        self._current = gray
+        self.generation += 1
+
+        tracks = self.tracks
+        matched_blobs = np.zeros(len(centroids), dtype=bool)
+        if tracks and len(centroids):
+            predicted = np.array([(t.x + t.vx, t.y + t.vy) for t in tracks])
+            distances = np.hypot(predicted[:, None, 0] - centroids[None, :, 0],
+                                 predicted[:, None, 1] - centroids[None, :, 1])
+            matched_tracks = np.zeros(len(tracks), dtype=bool)
+            for flat in np.argsort(distances, axis=None):
+                ti, bi = divmod(int(flat), len(centroids))
+                if distances[ti, bi] > self.gate:
+                    break
+                if matched_tracks[ti] or matched_blobs[bi]:
+                    continue
+                matched_tracks[ti] = matched_blobs[bi] = True
+                self._update_track(tracks[ti], centroids[bi], areas[bi], boxes[bi])
+            for ti in np.flatnonzero(~matched_tracks):
+                self._coast(tracks[ti])
+        else:
+            for track in tracks:
+                self._coast(track)
+
+        # --- 見失いが続いたトラックを消し、残った輝点から新しいトラックを作る (面積の大きい順) ---
+        alive = [t for t in tracks if t.missed <= self.max_missed]
+        _TRACK_EVENTS.inc(len(tracks) - len(alive), label='lost')
+        for bi in sorted(np.flatnonzero(~matched_blobs), key=lambda i: -areas[i]):
+            if len(alive) >= self.max_tracks:
+                break
+            x, y = centroids[bi]
+            alive.append(Track(self._next_id, float(x), float(y), int(areas[bi]), tuple(int(v) for v in boxes[bi])))
+            self._next_id += 1
+            _TRACK_EVENTS.inc(label='created')
+        self.tracks = alive
+        self._assign_slots()
+        if glare is not None: # 確定したポインタの周囲は映り込みとして学習しない
+            primary = next((t for t in alive if t.slot == 0 and t.missed == 0), None)
+            glare.observe(gray, threshold, None if primary is None else (primary.x, primary.y))
+        return self.pointers()
+
+    def _update_track(self, track, centroid, area, box):
+        x, y = float(centroid[0]), float(centroid[1])
+        k = self.velocity_smoothing
+        track.vx = (1 - k) * track.vx + k * (x - track.x)
+        track.vy = (1 - k) * track.vy + k * (y - track.y)
+        track.x, track.y = x, y
+        track.area = int(area)
+        track.box = tuple(int(v) for v in box)
+        track.hits += 1
+        track.missed = 0
+
+    def _coast(self, track):
+        """見つからなかったトラックは予測位置に進めておく (再び見つけたときの対応付け用)"""
+        track.x += track.vx
+        track.y += track.vy
+        track.missed += 1
+        if track.slot is None:
+            track.hits = 0 # 確定前の見失いは最初から数え直す
+
+    def _assign_slots(self):
+        used = {t.slot for t in self.tracks if t.slot is not None}
+        for track in self.tracks:
+            if track.slot is None and track.hits >= self.min_hits:
+                slot = 0
+                while slot in used:
+                    slot += 1
+                track.slot = slot
+                used.add(slot)
+
+    def result(self, slot=0):
+        """直近の update() での slot 番のポインタの (maxVal, maxLoc)"""
+        for track in self.tracks:
+            if track.slot == slot:
+                if track.missed:
+                    return 0.0, (track.x, track.y)
+                x, y, w, h = track.box
+                max_val = cv2.minMaxLoc(self._current[y:y + h, x:x + w])[1]
+                return max_val, (track.x, track.y)
+        return 0.0, (0.0, 0.0)
+
+    def detect(self, frame, threshold):
+        """輝点を検出し、slot 0 のポインタの (maxVal, maxLoc) を返す"""
+        self.update(frame, threshold)
+        return self.result(0)
+
+    def pointer(self, slot):
+        """slot 番のポインタだけを返す検出器 (同じフレームを複数のエンジンで処理する場合)"""
+        return PointerView(self, slot)
+
+
+class PointerView:
+    """BlobTracker の1つのポインタを、TrackingEngine の検出器として見せる
+
+    同じ BlobTracker のビューを複数のエンジンに渡し、フレームごとに各エンジンの
+    step() を同じフレームで1回ずつ呼ぶ。最初に呼ばれたビューが update() を行い、
+    他のビューはその結果を読むだけなので、検出は1フレームにつき1回で済む。
+    """
+
+    def __init__(self, tracker, slot):
+        self.tracker = tracker
+        self.slot = slot
+        self._seen = 0 # 最後に読んだ tracker.generation
+
+    def detect(self, frame, threshold):
+        tracker = self.tracker
+        if self._seen == tracker.generation: # このビューは今の結果を読み済み = 新しいフレーム
+            tracker.update(frame, threshold)
+        self._seen = tracker.generation
+        return tracker.result(self.slot)
@@ -0,0 +1,219 @@
+# ===================================================================
+# --- カメラ取得サブシステム (Threaded Camera Capture) ---
+# cv2.VideoCapture を専用スレッドで回し、常に「最新の1フレーム」だけを保持する。
+# メインループは古いフレームを待たずに最新画像を処理でき、
+# 同じフレームを再処理しているかどうかはシーケンス番号で判別できる。
+# ===================================================================
+import time
+from threading import Thread, Condition
+
+import cv2
+import numpy as np
+
+from capture_profile import apply_profile, format_profile, same_mode
+from metrics import METRICS, now
+
+_CAPTURE_TIME = METRICS.histogram('capture', "cap.read() でフレームを取得するまでの時間")
+_DROPPED = METRICS.counter('frames_dropped', "処理される前に新しいフレームで上書きされたフレーム数")
+
+
+class SyntheticSource:
+    """Webカメラが無い環境向けの合成フレームソース
+
+    黒背景の上を明るい点 (LED相当) が円軌道で移動する画像を生成する。
+    cv2.VideoCapture と同じ read() / get() / isOpened() / release() を持つ。
+    """
+
+    def __init__(self, width=640, height=480, fps=30.0, spot_radius=4, spot_value=255,
+                 period=4.0, max_frames=None, realtime=True):
+        self.width = int(width)
+        self.height = int(height)
+        self.fps = float(fps)
+        self.spot_radius = spot_radius
+        self.spot_value = spot_value
+        self.period = period
+        self.max_frames = max_frames
+        self.realtime = realtime
+        self.frame_index = 0
+        self.last_spot = (0.0, 0.0) # 直近フレームの点の真値 (ベンチマークの誤差計算用)
+        self._opened = True
+        self._next_due = time.monotonic()
+
+    def spot_position(self, index):
+        """フレーム番号 index における点の中心座標 (真値) を返す"""
+        t = index / self.fps
+        angle = 2.0 * np.pi * t / self.period
+        cx = self.width * (0.5 + 0.3 * np.cos(angle))
+        cy = self.height * (0.5 + 0.3 * np.sin(angle))
+        return float(cx), float(cy)
+
+    def render(self, index):
+        """フレーム番号 index の画像 (BGR) を生成する"""
+        frame = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        cx, cy = self.spot_position(index)
+        # サブピクセル位置に描画する (shift=4 で 1/16 ピクセル単位)
+        cv2.circle(frame, (int(round(cx * 16)), int(round(cy * 16))), self.spot_radius * 16,
+                   (self.spot_value,) * 3, -1, cv2.LINE_AA, 4)
+        return frame
+
+    def read(self):
+        if not self._opened:
+            return False, None
+        if self.max_frames is not None and self.frame_index >= self.max_frames:
+            return False, None
+        if self.realtime:
+            # 実カメラと同様にフレーム間隔ぶんブロックする
+            now = time.monotonic()
+            if self._next_due > now:
+                time.sleep(self._next_due - now)
+            self._next_due = max(self._next_due, now) + 1.0 / self.fps
+        frame = self.render(self.frame_index)
+        self.last_spot = self.spot_position(self.frame_index)
+        self.frame_index += 1
+        return True, frame
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.width)
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.height)
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        return 0.0
+
+    def set(self, prop, value):
+        return False
+
+    def isOpened(self):
+        return self._opened
+
+    def release(self):
+        self._opened = False
+
+
+def open_source(source):
+    """カメラ番号・動画ファイルパス・'synthetic' 指定からキャプチャを開く
+
+    - int または数字の文字列: Webカメラ番号
+    - 'synthetic' / 'synthetic:WxH': 合成フレーム
+    - 'replay://DIR': recording.py で記録したフレーム
+    - それ以外の文字列: 動画ファイルのパス
+    - read() を持つオブジェクト: そのまま使用
+    """
+    if hasattr(source, 'read'):
+        return source
+    if isinstance(source, str):
+        if source.isdigit():
+            return cv2.VideoCapture(int(source))
+        if source.startswith('replay://'):
+            from recording import ReplayCapture
+            return ReplayCapture(source)
+        if source.startswith('synthetic'):
+            _, _, size = source.partition(':')
+            if size:
+                w, h = size.lower().split('x')
+                return SyntheticSource(int(w), int(h))
+            return SyntheticSource()
+    return cv2.VideoCapture(source)
+
+
+class FrameGrabber:
+    """キャプチャを専用スレッドで読み続け、最新フレームのみを保持するクラス
+
+    read() は (ret, frame, timestamp, seq) を返す。
+    timestamp は time.monotonic() によるフレーム取得時刻、seq は取得順の通し番号。
+    読み出されずに上書きされたフレームは dropped としてカウントされる。
+    profile (capture_profile.CaptureProfile) を渡すと、開いたカメラに取得設定を適用する。
+    """
+
+    def __init__(self, source=0, loop=False, profile=None):
+        self.source = source
+        self.loop = loop # 動画ファイルの末尾に達したら先頭に戻る
+        self.cap = open_source(source)
+        self.profile = None # 実際に採用された取得設定
+        if profile is not None and isinstance(self.cap, cv2.VideoCapture) and self.cap.isOpened():
+            self.profile = apply_profile(self.cap, profile)
+            if not same_mode(profile, self.profile):
+                print(f"⚠️ 警告: カメラが取得設定 {format_profile(profile)} を受け付けず "
+                      f"{format_profile(self.profile)} になりました。")
+        self._cond = Condition()
+        self._frame = None
+        self._timestamp = 0.0
+        self._seq = 0
+        self._consumed_seq = 0
+        self._running = False
+        self._ended = False
+        self._thread = None
+        self.dropped = 0
+        self.on_frame = None # フレーム取得ごとに on_frame(frame, timestamp) を呼ぶ (記録用)
+
+    def isOpened(self):
+        return self.cap is not None and self.cap.isOpened()
+
+    def get(self, prop):
+        return self.cap.get(prop)
+
+    def start(self):
+        """取得スレッドを開始する"""
+        if self._running:
+            return self
+        self._running = True
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while self._running:
+            start = now()
+            ret, frame = self.cap.read()
+            timestamp = time.monotonic()
+            _CAPTURE_TIME.since(start)
+            if not ret:
+                if self.loop and hasattr(self.cap, 'set') and self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0):
+                    continue
+                with self._cond:
+                    self._ended = True
+                    self._cond.notify_all()
+                break
+            if self.on_frame is not None:
+                self.on_frame(frame, timestamp)
+            with self._cond:
+                if self._seq > self._consumed_seq:
+                    self.dropped += 1
+                    _DROPPED.inc()
+                self._frame = frame
+                self._timestamp = timestamp
+                self._seq += 1
+                self._cond.notify_all()
+
+    def read(self, last_seq=None, timeout=1.0):
+        """最新フレームを返す
+
+        last_seq を渡すと、それより新しいフレームが届くまで最大 timeout 秒待つ。
+        待っても新しいフレームが無ければ seq は last_seq のまま返るので、
+        呼び出し側は seq を比較して同じフレームの再処理を避けられる。
+        ret=False になるのは取得が終了 (動画の終端・カメラ切断) した場合のみ。
+        """
+        with self._cond:
+            seen_seq = self._consumed_seq if last_seq is None else last_seq
+            self._cond.wait_for(lambda: self._seq > seen_seq or self._ended or not self._running,
+                                timeout=timeout)
+            if self._seq <= seen_seq and (self._ended or not self._running):
+                return False, None, 0.0, self._seq
+            self._consumed_seq = self._seq
+            return True, self._frame, self._timestamp, self._seq
+
+    @property
+    def ended(self):
+        return self._ended
+
+    def release(self):
+        """取得スレッドを停止してキャプチャを解放する"""
+        self._running = False
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+        if self.cap is not None:
+            self.cap.release()
+
@@ -0,0 +1,441 @@
+# ===================================================================
+# --- カメラの取得設定の選択 (Capture Profile Negotiation) ---
+# cv2.VideoCapture はドライバ任せの解像度・画素形式・バッファ数で開かれ、
+# ドライバ内に数フレーム分の古い画像が溜まって遅れることがある。
+#
+# 候補の取得設定 (解像度・FPS・MJPG/YUYV・バッファ数) を順に試し、
+# 実際に届くフレームレートと、溜まっていた古いフレームの数から遅れを測って、
+# 目標 (例: 640x480@60) を満たす中で最も遅れの小さい設定を選ぶ。
+# 選んだ設定はデバイスごとに JSON ファイルにキャッシュし、次回は計測しない。
+#
+#   python capture_profile.py --camera 0 --target 1280x720@60   # 計測して結果を表示・保存
+#   python capture_profile.py --camera 0 --max-fps 60           # 処理ループが60fpsまでしか回らない場合
+#   python capture_profile.py --fake                            # 疑似ドライバで動作確認
+#
+# 設定の書式は "1280x720@60/MJPG#1" (幅x高さ@FPS/画素形式#バッファ数)。
+# 画素形式とバッファ数は省略でき、省略した項目はドライバの既定値のまま。
+# ===================================================================
+import argparse
+import json
+import os
+import re
+import time
+from collections import namedtuple, deque
+
+import cv2
+import numpy as np
+
+# buffer_size / fourcc が None の項目は設定しない (ドライバの既定値)
+CaptureProfile = namedtuple('CaptureProfile', ['width', 'height', 'fps', 'fourcc', 'buffer_size'])
+
+# 1つの設定の計測結果
+#   actual          ドライバが実際に採用した設定 (要求と違うことがある)
+#   delivered_fps   実際に届いたフレームレート
+#   read_ms         溜まっていたフレームを読むのにかかった時間 (MJPGの展開など)
+#   queued_frames   しばらく読まなかった後にドライバに溜まっていた古いフレームの数
+#   latency_ms      遅れの見積もり = (queued_frames + 0.5) * フレーム間隔 + read_ms
+ProbeResult = namedtuple('ProbeResult', ['profile', 'actual', 'delivered_fps', 'read_ms', 'queued_frames',
+                                         'latency_ms'])
+
+DEFAULT_CACHE = 'capture_profiles.json'
+RESOLUTIONS = [(320, 240), (640, 480), (800, 600), (1280, 720), (1920, 1080)]
+FRAME_RATES = [30, 60, 90, 120]
+FOURCCS = ('MJPG', 'YUYV')
+BUFFER_SIZES = (1, None)
+FPS_TOLERANCE = 0.9 # 目標FPSの何割以上が届けば満たしたとみなすか
+FPS_MATCH = 0.5     # 設定したFPSと読み戻したFPSの差がこれ未満なら同じとみなす (30 と 29.97003 など)
+
+_PROFILE_PATTERN = re.compile(r'^(\d+)x(\d+)@([\d.]+)(?:/(\w{4}))?(?:#(\d+))?$')
+
+
+def parse_profile(text):
+    """"1280x720@60/MJPG#1" 形式の文字列を CaptureProfile にする。書式が違えば ValueError"""
+    match = _PROFILE_PATTERN.match(str(text).strip())
+    if not match:
+        raise ValueError(f"取得設定の書式が不正です: {text} (例: 1280x720@60/MJPG#1)")
+    width, height, fps, fourcc, buffer_size = match.groups()
+    return CaptureProfile(int(width), int(height), float(fps), fourcc and fourcc.upper(),
+                          int(buffer_size) if buffer_size else None)
+
+
+def format_profile(profile):
+    text = f"{profile.width}x{profile.height}@{profile.fps:g}"
+    if profile.fourcc:
+        text += f"/{profile.fourcc}"
+    if profile.buffer_size is not None:
+        text += f"#{profile.buffer_size}"
+    return text
+
+
+def decode_fourcc(value):
+    value = int(value)
+    text = ''.join(chr((value >> (8 * i)) & 0xFF) for i in range(4))
+    return text if text.isalnum() else None
+
+
+def read_back(cap):
+    """キャプチャに実際に設定されている値を CaptureProfile として読み出す"""
+    buffer_size = int(cap.get(cv2.CAP_PROP_BUFFERSIZE))
+    return CaptureProfile(int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                          float(cap.get(cv2.CAP_PROP_FPS)), decode_fourcc(cap.get(cv2.CAP_PROP_FOURCC)),
+                          buffer_size if buffer_size > 0 else None)
+
+
+def same_mode(requested, actual):
+    """読み戻した設定 actual が requested の解像度・FPSと同じか
+
+    ドライバは 30 fps を 29.97003 などと返すので FPS は FPS_MATCH の差まで許す。
+    FPS を返さない (0 の) バックエンドでは FPS は比べない。
+    """
+    if (actual.width, actual.height) != (requested.width, requested.height):
+        return False
+    return not actual.fps or not requested.fps or abs(actual.fps - requested.fps) < FPS_MATCH
+
+
+def apply_profile(cap, profile):
+    """キャプチャに取得設定を適用し、実際に採用された設定を返す
+
+    画素形式は解像度より先に設定する (ドライバによっては後から変えると解像度が戻る)。
+    """
+    if profile.fourcc:
+        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*profile.fourcc))
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, profile.width)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, profile.height)
+    cap.set(cv2.CAP_PROP_FPS, profile.fps)
+    if profile.buffer_size is not None:
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, profile.buffer_size)
+    return read_back(cap)
+
+
+def measure(cap, frames=30, warmup=5, stall=0.25, repeat=3, max_drain=16):
+    """開いているキャプチャのフレームレートと、ドライバ内に溜まるフレーム数を測る
+
+    戻り値は (delivered_fps, read_ms, queued_frames)。読み込みに失敗したら None。
+    stall 秒読まずに待ってから続けて読み、待たずに返ってきた (古い) フレームを数える。
+    古いフレームの読み込みがたまたま遅いと少なく数えるので、repeat 回の最大を取る。
+    """
+    for _ in range(warmup):
+        if not cap.read()[0]:
+            return None
+    start = time.perf_counter()
+    for _ in range(frames):
+        if not cap.read()[0]:
+            return None
+    delivered_fps = frames / (time.perf_counter() - start)
+    period = 1.0 / delivered_fps
+
+    queued = 0
+    read_times = []
+    for _ in range(repeat):
+        time.sleep(stall)
+        count = 0
+        for _ in range(max_drain):
+            start = time.perf_counter()
+            if not cap.read()[0]:
+                return None
+            elapsed = time.perf_counter() - start
+            if elapsed >= period * 0.5: # 次のフレームを待った = 溜まっていた分を読み切った
+                break
+            count += 1
+            read_times.append(elapsed)
+        queued = max(queued, count)
+    read_ms = float(np.median(read_times)) * 1000 if read_times else 0.0
+    return delivered_fps, read_ms, queued
+
+
+def candidate_profiles(target, max_fps=0, resolutions=RESOLUTIONS, rates=FRAME_RATES, fourccs=FOURCCS,
+                       buffer_sizes=BUFFER_SIZES):
+    """目標 (幅, 高さ, FPS) 以上の候補を、遅れが小さそうな順 (高FPS・小さい解像度) に並べる
+
+    max_fps (0で無制限) を超えるFPSは候補にしない。処理ループが追いつけないFPSにしても
+    取得スレッドがCPUを使うだけで遅れは減らないので、ループの処理レートを指定する。
+    """
+    width, height, fps = target
+    sizes = [(w, h) for w, h in resolutions if w >= width and h >= height] or [(width, height)]
+    sizes = sizes[:2] # 目標に近い2つまで (大きすぎる解像度は検出が遅くなるだけ)
+    rates = sorted({r for r in rates if r >= fps and (not max_fps or r <= max_fps)} | {fps}, reverse=True)
+    return [CaptureProfile(w, h, float(r), fourcc, buffer_size)
+            for r in rates for w, h in sizes for fourcc in fourccs for buffer_size in buffer_sizes]
+
+
+def probe_profiles(open_capture, candidates, frames=30, log=print):
+    """候補ごとにキャプチャを開き直して設定・計測する
+
+    open_capture() は新しいキャプチャを返す関数 (cv2.VideoCapture や FakeCamera)。
+    ドライバが同じ設定に丸めた候補は1回だけ計測する。
+    """
+    results = []
+    measured = set()
+    for profile in candidates:
+        cap = open_capture()
+        try:
+            if not cap.isOpened():
+                continue
+            actual = apply_profile(cap, profile)
+            if actual in measured:
+                continue
+            measured.add(actual)
+            stats = measure(cap, frames=frames)
+        finally:
+            cap.release()
+        if stats is None:
+            log(f"   {format_profile(profile)}: 読み込めません")
+            continue
+        delivered_fps, read_ms, queued = stats
+        latency_ms = (queued + 0.5) * 1000.0 / delivered_fps + read_ms
+        result = ProbeResult(profile, actual, delivered_fps, read_ms, queued, latency_ms)
+        results.append(result)
+        log(f"   {format_profile(profile):>22} -> {format_profile(actual):>22}: {delivered_fps:6.1f} fps, "
+            f"溜まり {queued} フレーム, 遅れ {latency_ms:6.1f} ms")
+    return results
+
+
+def parse_target(text):
+    """"640x480@60" を (幅, 高さ, FPS) にする"""
+    profile = parse_profile(text)
+    return profile.width, profile.height, profile.fps
+
+
+def meets_target(result, target):
+    width, height, fps = target
+    return (result.actual.width >= width and result.actual.height >= height
+            and result.delivered_fps >= fps * FPS_TOLERANCE)
+
+
+def choose_profile(results, target):
+    """目標を満たす中で遅れが最小の結果を返す (同程度なら画素数の少ない方)
+
+    目標を満たすものが無ければ、全体で遅れが最小のものを返す。結果が空なら None。
+    """
+    if not results:
+        return None
+    passing = [r for r in results if meets_target(r, target)] or results
+    return min(passing, key=lambda r: (round(r.latency_ms, 1), r.actual.width * r.actual.height))
+
+
+# ===================================================================
+# --- デバイスごとのキャッシュ ---
+# ===================================================================
+
+def device_key(source, cap=None):
+    """キャッシュのキー。カメラ番号に加え、分かればバックエンド名とデバイス名を含める"""
+    parts = [str(source)]
+    if cap is not None and hasattr(cap, 'getBackendName'):
+        try:
+            parts.insert(0, cap.getBackendName())
+        except cv2.error:
+            pass
+    name_path = f"/sys/class/video4linux/video{source}/name" # Linux (V4L2) のみ
+    if os.path.exists(name_path):
+        with open(name_path, encoding='utf-8') as f:
+            parts.append(f.read().strip())
+    return ':'.join(parts)
+
+
+def load_cache(path):
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(path, cache):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, ensure_ascii=False, indent=2)
+
+
+def negotiate(source, target, cache_path=DEFAULT_CACHE, open_capture=None, refresh=False, frames=30,
+              max_fps=0, log=print):
+    """キャッシュにあればそれを、無ければ計測して選んだ取得設定を返す (選べなければ None)"""
+    if open_capture is None:
+        open_capture = lambda: cv2.VideoCapture(int(source))
+    target_text = format_profile(CaptureProfile(*target, None, None))
+    if max_fps:
+        target_text += f" (上限 {max_fps:g} fps)"
+    cap = open_capture()
+    key = device_key(source, cap)
+    cap.release()
+    cache = load_cache(cache_path)
+    entry = cache.get(key)
+    if entry and entry.get('target') == target_text and not refresh:
+        profile = parse_profile(entry['profile'])
+        log(f"📷 取得設定 (キャッシュ): {format_profile(profile)} ({key})")
+        return profile
+    log(f"📷 カメラ {key} の取得設定を計測しています (目標 {target_text})...")
+    results = probe_profiles(open_capture, candidate_profiles(target, max_fps), frames=frames, log=log)
+    best = choose_profile(results, target)
+    if best is None:
+        log("⚠️ 警告: 取得設定を計測できませんでした。ドライバの既定値を使います。")
+        return None
+    if not meets_target(best, target):
+        log(f"⚠️ 警告: 目標 {target_text} を満たす設定がありません。最も遅れの小さい設定を使います。")
+    # 要求した値ではなく、ドライバが実際に採用した値を保存する
+    profile = best.actual._replace(fourcc=best.actual.fourcc or best.profile.fourcc,
+                                   buffer_size=best.profile.buffer_size)
+    if same_mode(best.profile, profile): # 29.97003 などの読み戻しの誤差は保存しない
+        profile = profile._replace(fps=best.profile.fps)
+    cache[key] = {
+        'target': target_text,
+        'profile': format_profile(profile),
+        'delivered_fps': round(best.delivered_fps, 1),
+        'latency_ms': round(best.latency_ms, 1),
+        'probed_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    if cache_path:
+        save_cache(cache_path, cache)
+    log(f"📷 取得設定: {format_profile(profile)} ({best.delivered_fps:.1f} fps, 遅れ {best.latency_ms:.1f} ms)")
+    return profile
+
+
+def resolve_profile(source, spec, target='640x480@30', cache_path=DEFAULT_CACHE, max_fps=0, log=print):
+    """設定値 spec からカメラに適用する取得設定を決める
+
+    ''  ドライバの既定値のまま (None)
+    'auto'  negotiate() で計測・キャッシュ (カメラ番号のときのみ)
+    それ以外  "1280x720@60/MJPG#1" 形式の固定の設定
+    """
+    spec = str(spec or '').strip()
+    if not spec:
+        return None
+    if spec.lower() != 'auto':
+        return parse_profile(spec)
+    if not (isinstance(source, int) or (isinstance(source, str) and source.isdigit())):
+        return None # 動画ファイル・合成映像には適用しない
+    return negotiate(source, parse_target(target), cache_path, max_fps=max_fps, log=log)
+
+
+# ===================================================================
+# --- 疑似ドライバ (Fake Camera Driver) ---
+# 実カメラが無くても選択処理を確かめられるよう、UVCカメラのドライバの
+# ふるまいを真似る: 対応モードへの丸め、画素形式ごとの上限FPS、
+# 読まれないと埋まるバッファ (満杯の間に届いたフレームは捨てる)、MJPGの展開時間。
+# ===================================================================
+
+# (画素形式, 幅, 高さ): 上限FPS (USB 2.0 の帯域では YUYV の高解像度は遅い)
+FAKE_MODES = {
+    ('MJPG', 640, 480): 120, ('MJPG', 1280, 720): 60, ('MJPG', 1920, 1080): 30,
+    ('YUYV', 640, 480): 30, ('YUYV', 1280, 720): 10, ('YUYV', 320, 240): 60,
+}
+
+
+class FakeCamera:
+    """cv2.VideoCapture と同じ read() / get() / set() を持つ疑似カメラ
+
+    フレームは実時間で 1/fps 秒ごとに撮影されたものとして扱い、ドライバのバッファ
+    (buffer_size 個) に入る。バッファが満杯の間に撮影されたフレームは捨てられるので、
+    しばらく読まないと古いフレームが返る。最後に返したフレームの撮影時刻は
+    last_timestamp (CAP_PROP_POS_MSEC) で確認できる。
+    """
+
+    def __init__(self, modes=None, default_buffer=4, honors_buffer_size=True, decode_ms=None,
+                 fourcc='YUYV', width=640, height=480):
+        self.modes = dict(FAKE_MODES if modes is None else modes)
+        self.honors_buffer_size = honors_buffer_size
+        self.decode_ms = {'MJPG': 2.0, 'YUYV': 0.2} if decode_ms is None else decode_ms
+        self.buffer_size = default_buffer
+        self._requested = {'fourcc': fourcc, 'width': width, 'height': height, 'fps': 1000.0}
+        self._opened = True
+        self.last_timestamp = 0.0
+        self._configure()
+
+    def _configure(self):
+        """要求された値を対応モードに丸め、ストリームを開始し直す"""
+        fourcc = self._requested['fourcc']
+        if not any(mode[0] == fourcc for mode in self.modes):
+            fourcc = next(iter(self.modes))[0]
+        sizes = [(w, h) for f, w, h in self.modes if f == fourcc]
+        want_w, want_h = self._requested['width'], self._requested['height']
+        self.fourcc = fourcc
+        self.width, self.height = min(sizes, key=lambda s: (abs(s[0] - want_w) + abs(s[1] - want_h), -s[0]))
+        self.fps = float(min(self._requested['fps'], self.modes[(fourcc, self.width, self.height)]))
+        self._start = time.monotonic()
+        self._next_index = 0
+        self._queue = deque()
+        self._frame = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+
+    def _capture_until(self, now):
+        """now までに撮影されたフレームをバッファに入れる (満杯なら捨てる)"""
+        period = 1.0 / self.fps
+        while self._start + self._next_index * period <= now:
+            if len(self._queue) < self.buffer_size:
+                self._queue.append(self._start + self._next_index * period)
+            self._next_index += 1
+
+    def read(self):
+        if not self._opened:
+            return False, None
+        now = time.monotonic()
+        self._capture_until(now)
+        if not self._queue: # 次のフレームの撮影まで待つ
+            due = self._start + self._next_index / self.fps
+            time.sleep(max(0.0, due - now))
+            self._capture_until(max(due, time.monotonic()))
+        self.last_timestamp = self._queue.popleft()
+        time.sleep(self.decode_ms.get(self.fourcc, 0.0) / 1000.0)
+        return True, self._frame
+
+    def get(self, prop):
+        values = {
+            cv2.CAP_PROP_FRAME_WIDTH: float(self.width),
+            cv2.CAP_PROP_FRAME_HEIGHT: float(self.height),
+            cv2.CAP_PROP_FPS: self.fps,
+            cv2.CAP_PROP_FOURCC: float(cv2.VideoWriter_fourcc(*self.fourcc)),
+            cv2.CAP_PROP_BUFFERSIZE: float(self.buffer_size),
+            cv2.CAP_PROP_POS_MSEC: self.last_timestamp * 1000.0,
+        }
+        return values.get(prop, 0.0)
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_FOURCC:
+            self._requested['fourcc'] = decode_fourcc(value)
+        elif prop == cv2.CAP_PROP_FRAME_WIDTH:
+            self._requested['width'] = int(value)
+        elif prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            self._requested['height'] = int(value)
+        elif prop == cv2.CAP_PROP_FPS:
+            self._requested['fps'] = float(value)
+        elif prop == cv2.CAP_PROP_BUFFERSIZE:
+            if not self.honors_buffer_size:
+                return False
+            self.buffer_size = max(1, int(value))
+        else:
+            return False
+        self._configure()
+        return True
+
+    def getBackendName(self):
+        return 'FAKE'
+
+    def isOpened(self):
+        return self._opened
+
+    def release(self):
+        self._opened = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="カメラの取得設定を計測して選ぶ")
+    parser.add_argument('--camera', default='0', help="カメラ番号")
+    parser.add_argument('--target', default='640x480@60', help="目標 (幅x高さ@FPS)")
+    parser.add_argument('--max-fps', type=float, default=0, help="候補にするFPSの上限 (0で無制限)")
+    parser.add_argument('--cache', default=DEFAULT_CACHE, help="結果を保存するファイル")
+    parser.add_argument('--refresh', action='store_true', help="キャッシュがあっても計測し直す")
+    parser.add_argument('--frames', type=int, default=30, help="1つの設定で読むフレーム数")
+    parser.add_argument('--fake', action='store_true', help="疑似ドライバで試す (キャッシュは保存しない)")
+    args = parser.parse_args()
+    target = parse_target(args.target)
+    if args.fake:
+        profile = negotiate('fake', target, cache_path=None, open_capture=FakeCamera, frames=args.frames,
+                            max_fps=args.max_fps)
+        if profile is not None:
+            cap = FakeCamera()
+            print(f"疑似ドライバに適用した結果: {format_profile(apply_profile(cap, profile))}")
+        return
+    negotiate(args.camera, target, args.cache, refresh=args.refresh, frames=args.frames, max_fps=args.max_fps)
+
+
+if __name__ == '__main__':
+    main()
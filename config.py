@@ -0,0 +1,110 @@
+# ===================================================================
+# --- 設定ファイル (Configuration) ---
+# ヘッドレス実行用の設定をJSONファイルから読み書きする。
+# 項目名はGUI版 (app.py / app2.py) の設定項目に対応している。
+# ===================================================================
+import json
+import os
+
+from engine import EngineParams
+
+# --- 既定値 ---
+DEFAULT_CONFIG = {
+    # シリアル通信
+    'serial_port': 'auto',      # 'auto'にするとPicoを自動検索 / 'none'でIMUを使わない
+    'baud_rate': 115200,
+    'imu_format': 'auto',       # IMUの受信形式 'auto' / 'csv' / 'binary' (imu_reader.py)
+    # Webサーバー
+    'flask_port': 5000,
+    'udp_port': 5001,           # UDPでコマンドを受け付けるポート (0で無効)
+    # カメラ
+    'camera_source': 0,         # カメラ番号・動画ファイルのパス・'synthetic'
+    'capture_profile': '',      # カメラの取得設定。'' (ドライバ既定) / 'auto' (計測して選ぶ) / '640x480@60/MJPG#1'
+    'capture_target': '640x480@30', # 'auto' のときに満たすべき解像度とFPS
+    'capture_max_fps': 0,       # 'auto' で候補にするFPSの上限 (処理ループが追いつけるレート。0で無制限)
+    'capture_cache': 'capture_profiles.json', # 'auto' で選んだ設定の保存先 (カメラごと)
+    'margin': 0.1,              # カメラ映像の端を除外する割合
+    'roi_tracking': True,       # 前回位置の周囲だけを探索する
+    'subpixel_detection': False, # サブピクセル検出 (roi_trackingより優先)
+    'blob_tracking': False,     # 輝点をすべて検出してIDで追跡する (blob_tracker.py。上の2つより優先)
+    'glare_mask': '',           # 映り込みのマスク (PNG) のパス (glare_mask.py。--calibrate-glare で作る)
+    'glare_update_interval': 30, # 動作中にマスクを学習し直すフレーム間隔 (0で学習しない)
+    'mirror': True,             # 映像を左右反転して扱う
+    'detect_process': False,    # 輝点検出を別プロセスで行う (detector_process.py)
+    # カーソル出力
+    'cursor_backend': 'auto',   # 'auto' / 'xtest' / 'pyautogui' / 'record' (cursor.py)
+    'cursor_rate': 0.0,         # カーソルの更新レート (Hz)。0ならカメラのフレームごとに動かす
+    'cursor_mode': 'interpolate', # フレーム間の 'interpolate' (補間) / 'extrapolate' (外挿)
+    'cursor_max_overshoot': 16.0, # 外挿で最新位置を越えてよい距離 (px)
+    'cursor_display': '',       # XTestで使うXディスプレイ (例: ':1')。空なら環境変数 DISPLAY
+    # 複数のポインタを同時に動かす場合のトラッカーごとの設定 (空なら1台のみ)
+    # 例: [{"name": "p1", "camera_source": 0, "serial_port": "/dev/ttyACM0"},
+    #      {"name": "p2", "camera_source": 1, "serial_port": "/dev/ttyACM1", "cursor_display": ":1"}]
+    # 書かなかった項目は上の値を引き継ぐ。
+    'trackers': [],
+}
+# トラッキングパラメータ (engine.EngineParams の項目)
+DEFAULT_CONFIG.update(EngineParams().as_dict())
+DEFAULT_CONFIG['use_imu'] = True
+
+
+def load_config(path=None):
+    """既定値に設定ファイルの内容を上書きした辞書を返す
+
+    path が None またはファイルが存在しない場合は既定値のみを返す。
+    未知の項目があれば ValueError。
+    """
+    config = dict(DEFAULT_CONFIG)
+    if path and os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            values = json.load(f)
+        unknown = set(values) - set(DEFAULT_CONFIG)
+        for tracker in values.get('trackers', []):
+            unknown |= set(tracker) - set(DEFAULT_CONFIG) - {'name'}
+        if unknown:
+            raise ValueError(f"不明な設定項目: {', '.join(sorted(unknown))}")
+        config.update(values)
+    return config
+
+
+def tracker_configs(config):
+    """トラッカーごとの (名前, 設定) のリストを返す
+
+    'trackers' が空なら ('default', config) の1つだけ。各トラッカーの設定は
+    共通の設定に 'trackers' の項目を上書きしたもの。名前が無ければ p1, p2, ...
+    """
+    if not config['trackers']:
+        return [('default', config)]
+    result = []
+    for index, overrides in enumerate(config['trackers']):
+        values = dict(config, trackers=[])
+        values.update({k: v for k, v in overrides.items() if k != 'name'})
+        name = str(overrides.get('name') or f"p{index + 1}")
+        if name in dict(result):
+            raise ValueError(f"トラッカー名が重複しています: {name}")
+        result.append((name, values))
+    return result
+
+
+def save_config(config, path):
+    """設定を JSON ファイルに保存する"""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+
+
+def coerce_value(current, value):
+    """value (文字列やJSONの値) を現在の値 current と同じ型に変換する"""
+    if isinstance(current, bool):
+        if isinstance(value, str):
+            return value.strip().lower() in ('1', 'true', 'on', 'yes')
+        return bool(value)
+    if isinstance(current, int):
+        return int(float(value))
+    if isinstance(current, float):
+        return float(value)
+    return value
+
+
+def engine_params(config):
+    """設定からトラッキングパラメータを作る"""
+    return EngineParams(**{name: config[name] for name in EngineParams.__slots__})
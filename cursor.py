@@ -0,0 +1,284 @@
+# ===================================================================
+# --- カーソル出力 (Cursor Sink) ---
+# トラッキング結果をマウスカーソルに反映する部分を差し替え可能にしたもの。
+#
+#   XTestSink       Linux (X11) で XTest 拡張を直接呼ぶ (python-xlib が必要)
+#   PyAutoGUISink   pyautogui.moveTo (呼び出しごとの PAUSE 待ちは無効にする)
+#   RecordingSink   実際には動かさず、移動先をメモリに記録する (テスト・ドライラン用)
+#
+# どのシンクも整数ピクセル位置が前回と同じ移動は送らない。
+#
+#   CursorScheduler はカメラのフレームレートとは独立した一定レート (例: 144Hz) で
+#   シンクを呼び出し、フレーム間のカーソル位置を補間・外挿して滑らかに動かす。
+# ===================================================================
+import os
+import sys
+import time
+from threading import Thread, Event
+
+from metrics import METRICS, now
+
+CURSOR_BACKENDS = ('auto', 'xtest', 'pyautogui', 'record')
+CURSOR_MODES = ('interpolate', 'extrapolate')
+
+_MOVE_TIME = METRICS.histogram('cursor_move', "マウスカーソル移動の時間 (位置が変わらず省略した分は含まない)")
+
+
+class CursorSink:
+    """カーソル出力の基底クラス
+
+    move(x, y) に浮動小数点の画面座標を渡す。整数に丸めた位置が前回と
+    同じなら何もしない。派生クラスは _move_to(ix, iy) と size() を実装する。
+    """
+
+    name = 'base'
+
+    def __init__(self):
+        self._last = None
+        self.moves = 0    # 実際に送った移動の回数
+        self.skipped = 0  # 位置が変わらず省略した回数
+
+    def move(self, x, y):
+        ix, iy = int(round(x)), int(round(y))
+        if (ix, iy) == self._last:
+            self.skipped += 1
+            return False
+        self._last = (ix, iy)
+        start = now()
+        self._move_to(ix, iy)
+        _MOVE_TIME.since(start)
+        self.moves += 1
+        return True
+
+    def reset(self):
+        """前回の位置を忘れ、次の move() を必ず送る (一時停止中にカーソルが手で動かされた場合など)"""
+        self._last = None
+
+    def _move_to(self, ix, iy):
+        raise NotImplementedError
+
+    def size(self):
+        """画面サイズ (幅, 高さ)"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class XTestSink(CursorSink):
+    """X11 の XTest 拡張でカーソルを動かす (Xvfb 上でも動作する)"""
+
+    name = 'xtest'
+
+    def __init__(self, display_name=None):
+        super().__init__()
+        from Xlib import X, display # python-xlib は Linux でのみ必要
+        from Xlib.ext import xtest
+        self._display = display.Display(display_name)
+        if not self._display.has_extension('XTEST'):
+            self._display.close()
+            raise RuntimeError("XサーバーがXTest拡張に対応していません")
+        self._motion = X.MotionNotify
+        self._fake_input = xtest.fake_input
+        self._screen = self._display.screen()
+
+    def _move_to(self, ix, iy):
+        self._fake_input(self._display, self._motion, x=ix, y=iy)
+        self._display.flush()
+
+    def position(self):
+        """現在のカーソル位置 (テストでの確認用)"""
+        pointer = self._screen.root.query_pointer()
+        return pointer.root_x, pointer.root_y
+
+    def size(self):
+        return self._screen.width_in_pixels, self._screen.height_in_pixels
+
+    def close(self):
+        self._display.close()
+
+
+class PyAutoGUISink(CursorSink):
+    """pyautogui でカーソルを動かす (Windows / macOS 向けの代替手段)"""
+
+    name = 'pyautogui'
+
+    def __init__(self):
+        super().__init__()
+        import pyautogui
+        pyautogui.FAILSAFE = False
+        pyautogui.PAUSE = 0 # 既定では呼び出しごとに 0.1 秒待つ
+        self._pyautogui = pyautogui
+
+    def _move_to(self, ix, iy):
+        self._pyautogui.moveTo(ix, iy, _pause=False)
+
+    def position(self):
+        return tuple(self._pyautogui.position())
+
+    def size(self):
+        return tuple(self._pyautogui.size())
+
+
+class RecordingSink(CursorSink):
+    """カーソルを動かさず、送られた移動先を記録する"""
+
+    name = 'record'
+
+    def __init__(self, screen_size=(1920, 1080), keep=True):
+        super().__init__()
+        self.screen_size = tuple(screen_size)
+        self.keep = keep # False なら位置だけを保持し、履歴は残さない
+        self.history = []
+
+    def _move_to(self, ix, iy):
+        if self.keep:
+            self.history.append((ix, iy))
+
+    def position(self):
+        return self._last
+
+    def size(self):
+        return self.screen_size
+
+
+def open_cursor_sink(backend='auto', screen_size=(1920, 1080), display=None):
+    """名前を指定してカーソル出力を作る
+
+    'auto' は X11 (DISPLAY が設定された Linux) で python-xlib があれば XTest、
+    それ以外は pyautogui を使う。'record' は screen_size の仮想画面で位置を保持するだけ
+    (長時間動かしても履歴は溜めない)。display (例: ':1') を指定すると XTest で
+    そのXディスプレイのカーソルを動かす (ポインタごとに別の画面を使う場合)。
+    """
+    backend = str(backend).lower()
+    if backend not in CURSOR_BACKENDS:
+        raise ValueError(f"不明なカーソル出力: {backend} ({' / '.join(CURSOR_BACKENDS)})")
+    if backend == 'record':
+        return RecordingSink(screen_size, keep=False)
+    if backend == 'xtest':
+        return XTestSink(display or None)
+    if backend == 'auto' and sys.platform.startswith('linux') and (display or os.environ.get('DISPLAY')):
+        try:
+            return XTestSink(display or None)
+        except Exception as e: # python-xlib が無い・Xサーバーに接続できない など
+            print(f"⚠️ XTestが使えないため pyautogui を使います: {e}")
+    return PyAutoGUISink()
+
+
+class CursorScheduler:
+    """一定レートでカーソルを動かす出力スレッド
+
+    move(x, y) でトラッキング結果を渡すと、出力スレッドが rate Hz で
+    直近2つの結果の間を補間 (または外挿) した位置をシンクに送る。
+
+    mode='interpolate' は1フレーム分遅れて前回位置→今回位置を直線でたどる
+        (行き過ぎは起きない)。
+    mode='extrapolate' は直近の速度で今回位置の先を予測する。予測は最大1フレーム分、
+        今回位置からの距離 max_overshoot [px] までに制限する。
+    次の結果が届かないまま1フレーム分の時間が過ぎると、カーソルはそこで止まる。
+    """
+
+    def __init__(self, sink, rate=144.0, mode='interpolate', max_overshoot=16.0, max_interval=0.2):
+        if mode not in CURSOR_MODES:
+            raise ValueError(f"不明な補間方式: {mode} ({' / '.join(CURSOR_MODES)})")
+        self.sink = sink
+        self.rate = float(rate)
+        self.mode = mode
+        self.max_overshoot = float(max_overshoot)
+        self.max_interval = max_interval # これより間隔が空いた結果同士は補間しない
+        width, height = sink.size()
+        self._x_limit, self._y_limit = width - 1, height - 1
+        # (前回x, 前回y, 今回x, 今回y, 今回の時刻, 間隔) をまとめて差し替える
+        self._segment = None
+        self._stop = Event()
+        self._thread = None
+        self.ticks = 0
+
+    def start(self):
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def size(self):
+        return self.sink.size()
+
+    def move(self, x, y, timestamp=None):
+        """トラッキング結果を渡す (すぐに戻る)"""
+        if timestamp is None:
+            timestamp = time.monotonic()
+        segment = self._segment
+        if segment is None:
+            self._segment = (x, y, x, y, timestamp, 0.0)
+            return
+        interval = timestamp - segment[4]
+        if interval <= 0.0 or interval > self.max_interval:
+            self._segment = (x, y, x, y, timestamp, 0.0)
+            return
+        if self.mode == 'interpolate':
+            # 補間はいま表示中の位置から始めて、前回の区間の残りを飛ばさない
+            x0, y0 = self.position_at(timestamp)
+        else:
+            x0, y0 = segment[2], segment[3]
+        self._segment = (x0, y0, x, y, timestamp, interval)
+
+    def reset(self):
+        """保持している区間を捨て、次の move() の位置から出力し直す (制御の再開時に呼ぶ)"""
+        self._segment = None
+        self.sink.reset()
+
+    def position_at(self, t, segment=None):
+        """時刻 t に出力すべき位置"""
+        x0, y0, x1, y1, t1, interval = self._segment if segment is None else segment
+        if interval <= 0.0:
+            return x1, y1
+        elapsed = t - t1
+        if self.mode == 'interpolate':
+            ratio = elapsed / interval
+            ratio = 0.0 if ratio < 0.0 else (1.0 if ratio > 1.0 else ratio)
+            x, y = x0 + (x1 - x0) * ratio, y0 + (y1 - y0) * ratio
+        else:
+            lead = 0.0 if elapsed < 0.0 else (interval if elapsed > interval else elapsed)
+            dx = (x1 - x0) * lead / interval
+            dy = (y1 - y0) * lead / interval
+            distance = (dx * dx + dy * dy) ** 0.5
+            if distance > self.max_overshoot:
+                dx *= self.max_overshoot / distance
+                dy *= self.max_overshoot / distance
+            x, y = x1 + dx, y1 + dy
+        x = 0.0 if x < 0.0 else (self._x_limit if x > self._x_limit else x)
+        y = 0.0 if y < 0.0 else (self._y_limit if y > self._y_limit else y)
+        return x, y
+
+    def _run(self):
+        period = 1.0 / self.rate
+        next_tick = time.monotonic()
+        while not self._stop.is_set():
+            segment = self._segment # reset() と競合しないよう一度だけ読む
+            if segment is not None:
+                x, y = self.position_at(time.monotonic(), segment)
+                self.sink.move(x, y)
+                self.ticks += 1
+            next_tick += period
+            delay = next_tick - time.monotonic()
+            if delay < 0.0: # 遅れたら追いつこうとせず、次の周期から数え直す
+                next_tick = time.monotonic()
+                delay = 0.0
+            self._stop.wait(delay)
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+        self.sink.close()
+
+
+def open_cursor_output(backend='auto', rate=0, mode='interpolate', max_overshoot=16.0,
+                       screen_size=(1920, 1080), display=None):
+    """カーソル出力を作る。rate > 0 なら CursorScheduler を起動して返す
+
+    どちらも move(x, y) / reset() / size() / close() を持つので、呼び出し側は区別しなくてよい。
+    """
+    sink = open_cursor_sink(backend, screen_size, display)
+    if not rate or rate <= 0:
+        return sink
+    return CursorScheduler(sink, rate=rate, mode=mode, max_overshoot=max_overshoot).start()
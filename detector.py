@@ -0,0 +1,217 @@
+# ===================================================================
+# --- 輝点検出 (Bright Spot Detection) ---
+# カメラ画像から追跡対象 (LED) の最も明るい点を探す。
+# 検出器はグレースケール化の出力先を使い回し、毎フレーム画像を確保しない。
+# glare (glare_mask.GlareMask) を渡すと、学習した映り込みの領域を探索しない。
+# ===================================================================
+import cv2
+import numpy as np
+
+from metrics import METRICS
+
+_ROI_HITS = METRICS.counter('roi_hits', "探索窓の中で輝点が見つかった回数")
+_ROI_MISSES = METRICS.counter('roi_misses', "探索窓の中で輝点を見失った回数")
+_FULL_SCANS = METRICS.counter('full_scans', "画像全体を探索した回数 (初回・見失ったとき・ROI探索が無効のとき)")
+
+
+def count_scans(hits, misses, full_scans):
+    """探索回数を METRICS に加える (別プロセスで検出した分を親プロセスで数えるときに使う)"""
+    _ROI_HITS.inc(hits)
+    _ROI_MISSES.inc(misses)
+    _FULL_SCANS.inc(full_scans)
+
+
+def find_bright_spot(frame, gray=None, mask=None):
+    """画像全体から最も明るい点を探し (maxVal, maxLoc) を返す
+
+    gray (frame と同じ高さ・幅の uint8 配列) を渡すと、カラー画像のグレースケール化の
+    結果をそこに書き込む (新しい配列を確保しない)。mask を渡すと 0 の画素は探索しない。
+    """
+    if frame.ndim == 3:
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray)
+    else:
+        gray = frame
+    (_, max_val, _, max_loc) = cv2.minMaxLoc(gray, mask)
+    return max_val, max_loc
+
+
+def reuse_buffer(buffer, shape, dtype=np.uint8):
+    """buffer が shape の配列ならそのまま、違えば (解像度が変わったら) 作り直して返す"""
+    if buffer is None or buffer.shape != shape:
+        buffer = np.empty(shape, dtype)
+    return buffer
+
+
+class ROISpotDetector:
+    """前回の検出位置の周囲だけを探索する輝点検出器
+
+    探索窓の大きさは直近の移動速度に応じて広がる。
+    窓内で maxVal が閾値を下回った場合 (見失った場合) は画像全体を探索する。
+    hits / misses で窓探索の成功・失敗回数を確認できる (METRICS の roi_hits / roi_misses / full_scans にも数える)。
+    """
+
+    def __init__(self, min_half_size=24, max_half_size=None, velocity_gain=3.0, smoothing=0.5, enabled=True,
+                 glare=None):
+        self.min_half_size = min_half_size   # 窓の半径の最小値 (ピクセル)
+        self.max_half_size = max_half_size   # 窓の半径の最大値 (None なら制限なし)
+        self.velocity_gain = velocity_gain   # 速度1ピクセル/フレームあたりの窓の広がり
+        self.smoothing = smoothing           # 速度推定の平滑化係数
+        self.enabled = enabled
+        self.glare = glare                   # 映り込みのマスク (glare_mask.GlareMask)
+        self.last_loc = None
+        self.velocity = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.full_scans = 0
+        self._gray = None # グレースケール化の出力先 (窓探索では同じ位置の部分に書き込む)
+
+    @property
+    def hit_ratio(self):
+        """窓探索で見つかった割合"""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def reset(self):
+        self.last_loc = None
+        self.velocity = 0.0
+
+    def window(self, width, height):
+        """現在の探索窓 (x0, y0, x1, y1) を返す"""
+        half = self.min_half_size + self.velocity_gain * self.velocity
+        if self.max_half_size is not None:
+            half = min(half, self.max_half_size)
+        half = int(half)
+        x, y = self.last_loc
+        return max(0, x - half), max(0, y - half), min(width, x + half + 1), min(height, y + half + 1)
+
+    def detect(self, frame, threshold):
+        """輝点を検出し (maxVal, maxLoc) を返す。maxLoc は画像全体での座標"""
+        max_val, max_loc = self._detect(frame, threshold)
+        if self.glare is not None:
+            self.glare.observe(frame, threshold, max_loc if max_val >= threshold else None)
+        return max_val, max_loc
+
+    def _detect(self, frame, threshold):
+        glare = self.glare
+        if glare is not None and glare.empty:
+            glare = None
+        gray = None
+        if frame.ndim == 3:
+            gray = self._gray = reuse_buffer(self._gray, frame.shape[:2])
+        if self.enabled and self.last_loc is not None:
+            height, width = frame.shape[:2]
+            x0, y0, x1, y1 = self.window(width, height)
+            window_gray = None if gray is None else gray[y0:y1, x0:x1]
+            window_valid = None if glare is None else glare.window_valid(x0, y0, x1, y1)
+            max_val, (lx, ly) = find_bright_spot(frame[y0:y1, x0:x1], window_gray, window_valid)
+            if max_val >= threshold:
+                self.hits += 1
+                _ROI_HITS.inc()
+                self._update((lx + x0, ly + y0))
+                return max_val, self.last_loc
+            self.misses += 1
+            _ROI_MISSES.inc()
+
+        # --- 窓内に見つからない・初回は全体を探索 ---
+        self.full_scans += 1
+        _FULL_SCANS.inc()
+        if glare is None:
+            max_val, max_loc = find_bright_spot(frame, gray)
+        else:
+            max_val, max_loc = glare.find_bright_spot(frame, gray)
+        if max_val >= threshold:
+            self._update(max_loc)
+        else:
+            self.reset()
+        return max_val, max_loc
+
+    def _update(self, loc):
+        if self.last_loc is not None:
+            dx = loc[0] - self.last_loc[0]
+            dy = loc[1] - self.last_loc[1]
+            speed = (dx * dx + dy * dy) ** 0.5
+            self.velocity = (1 - self.smoothing) * self.velocity + self.smoothing * speed
+        self.last_loc = loc
+
+
+def refine_centroid(gray, loc, radius):
+    """loc の周囲 radius ピクセルの輝度重心を求め、サブピクセル座標 (x, y) を返す
+
+    ピーク値の半分以上の画素だけを重みとして使うので、背景の影響を受けにくい。
+    """
+    height, width = gray.shape[:2]
+    x, y = int(loc[0]), int(loc[1])
+    x0, y0 = max(0, x - radius), max(0, y - radius)
+    x1, y1 = min(width, x + radius + 1), min(height, y + radius + 1)
+    patch = gray[y0:y1, x0:x1].astype('float32')
+    half = float(patch.max()) * 0.5
+    _, weights = cv2.threshold(patch, half, 0, cv2.THRESH_TOZERO)
+    m = cv2.moments(weights)
+    if m['m00'] <= 0:
+        return float(x), float(y)
+    return x0 + m['m10'] / m['m00'], y0 + m['m01'] / m['m00']
+
+
+class PyramidSpotDetector:
+    """縮小画像で候補を探し、元解像度の小領域でサブピクセル位置を求める輝点検出器
+
+    scale 分の1に縮小した画像で最も明るい点を探し、その周囲の元解像度パッチで
+    ピーク値 (閾値判定用) と輝度重心を計算する。maxLoc は float の (x, y) になる。
+    縮小は間引き (最近傍) で行うため、LEDの写り込みの直径が scale ピクセル以上必要。
+    """
+
+    def __init__(self, scale=4, centroid_radius=6, glare=None):
+        self.scale = scale                       # 縮小率 (1/scale に縮小する)
+        self.centroid_radius = centroid_radius   # 重心計算に使う半径 (元解像度のピクセル)
+        self.glare = glare                       # 映り込みのマスク (glare_mask.GlareMask)
+        self._small = None      # 縮小画像の出力先
+        self._small_gray = None # 縮小画像のグレースケール化の出力先
+        self._small_valid = None       # glare.valid を縮小したもの (一部でもマスクされた画素は 0)
+        self._small_valid_source = None
+
+    def detect(self, frame, threshold):
+        """輝点を検出し (maxVal, (x, y)) を返す。座標はサブピクセル精度"""
+        max_val, max_loc = self._detect(frame, threshold)
+        if self.glare is not None:
+            self.glare.observe(frame, threshold, max_loc if max_val >= threshold else None)
+        return max_val, max_loc
+
+    def _small_mask(self, size):
+        """縮小画像用のマスク (glare が作り直されたときだけ作り直す)"""
+        glare = self.glare
+        if glare is None or glare.empty:
+            return None
+        if self._small_valid_source is not glare.valid:
+            small = cv2.resize(glare.valid, size, interpolation=cv2.INTER_AREA)
+            self._small_valid = cv2.threshold(small, 254, 255, cv2.THRESH_BINARY)[1]
+            self._small_valid_source = glare.valid
+        return self._small_valid
+
+    def _detect(self, frame, threshold):
+        s = self.scale
+        height, width = frame.shape[:2]
+        small_w, small_h = max(1, width // s), max(1, height // s)
+        self._small = reuse_buffer(self._small, (small_h, small_w) + frame.shape[2:])
+        small = cv2.resize(frame, (small_w, small_h), dst=self._small, interpolation=cv2.INTER_NEAREST)
+        if small.ndim == 3:
+            self._small_gray = reuse_buffer(self._small_gray, (small_h, small_w))
+        _, (sx, sy) = find_bright_spot(small, self._small_gray, self._small_mask((small_w, small_h)))
+
+        # --- 元解像度で候補の周囲を探索 (間引きによる位置のずれを吸収する) ---
+        reach = s + self.centroid_radius
+        cx, cy = sx * s, sy * s
+        x0, y0 = max(0, cx - reach), max(0, cy - reach)
+        x1, y1 = min(width, cx + reach + 1), min(height, cy + reach + 1)
+        patch = frame[y0:y1, x0:x1]
+        gray = cv2.cvtColor(patch, cv2.COLOR_BGR2GRAY) if patch.ndim == 3 else patch
+        valid = None
+        if self.glare is not None and not self.glare.empty:
+            valid = self.glare.window_valid(x0, y0, x1, y1)
+        if valid is not None: # 重心にもマスクした映り込みの画素を含めない (frame は書き換えない)
+            gray = cv2.bitwise_and(gray, valid)
+        (_, max_val, _, peak) = cv2.minMaxLoc(gray)
+        if max_val < threshold:
+            return max_val, (float(x0 + peak[0]), float(y0 + peak[1]))
+        # 飽和したLEDでは minMaxLoc のピークが左上に偏るため、パッチ全体で重心を取る
+        fx, fy = refine_centroid(gray, (cx - x0, cy - y0), reach)
+        return max_val, (x0 + fx, y0 + fy)
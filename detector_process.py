@@ -0,0 +1,232 @@
+# ===================================================================
+# --- 別プロセスでの輝点検出 (Process Spot Detector) ---
+# 輝点検出を子プロセスで行い、GUI・Webサーバー・キーボードフックと同じ
+# インタプリタ (GIL) の取り合いからトラッキングの処理を切り離す。
+#
+# フレームは共有メモリ (multiprocessing.shared_memory) のリングバッファの
+# スロットに書き込み、パイプで送るのはスロット番号と形状だけ (pickle しない)。
+# 子プロセスからは (maxVal, maxLoc, 撮影時刻, 検出時間, 探索回数の増分) だけが返る。
+#
+#   detector = ProcessSpotDetector('roi')   # 'roi' / 'full' / 'pyramid'
+#   engine = TrackingEngine(..., detector=detector)
+#   ...
+#   detector.close()
+# ===================================================================
+import multiprocessing
+import signal
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from blob_tracker import BlobTracker
+from detector import ROISpotDetector, PyramidSpotDetector, count_scans
+from metrics import METRICS, now
+
+DETECTOR_KINDS = ('roi', 'full', 'pyramid', 'blob')
+RING_SLOTS = 3        # 共有メモリのスロット数 (同時に処理待ちにできるフレーム数)
+RESULT_TIMEOUT = 1.0  # これ以上結果が返らなければ子プロセスを諦める (秒)
+STARTUP_TIMEOUT = 30.0 # 子プロセスの起動 (cv2 などの読み込み) を待つ時間 (秒)
+
+_WORKER_TIME = METRICS.histogram('detect_worker', "検出プロセス内での検出時間 (detect との差がプロセス間の受け渡しのコスト)")
+
+
+def detector_kind(subpixel_detection, roi_tracking, blob_tracking=False):
+    """設定 (複数輝点の追跡 / サブピクセル検出 / ROI探索) に対応する検出方式の名前"""
+    if blob_tracking:
+        return 'blob'
+    if subpixel_detection:
+        return 'pyramid'
+    return 'roi' if roi_tracking else 'full'
+
+
+def make_detector(kind, glare=None):
+    """名前から (同じプロセスで動く) 輝点検出器を作る
+
+    glare (glare_mask.GlareMask) を渡すと、学習した映り込みの領域を探索しない。
+    """
+    if kind not in DETECTOR_KINDS:
+        raise ValueError(f"不明な検出方式: {kind} ({' / '.join(DETECTOR_KINDS)})")
+    if kind == 'blob':
+        return BlobTracker(glare=glare)
+    if kind == 'pyramid':
+        return PyramidSpotDetector(glare=glare)
+    return ROISpotDetector(enabled=(kind == 'roi'), glare=glare)
+
+
+def _scan_counts(detector):
+    """検出器の (窓探索の成功, 失敗, 全体探索) の回数"""
+    return tuple(getattr(detector, name, 0) for name in ('hits', 'misses', 'full_scans'))
+
+
+def _worker(conn, kind, glare):
+    """検出プロセスの本体。パイプで届いた指示を順に処理する"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C の後片付けは親プロセスが行う
+    detector = make_detector(kind, glare)
+    shm = None
+    slot_size = 0
+    try:
+        conn.send('ready')
+        while True:
+            message = conn.recv()
+            if message[0] == 'detect':
+                _, slot, shape, dtype, threshold, timestamp = message
+                frame = np.ndarray(shape, dtype, buffer=shm.buf, offset=slot * slot_size)
+                before = _scan_counts(detector)
+                start = now()
+                max_val, max_loc = detector.detect(frame, threshold)
+                elapsed = now() - start
+                del frame # 共有メモリを閉じられるよう参照を残さない
+                scans = tuple(after - prev for after, prev in zip(_scan_counts(detector), before))
+                conn.send((max_val, max_loc, timestamp, elapsed, scans))
+            elif message[0] == 'buffer':
+                if shm is not None:
+                    shm.close()
+                _, name, slot_size = message
+                shm = shared_memory.SharedMemory(name=name) # 削除は親プロセスが行う
+            elif message[0] == 'stop':
+                glare = getattr(detector, 'glare', None)
+                conn.send({'glare': glare.core if glare is not None and glare.changed else None}) # 動作中に学習したマスク
+                break
+    except (EOFError, OSError): # 親プロセスが終了した
+        pass
+    finally:
+        if shm is not None:
+            shm.close()
+
+
+class ProcessSpotDetector:
+    """子プロセスで輝点検出を行う検出器 (ROISpotDetector などと同じ detect() を持つ)
+
+    submit() でフレームを共有メモリに書いて送り、result() で結果を受け取る。
+    スロットは RING_SLOTS 個あるので、前のフレームの結果を待たずに次を送ってもよい。
+    detect() はその両方を続けて行う。子プロセスが応答しなくなった場合は
+    警告を出して同じプロセスでの検出に切り替える。
+    """
+
+    def __init__(self, kind='roi', slots=RING_SLOTS, timeout=RESULT_TIMEOUT, glare=None):
+        make_detector(kind) # 名前の確認
+        self.kind = kind
+        self.glare = glare # 子プロセスにはコピーが渡る (子プロセスでの学習は close() で親に戻す)
+        self.slots = slots
+        self.timeout = timeout
+        # GUIやスレッドを持つプロセスを fork しないよう spawn で起動する
+        context = multiprocessing.get_context('spawn')
+        self._conn, child_conn = context.Pipe()
+        self._process = context.Process(target=_worker, args=(child_conn, kind, glare), name='spot-detector', daemon=True)
+        self._process.start()
+        child_conn.close()
+        self._shm = None
+        self._slot_size = 0
+        self._next_slot = 0
+        self._in_flight = 0
+        self._ready = False
+        self._fallback = None # 子プロセスを使えなくなったときの検出器
+        self.hits = 0
+        self.misses = 0
+        self.full_scans = 0
+        self.last_timestamp = None # 直近の結果のフレームの撮影時刻
+
+    @property
+    def hit_ratio(self):
+        """窓探索で見つかった割合"""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _ensure_buffer(self, nbytes):
+        """1スロットに nbytes が入る共有メモリを用意する (解像度が変わったら作り直す)"""
+        if self._shm is not None and nbytes <= self._slot_size:
+            return
+        self._release_buffer()
+        self._shm = shared_memory.SharedMemory(create=True, size=nbytes * self.slots)
+        self._slot_size = nbytes
+        self._conn.send(('buffer', self._shm.name, nbytes))
+
+    def _release_buffer(self):
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def _wait_ready(self):
+        """子プロセスの起動完了の通知を受け取る (初回のみ)"""
+        if self._ready:
+            return
+        if not self._conn.poll(STARTUP_TIMEOUT):
+            raise TimeoutError("検出プロセスが起動しませんでした")
+        self._conn.recv()
+        self._ready = True
+
+    def submit(self, frame, threshold, timestamp=None):
+        """フレームを空いているスロットに書き込み、検出を依頼する (結果は待たない)"""
+        if self._fallback is not None:
+            raise RuntimeError("検出プロセスは停止しています")
+        self._wait_ready()
+        if self._in_flight >= self.slots:
+            raise RuntimeError("検出待ちのフレームが多すぎます (先に result() を呼んでください)")
+        if self._in_flight == 0:
+            self._ensure_buffer(frame.nbytes) # 処理中のスロットがあるときは作り直さない
+        elif frame.nbytes > self._slot_size:
+            raise ValueError("処理中に解像度が変わりました")
+        slot = self._next_slot
+        self._next_slot = (slot + 1) % self.slots
+        view = np.ndarray(frame.shape, frame.dtype, buffer=self._shm.buf, offset=slot * self._slot_size)
+        np.copyto(view, frame)
+        del view
+        self._conn.send(('detect', slot, frame.shape, frame.dtype.str, threshold, timestamp))
+        self._in_flight += 1
+
+    def result(self):
+        """最も古い依頼の結果 (maxVal, maxLoc) を返す"""
+        if not self._conn.poll(self.timeout):
+            raise TimeoutError(f"検出プロセスが {self.timeout} 秒以内に応答しませんでした")
+        max_val, max_loc, self.last_timestamp, elapsed = self._receive()
+        _WORKER_TIME.observe(elapsed)
+        return max_val, max_loc
+
+    def _receive(self):
+        """子プロセスから結果を1つ受け取り、探索回数を親プロセスの METRICS にも数える"""
+        max_val, max_loc, timestamp, elapsed, (hits, misses, full_scans) = self._conn.recv()
+        self._in_flight -= 1
+        self.hits += hits
+        self.misses += misses
+        self.full_scans += full_scans
+        count_scans(hits, misses, full_scans)
+        return max_val, max_loc, timestamp, elapsed
+
+    def detect(self, frame, threshold, timestamp=None):
+        """輝点を検出し (maxVal, maxLoc) を返す"""
+        if self._fallback is not None:
+            return self._fallback.detect(frame, threshold)
+        try:
+            self.submit(frame, threshold, timestamp)
+            return self.result()
+        except (OSError, EOFError, TimeoutError) as e:
+            print(f"⚠️ 検出プロセスが使えないため、同じプロセスで検出します: {e}")
+            self._stop_worker()
+            self._fallback = make_detector(self.kind, self.glare)
+            return self._fallback.detect(frame, threshold)
+
+    def _stop_worker(self):
+        if self._process.is_alive():
+            try:
+                self._wait_ready()
+                while self._in_flight and self._conn.poll(self.timeout): # 処理中の結果を読み捨てる
+                    self._receive()
+                self._conn.send(('stop',))
+                if self._conn.poll(self.timeout):
+                    stats = self._conn.recv()
+                    if self.glare is not None and stats['glare'] is not None:
+                        self.glare.replace(stats['glare'])
+            except (OSError, EOFError):
+                pass
+            self._process.join(timeout=self.timeout)
+            if self._process.is_alive():
+                self._process.terminate()
+        self._conn.close()
+        self._release_buffer()
+
+    def close(self):
+        """子プロセスを止め、共有メモリを解放する"""
+        if self._fallback is None:
+            self._stop_worker()
+            self._fallback = make_detector(self.kind, self.glare) # close() 後の detect() は同じプロセスで行う
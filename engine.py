@@ -0,0 +1,291 @@
+# ===================================================================
+# --- トラッキングエンジン (Headless Tracking Engine) ---
+# 検出 → センサーフュージョン → カーソル座標 の処理をGUIから切り離したもの。
+# app.py (PySimpleGUI) と app2.py (Tkinter) はこのクラスを毎フレーム呼び出すだけ。
+# 1フレームあたりの計算は Python の float だけで行う (NumPyのスカラー演算は遅い)。
+# 映像の左右反転は画像をコピーせず、検出した座標の変換 (mirror) で行う。
+# ===================================================================
+import time
+
+import cv2
+
+from detector import ROISpotDetector
+from filters import FILTERS, FILTER_EMA, make_filter
+from metrics import METRICS, now
+
+_DETECT_TIME = METRICS.histogram('detect', "輝点検出 (グレースケール化を含む) の時間")
+_FUSION_TIME = METRICS.histogram('fusion', "センサーフュージョンの時間")
+_MODE_SECONDS = METRICS.counter('fusion_mode_seconds', "各動作モードで過ごした時間 (秒)", label_name='mode')
+
+# --- 動作モード ---
+MODE_PAUSED = 'paused'                     # 一時停止中
+MODE_LOST = 'lost'                         # 追跡対象なし
+MODE_IMU_PREDICTION = 'imu_prediction'     # IMU予測モード
+MODE_NOISE_SUPPRESSION = 'noise_suppression' # ノイズ抑制モード (フュージョン)
+MODE_NORMAL = 'normal'                     # 通常追跡モード (フュージョン)
+MODE_CAMERA_NOISE = 'camera_noise'         # 単独ノイズ抑制モード
+MODE_CAMERA_ONLY = 'camera_only'           # カメラ単独モード
+
+# モードごとの表示テキストと色
+STATUS_TEXT = {
+    MODE_PAUSED: ("状態: 一時停止中 (ESCキーで再開)", "yellow"),
+    MODE_LOST: ("状態: 追跡対象なし", "red"),
+    MODE_IMU_PREDICTION: ("状態: IMU予測モード", "magenta"),
+    MODE_NOISE_SUPPRESSION: ("状態: ノイズ抑制モード", "orange"),
+    MODE_NORMAL: ("状態: 通常追跡モード", "cyan"),
+    MODE_CAMERA_NOISE: ("状態: 単独ノイズ抑制モード", "orange"),
+    MODE_CAMERA_ONLY: ("状態: カメラ単独モード", "lime"),
+}
+
+# モードごとの輝点マーカーの色 (BGR)
+MARKER_COLORS = {
+    MODE_NOISE_SUPPRESSION: (0, 165, 255),
+    MODE_NORMAL: (255, 255, 0),
+    MODE_CAMERA_NOISE: (0, 255, 0),
+    MODE_CAMERA_ONLY: (0, 255, 0),
+}
+
+
+class EngineParams:
+    """UIやCLIから変更できるトラッキングパラメータ"""
+
+    __slots__ = ('sens_x', 'sens_y', 'dead_zone', 'bright_thresh', 'alpha_normal',
+                 'alpha_stationary', 'delta_threshold', 'use_imu', 'noise_flag',
+                 'filter', 'one_euro_min_cutoff', 'one_euro_beta', 'one_euro_d_cutoff',
+                 'kalman_process_noise', 'kalman_measurement_noise', 'kalman_speed_scale',
+                 'latency_compensation', 'camera_latency')
+
+    def __init__(self, sens_x=5.0, sens_y=-10.0, dead_zone=0.5, bright_thresh=200,
+                 alpha_normal=0.4, alpha_stationary=0.1, delta_threshold=0.5,
+                 use_imu=False, noise_flag=False, filter=FILTER_EMA,
+                 one_euro_min_cutoff=0.5, one_euro_beta=0.01, one_euro_d_cutoff=1.0,
+                 kalman_process_noise=300.0, kalman_measurement_noise=4.0, kalman_speed_scale=100.0,
+                 latency_compensation=False, camera_latency=0.03):
+        self.sens_x = sens_x                       # IMU X軸の感度
+        self.sens_y = sens_y                       # IMU Y軸の感度
+        self.dead_zone = dead_zone                 # IMUの動きを無視する閾値
+        self.bright_thresh = bright_thresh         # 追跡対象とみなす輝度の閾値
+        self.alpha_normal = alpha_normal           # 通常時のカメラ追従度
+        self.alpha_stationary = alpha_stationary   # 静止時のノイズ抑制強度
+        self.delta_threshold = delta_threshold     # カメラの動きを「わずかに動いている」とみなす閾値
+        self.use_imu = use_imu                     # IMUとのセンサーフュージョンを行う
+        self.noise_flag = noise_flag               # カメラ単独時のノイズ抑制モード
+        if filter not in FILTERS:
+            raise ValueError(f"不明なフィルタ: {filter} ({' / '.join(FILTERS)})")
+        # 平滑化フィルタ ('ema' は上の2つのalphaを切り替える従来方式。filters.py を参照)
+        self.filter = filter
+        self.one_euro_min_cutoff = one_euro_min_cutoff # 静止時のカットオフ周波数 [Hz]
+        self.one_euro_beta = one_euro_beta             # 速さ [px/s] あたりのカットオフの増加量
+        self.one_euro_d_cutoff = one_euro_d_cutoff     # 速さの平滑化のカットオフ [Hz]
+        self.kalman_process_noise = kalman_process_noise         # 加速度のばらつき [px^2/s^3]
+        self.kalman_measurement_noise = kalman_measurement_noise # カメラ位置のばらつき [px^2]
+        self.kalman_speed_scale = kalman_speed_scale   # この速さ [px/s] でプロセスノイズが2倍になる
+        # カメラの遅れの補償: 撮影時刻以降のIMUの移動量をカメラ位置に足してから使う
+        self.latency_compensation = latency_compensation
+        self.camera_latency = camera_latency           # フレーム取得時刻から見た撮影時刻の遅れ [秒]
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def update(self, **values):
+        """指定された項目だけを更新する (未知の項目は KeyError、不正な値は ValueError)
+
+        先にすべての項目を確認し、エラーがあれば1つも変更しない。
+        """
+        for name, value in values.items():
+            if name not in self.__slots__:
+                raise KeyError(name)
+            if name == 'filter' and value not in FILTERS:
+                raise ValueError(f"不明なフィルタ: {value} ({' / '.join(FILTERS)})")
+        for name, value in values.items():
+            setattr(self, name, value)
+
+
+class TrackingEngine:
+    """輝点検出とセンサーフュージョンを行い、カーソル座標を求めるクラス
+
+    step() にフレームとIMUの移動量を渡すと、マウスを動かすべき座標
+    (一時停止中は None) を返す。直近の結果は mode / max_val / max_loc に残る。
+    mirror=True なら映像を左右反転したものとして画面座標に変換する (フレームは反転せずに渡す)。
+    max_loc は反転前のカメラ画像での座標。
+    """
+
+    __slots__ = ('params', 'detector', 'screen_width', 'screen_height', 'mirror', 'cam_width', 'cam_height',
+                 '_x_scale', '_x_offset', '_y_scale', '_y_offset', '_x_limit', '_y_limit',
+                 'fused_x', 'fused_y', 'last_cam_x', 'last_cam_y',
+                 'mode', 'max_val', 'max_loc', 'is_tracking', '_last_tick',
+                 '_filter', '_filter_name')
+
+    def __init__(self, cam_width, cam_height, screen_width, screen_height,
+                 margin=0.1, params=None, detector=None, mirror=False):
+        self.params = params if params is not None else EngineParams()
+        self.detector = detector if detector is not None else ROISpotDetector()
+        self.screen_width = screen_width
+        self.screen_height = screen_height
+        self.mirror = mirror
+        self.set_camera_size(cam_width, cam_height, margin)
+        self.fused_x, self.fused_y = screen_width / 2, screen_height / 2
+        self.last_cam_x, self.last_cam_y = self.fused_x, self.fused_y
+        self.mode = MODE_LOST
+        self.max_val = 0.0
+        self.max_loc = (0, 0)
+        self.is_tracking = False
+        self._last_tick = None
+        self._filter = None
+        self._filter_name = FILTER_EMA
+
+    def set_camera_size(self, cam_width, cam_height, margin=0.1):
+        """カメラ座標 → 画面座標 の一次変換を前計算する
+
+        カメラ映像の端 margin の割合を除いた範囲を画面全体に対応させる
+        (範囲外は画面の端に張り付く。np.interp と同じ挙動)。
+        mirror なら x を cam_width - 1 - x (cv2.flip(frame, 1) と同じ) に置き換えてから変換する。
+        """
+        self.cam_width, self.cam_height = cam_width, cam_height
+        x_min, x_max = cam_width * margin, cam_width * (1 - margin)
+        y_min, y_max = cam_height * margin, cam_height * (1 - margin)
+        self._x_limit = self.screen_width - 1
+        self._y_limit = self.screen_height - 1
+        self._x_scale = self._x_limit / (x_max - x_min)
+        self._y_scale = self._y_limit / (y_max - y_min)
+        self._x_offset = -x_min * self._x_scale
+        self._y_offset = -y_min * self._y_scale
+        if self.mirror:
+            self._x_offset += (cam_width - 1) * self._x_scale
+            self._x_scale = -self._x_scale
+
+    def map_to_screen(self, cam_x, cam_y):
+        """カメラ座標を画面座標に変換する"""
+        x = cam_x * self._x_scale + self._x_offset
+        y = cam_y * self._y_scale + self._y_offset
+        x = 0.0 if x < 0.0 else (self._x_limit if x > self._x_limit else x)
+        y = 0.0 if y < 0.0 else (self._y_limit if y > self._y_limit else y)
+        return x, y
+
+    def step(self, frame, delta_h=0.0, delta_p=0.0, active=True, timestamp=None, imu_history=None):
+        """1フレーム分の処理 (検出 → フュージョン) を行う"""
+        start = now()
+        max_val, max_loc = self.detector.detect(frame, self.params.bright_thresh)
+        detected = now()
+        _DETECT_TIME.observe(detected - start)
+        target = self.fuse(max_val, max_loc, delta_h, delta_p, active, timestamp, imu_history)
+        _FUSION_TIME.since(detected)
+        return target
+
+    def fuse(self, max_val, max_loc, delta_h=0.0, delta_p=0.0, active=True, timestamp=None,
+             imu_history=None):
+        """検出結果とIMUの移動量からカーソル座標を更新する
+
+        timestamp はフレームの取得時刻 (省略時は現在時刻)。フィルタの時間刻みに使う。
+        imu_history (imu_reader.IMUReader など motion_since() を持つもの) を渡し、
+        params.latency_compensation が有効なら、カメラの位置を撮影時点の観測とみなして
+        撮影時刻 (timestamp - camera_latency) 以降のIMUの移動量を足す。
+        戻り値はマウスを動かすべき座標 (画面内にクリップ済み)。一時停止中は None。
+        """
+        p = self.params
+        # 前回のモードで過ごした時間を集計する
+        tick = time.monotonic() if timestamp is None else timestamp
+        dt = 0.0
+        if self._last_tick is not None:
+            dt = tick - self._last_tick
+            _MODE_SECONDS.inc(dt, label=self.mode)
+        self._last_tick = tick
+        if p.filter != self._filter_name: # 切り替え時は現在の位置から始める
+            self._filter = make_filter(p.filter, p)
+            self._filter_name = p.filter
+            if self._filter is not None:
+                self._filter.reset(self.fused_x, self.fused_y)
+        self.max_val = max_val
+        self.max_loc = max_loc
+        is_tracking = max_val >= p.bright_thresh
+        self.is_tracking = is_tracking
+        is_imu_moving = abs(delta_h) > p.dead_zone or abs(delta_p) > p.dead_zone
+
+        cam_x, cam_y = self.last_cam_x, self.last_cam_y
+        if is_tracking:
+            cam_x, cam_y = self.map_to_screen(max_loc[0], max_loc[1])
+            if p.latency_compensation and p.use_imu and imu_history is not None and timestamp is not None:
+                since_h, since_p = imu_history.motion_since(timestamp - p.camera_latency)
+                cam_x += since_h * p.sens_x
+                cam_y += since_p * p.sens_y
+
+        alpha = None
+        if not active:
+            self.mode = MODE_PAUSED
+        elif p.use_imu: # --- センサーフュージョンモード ---
+            if not is_tracking and is_imu_moving:
+                self.mode = MODE_IMU_PREDICTION
+                self.fused_x += delta_h * p.sens_x
+                self.fused_y += delta_p * p.sens_y
+            elif is_tracking:
+                dx = cam_x - self.last_cam_x
+                dy = cam_y - self.last_cam_y
+                is_cam_moving_slightly = (dx * dx + dy * dy) ** 0.5 > p.delta_threshold
+                if not is_imu_moving and is_cam_moving_slightly:
+                    self.mode = MODE_NOISE_SUPPRESSION
+                    alpha = p.alpha_stationary
+                else:
+                    self.mode = MODE_NORMAL
+                    alpha = p.alpha_normal
+            else:
+                self.mode = MODE_LOST
+        else: # --- カメラ単独モード ---
+            if is_tracking:
+                if p.noise_flag:
+                    self.mode = MODE_CAMERA_NOISE
+                    alpha = p.alpha_stationary
+                else:
+                    self.mode = MODE_CAMERA_ONLY
+                    alpha = p.alpha_normal
+            else:
+                self.mode = MODE_LOST
+
+        filt = self._filter
+        if filt is None:
+            if alpha is not None:
+                self.fused_x = (1 - alpha) * self.fused_x + alpha * cam_x
+                self.fused_y = (1 - alpha) * self.fused_y + alpha * cam_y
+        elif alpha is not None: # 適応フィルタ: alphaの代わりにフィルタで平滑化する
+            dx = dy = 0.0
+            if p.use_imu and is_imu_moving:
+                dx, dy = delta_h * p.sens_x, delta_p * p.sens_y
+            self.fused_x, self.fused_y = filt.update(cam_x, cam_y, dt, dx, dy)
+        elif self.mode == MODE_IMU_PREDICTION:
+            predicted = filt.predict(dt, delta_h * p.sens_x, delta_p * p.sens_y)
+            if predicted is not None:
+                self.fused_x, self.fused_y = predicted
+        self.last_cam_x, self.last_cam_y = cam_x, cam_y
+
+        if not active:
+            return None
+        x, y = self.fused_x, self.fused_y
+        x = 0.0 if x < 0.0 else (self._x_limit if x > self._x_limit else x)
+        y = 0.0 if y < 0.0 else (self._y_limit if y > self._y_limit else y)
+        return x, y
+
+    @property
+    def status(self):
+        """現在のモードの (表示テキスト, 色)"""
+        return STATUS_TEXT[self.mode]
+
+
+def draw_overlay(frame, engine):
+    """プレビュー用に、現在のモードに応じたマーカーを画像に描き込む
+
+    frame は表示用の画像 (preview.PreviewRenderer で縮小・反転したもの)。
+    カメラのフレームそのものには描かない。マーカーの位置と大きさは
+    engine の左右反転と frame の大きさに合わせて変換する。
+    """
+    height, width = frame.shape[:2]
+    scale = width / engine.cam_width
+    if engine.mode == MODE_IMU_PREDICTION:
+        cv2.putText(frame, "IMU PREDICTION", (10, int(60 * scale)), cv2.FONT_HERSHEY_SIMPLEX, scale,
+                    (255, 0, 255), max(1, round(2 * scale)))
+        return
+    color = MARKER_COLORS.get(engine.mode)
+    if color is not None:
+        x, y = engine.max_loc
+        if engine.mirror:
+            x = engine.cam_width - 1 - x
+        marker = (int(x * scale), int(y * height / engine.cam_height))
+        cv2.circle(frame, marker, max(1, int(20 * scale)), color, 2)
@@ -0,0 +1,152 @@
+# ===================================================================
+# --- 平滑化フィルタ (Adaptive Filters) ---
+# 固定係数のEMA (ALPHA_NORMAL / ALPHA_STATIONARY) の代わりに使える、
+# 動きの速さに応じて追従性が連続的に変わるフィルタ。
+#
+#   OneEuroFilter   速く動くほどカットオフ周波数を上げる1次ローパス (1€ Filter)
+#   KalmanFilter    等速度モデルのカルマンフィルタ。IMUの移動量を制御入力として使う
+#
+# どちらも画面座標 (px) で動作し、パラメータは engine.EngineParams から毎回読む
+# (実行中に /params から変更しても即座に反映される)。
+# ===================================================================
+import math
+
+FILTER_EMA = 'ema'
+FILTER_ONE_EURO = 'one_euro'
+FILTER_KALMAN = 'kalman'
+FILTERS = (FILTER_EMA, FILTER_ONE_EURO, FILTER_KALMAN)
+
+_MIN_DT = 1e-4 # 同一時刻の入力で0除算しないための下限 (秒)
+_MAX_DT = 0.5  # これより間が空いたら (見失い・一時停止の後) 推定をやり直す (秒)
+
+
+def _smoothing_factor(dt, cutoff):
+    """カットオフ周波数 cutoff [Hz] の1次ローパスの係数"""
+    tau = 1.0 / (2.0 * math.pi * cutoff)
+    return 1.0 / (1.0 + tau / dt)
+
+
+class OneEuroFilter:
+    """1€ Filter (Casiez et al., CHI 2012) の2次元版
+
+    カットオフ = one_euro_min_cutoff + one_euro_beta * 速さ[px/s]。
+    静止時は強く平滑化し、速く動くほど遅れを小さくする。速さは2軸まとめて
+    求めるので、斜めの動きでもX/Yで追従性が揃う。IMUの移動量が渡されたときは
+    前回の推定位置をその分ずらしてから平滑化する (IMUで測れた動きには遅れない)。
+    """
+
+    __slots__ = ('params', 'x', 'y', 'speed')
+
+    def __init__(self, params):
+        self.params = params
+        self.x = self.y = None
+        self.speed = 0.0 # 平滑化した速さ [px/s]
+
+    def reset(self, x, y):
+        self.x, self.y = x, y
+        self.speed = 0.0
+
+    def update(self, x, y, dt, dx=0.0, dy=0.0):
+        """カメラの位置 (x, y) を入力し、推定位置を返す"""
+        if self.x is None or dt > _MAX_DT:
+            self.reset(x, y)
+            return x, y
+        p = self.params
+        dt = dt if dt > _MIN_DT else _MIN_DT
+        prev_x, prev_y = self.x + dx, self.y + dy
+        raw_speed = math.hypot(x - prev_x, y - prev_y) / dt
+        a = _smoothing_factor(dt, p.one_euro_d_cutoff)
+        self.speed += a * (raw_speed - self.speed)
+        a = _smoothing_factor(dt, p.one_euro_min_cutoff + p.one_euro_beta * self.speed)
+        self.x = prev_x + a * (x - prev_x)
+        self.y = prev_y + a * (y - prev_y)
+        return self.x, self.y
+
+    def predict(self, dt, dx=0.0, dy=0.0):
+        """カメラの位置が無いとき、IMUの移動量だけで位置を進める"""
+        if self.x is None:
+            return None
+        self.x += dx
+        self.y += dy
+        return self.x, self.y
+
+
+class KalmanFilter:
+    """等速度モデルのカルマンフィルタ (X/Yは独立に扱う)
+
+    状態は各軸の (位置, 速度)。予測ではIMUの移動量があればそれを、無ければ
+    速度×時間を位置に足す。プロセスノイズは推定速度が大きいほど増やし
+    (kalman_process_noise * (1 + 速さ/kalman_speed_scale))、速い動きで
+    カメラの観測への追従を強める。観測ノイズは kalman_measurement_noise [px^2]。
+    """
+
+    __slots__ = ('params', 'x', 'y')
+
+    def __init__(self, params):
+        self.params = params
+        self.x = self.y = None # 各軸 [位置, 速度, P00, P01, P11]
+
+    def reset(self, x, y):
+        r = self.params.kalman_measurement_noise
+        self.x = [x, 0.0, r, 0.0, r * 100.0]
+        self.y = [y, 0.0, r, 0.0, r * 100.0]
+
+    def _predict_axis(self, s, dt, u, q):
+        pos, vel, p00, p01, p11 = s
+        if u is None:
+            pos += vel * dt
+        else:
+            pos += u
+            vel = u / dt # IMUで測れた移動をそのまま速度の推定にする
+        # P = F P F^T + Q  (F = [[1, dt], [0, 1]], Q は白色加速度モデル)
+        p00 += dt * (2.0 * p01 + dt * p11) + q * dt ** 3 / 3.0
+        p01 += dt * p11 + q * dt * dt / 2.0
+        p11 += q * dt
+        s[:] = pos, vel, p00, p01, p11
+
+    @staticmethod
+    def _update_axis(s, z, r):
+        pos, vel, p00, p01, p11 = s
+        k0 = p00 / (p00 + r)
+        k1 = p01 / (p00 + r)
+        innovation = z - pos
+        s[:] = (pos + k0 * innovation, vel + k1 * innovation,
+                (1.0 - k0) * p00, (1.0 - k0) * p01, p11 - k1 * p01)
+
+    def _predict(self, dt, dx, dy):
+        p = self.params
+        dt = dt if dt > _MIN_DT else _MIN_DT
+        speed = math.hypot(self.x[1], self.y[1])
+        q = p.kalman_process_noise * (1.0 + speed / p.kalman_speed_scale)
+        imu = dx != 0.0 or dy != 0.0
+        self._predict_axis(self.x, dt, dx if imu else None, q)
+        self._predict_axis(self.y, dt, dy if imu else None, q)
+
+    def update(self, x, y, dt, dx=0.0, dy=0.0):
+        """カメラの位置 (x, y) を入力し、推定位置を返す"""
+        if self.x is None or dt > _MAX_DT:
+            self.reset(x, y)
+            return x, y
+        self._predict(dt, dx, dy)
+        r = self.params.kalman_measurement_noise
+        self._update_axis(self.x, x, r)
+        self._update_axis(self.y, y, r)
+        return self.x[0], self.y[0]
+
+    def predict(self, dt, dx=0.0, dy=0.0):
+        """カメラの位置が無いとき、予測だけで位置を進める"""
+        if self.x is None:
+            return None
+        self._predict(dt, dx, dy)
+        return self.x[0], self.y[0]
+
+
+def make_filter(name, params):
+    """名前からフィルタを作る ('ema' は engine 内の従来処理を使うので None)"""
+    if name == FILTER_ONE_EURO:
+        return OneEuroFilter(params)
+    if name == FILTER_KALMAN:
+        return KalmanFilter(params)
+    if name == FILTER_EMA:
+        return None
+    raise ValueError(f"不明なフィルタ: {name} ({' / '.join(FILTERS)})")
@@ -0,0 +1,214 @@
+# ===================================================================
+# --- 映り込みの学習マスク (Static Glare Mask) ---
+# 天井の照明やモニターなど、ポインタ以外で常に明るい領域を学習し、輝点検出で無視する。
+#
+#   1. ポインタを映さずに数秒間カメラを回し、閾値近くまで明るい頻度の高い画素を集める
+#      (python headless.py --calibrate-glare 5)。
+#   2. 結果は PNG (白 = 無視する画素) に保存し、設定の glare_mask にパスを書く。
+#      起動時はそれを読み込むので学習し直さない。
+#   3. 動作中も update_interval フレームごとに少しずつ学習を続け、照明の変化に追従する
+#      (追跡中のポインタの周囲は学習しない。そのため、検出器が捕まえてしまった新しい照明は
+#      学習されないので、照明を増やしたときは 1. からやり直す)。
+#
+# 画像全体の探索では、マスクを行の帯と列の区間からなる矩形に分解しておき、
+# 全面がマスクされた矩形はグレースケール化も走査もしない。画像全体のグレースケール化
+# (1280x720 で約0.5ms) が探索のほとんどを占めるので、矩形に分けて変換する手間が割に合うのは
+# 飛ばせる画素が MIN_SKIP 以上ある場合だけ (それ未満なら全体を変換してマスク付きで走査する)。
+# ===================================================================
+import os
+
+import cv2
+import numpy as np
+
+from metrics import METRICS
+
+_UPDATES = METRICS.counter('glare_mask_updates', "照明の変化に合わせてマスクを作り直した回数")
+
+MAX_RECTS = 64 # 矩形がこれより多くなる (マスクが細かい) 場合は画像全体をマスク付きで走査する
+MIN_SKIP = 0.15 # 全面マスクの矩形がこの割合未満なら、矩形に分けずに画像全体をマスク付きで走査する
+
+
+def scan_rects(masked):
+    """マスク (True = 無視) を走査用の矩形 [(x0, y0, x1, y1, 部分マスクか), ...] に分解する
+
+    マスクの無い行の帯は1つの矩形にし、マスクのある帯は列ごとに
+    「マスク無し」「一部マスク」「全面マスク」の区間に分ける。全面マスクの区間は含めない。
+    """
+    height, width = masked.shape
+    rects = []
+    row_masked = masked.any(axis=1)
+    for y0, y1, has_mask in _runs(row_masked):
+        if not has_mask:
+            rects.append((0, y0, width, y1, False))
+            continue
+        band = masked[y0:y1]
+        kind = band.any(axis=0).astype(np.int8) + band.all(axis=0) # 0: 無し 1: 一部 2: 全面
+        for x0, x1, k in _runs(kind):
+            if k != 2:
+                rects.append((x0, y0, x1, y1, bool(k)))
+    return rects
+
+
+def _runs(values):
+    """1次元配列を同じ値が続く区間 (start, end, value) に分ける"""
+    edges = np.flatnonzero(np.diff(values)) + 1
+    starts = np.concatenate(([0], edges))
+    ends = np.concatenate((edges, [len(values)]))
+    return [(int(s), int(e), values[s]) for s, e in zip(starts, ends)]
+
+
+class GlareMask:
+    """常に明るい領域のマスク。輝点検出器 (detector.py / blob_tracker.py) の glare に渡す
+
+    core は学習した「明るい頻度の高い画素」、valid はそれを dilate ピクセル広げて
+    反転したもの (255 = 探索する画素)。
+    """
+
+    def __init__(self, width, height, margin=20, min_fraction=0.3, dilate=4, rate=0.05,
+                 update_interval=30, exclude_radius=40):
+        self.width, self.height = width, height
+        self.margin = margin                   # 輝度の閾値よりこれだけ暗くても明るいとみなす
+        self.min_fraction = min_fraction       # 学習中にこの割合以上のフレームで明るければマスクする
+        self.dilate = dilate                   # マスクを広げる幅 (ピクセル。光のにじみの分)
+        self.rate = rate                       # 動作中の学習の速さ (1回の更新で反映する割合)
+        self.update_interval = update_interval # 動作中に学習するフレームの間隔 (0で学習しない)
+        self.exclude_radius = exclude_radius   # 追跡中のポインタの周囲で学習しない半径 (ピクセル)
+        self.core = np.zeros((height, width), dtype=np.uint8)
+        self._score = None    # 動作中の学習の累積 (0-255)
+        self._gray = None
+        self._bright = None
+        self._update_mask = None
+        self._frames = 0
+        self._calibration = None
+        self._calibration_frames = 0
+        self.changed = False  # 読み込み・保存の後に作り直したか
+        self._rebuild()
+
+    # --- 学習 ---
+    def _to_gray(self, frame):
+        if frame.ndim == 2:
+            return frame
+        if self._gray is None:
+            self._gray = np.empty((self.height, self.width), dtype=np.uint8)
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self._gray)
+
+    def add_calibration_frame(self, frame, threshold):
+        """ポインタを映していないフレームを学習に加える"""
+        if self._calibration is None:
+            self._calibration = np.zeros((self.height, self.width), dtype=np.uint16)
+        bright = self._to_gray(frame) >= max(0, threshold - self.margin)
+        self._calibration += bright
+        self._calibration_frames += 1
+
+    def finish_calibration(self):
+        """学習したフレームからマスクを作る。マスクした画素の割合を返す"""
+        if not self._calibration_frames:
+            raise ValueError("学習するフレームがありません")
+        core = self._calibration >= self.min_fraction * self._calibration_frames
+        self.core = core.astype(np.uint8) * 255
+        self._calibration = None
+        self._calibration_frames = 0
+        self._score = None
+        self._rebuild()
+        return self.masked_fraction
+
+    def observe(self, frame, threshold, exclude=None):
+        """動作中のフレームで少しずつ学習する (update_interval フレームに1回だけ処理する)
+
+        exclude (追跡中のポインタの位置) の周囲 exclude_radius ピクセルは学習しない。
+        """
+        if not self.update_interval:
+            return
+        self._frames += 1
+        if self._frames % self.update_interval:
+            return
+        if self._score is None:
+            self._score = self.core.astype(np.float32)
+            self._bright = np.empty((self.height, self.width), dtype=np.uint8)
+            self._update_mask = np.empty((self.height, self.width), dtype=np.uint8)
+        gray = self._to_gray(frame)
+        cv2.threshold(gray, max(0, threshold - self.margin) - 1, 255, cv2.THRESH_BINARY, dst=self._bright)
+        self._update_mask.fill(255)
+        if exclude is not None:
+            center = (int(exclude[0]), int(exclude[1]))
+            cv2.circle(self._update_mask, center, self.exclude_radius, 0, -1)
+        cv2.accumulateWeighted(self._bright, self._score, self.rate, mask=self._update_mask)
+        # ヒステリシス: 半分を超えたらマスクし、1/4 を下回ったら外す
+        core = np.where(self._score > 127, 255, np.where(self._score < 64, 0, self.core)).astype(np.uint8)
+        if not np.array_equal(core, self.core):
+            self.core = core
+            self._rebuild()
+            self.changed = True
+            _UPDATES.inc()
+
+    def replace(self, core):
+        """別のプロセスで学習したマスクに置き換える"""
+        self.core = core
+        self._score = None
+        self._rebuild()
+        self.changed = True
+
+    def _rebuild(self):
+        """core から探索用のマスクと矩形を作り直す"""
+        masked = self.core
+        if self.dilate and masked.any():
+            size = 2 * self.dilate + 1
+            masked = cv2.dilate(masked, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size)))
+        self.valid = cv2.bitwise_not(masked)
+        self.masked_fraction = float(np.count_nonzero(masked)) / masked.size
+        self._integral = cv2.integral(masked // 255) # 窓内のマスク画素数を O(1) で求める
+        rects = scan_rects(masked > 0)
+        self.rects = rects if len(rects) <= MAX_RECTS else None
+        scanned = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1, _ in rects)
+        self.scan_by_rect = self.rects is not None and 1.0 - scanned / masked.size >= MIN_SKIP
+        self.empty = not masked.any()
+
+    # --- 探索 ---
+    def window_valid(self, x0, y0, x1, y1):
+        """窓内にマスクがあれば valid の窓部分を、無ければ None を返す"""
+        s = self._integral
+        if s[y1, x1] - s[y0, x1] - s[y1, x0] + s[y0, x0] == 0:
+            return None
+        return self.valid[y0:y1, x0:x1]
+
+    def find_bright_spot(self, frame, gray):
+        """マスクされていない画素から最も明るい点を探し (maxVal, maxLoc) を返す
+
+        gray は frame と同じ大きさの uint8 配列 (グレースケール化の出力先)。
+        scan_by_rect なら矩形ごとに変換・走査し、全面がマスクされた矩形は飛ばす。
+        """
+        if not self.scan_by_rect:
+            if frame.ndim == 3:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray)
+            _, max_val, _, max_loc = cv2.minMaxLoc(frame, self.valid)
+            return max_val, max_loc
+        best_val, best_loc = 0.0, (0, 0)
+        for x0, y0, x1, y1, partial in self.rects:
+            region = frame[y0:y1, x0:x1]
+            if region.ndim == 3:
+                region = cv2.cvtColor(region, cv2.COLOR_BGR2GRAY, dst=gray[y0:y1, x0:x1])
+            _, max_val, _, (x, y) = cv2.minMaxLoc(region, self.valid[y0:y1, x0:x1] if partial else None)
+            if max_val > best_val:
+                best_val, best_loc = max_val, (x + x0, y + y0)
+        return best_val, best_loc
+
+    # --- 保存と読み込み ---
+    def save(self, path):
+        """学習したマスク (広げる前) を PNG で保存する"""
+        if not cv2.imwrite(path, self.core):
+            raise OSError(f"マスクを保存できません: {path}")
+        self.changed = False
+
+    @classmethod
+    def load(cls, path, width, height, **kwargs):
+        """保存したマスクを読み込む。ファイルが無い・大きさが違う場合は None"""
+        if not path or not os.path.exists(path):
+            return None
+        core = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if core is None or core.shape != (height, width):
+            print(f"⚠️ 警告: 映り込みのマスク {path} がカメラの解像度 {width}x{height} と合わないため使いません。")
+            return None
+        mask = cls(width, height, **kwargs)
+        mask.core = np.where(core > 127, 255, 0).astype(np.uint8)
+        mask._rebuild()
+        return mask
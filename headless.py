@@ -0,0 +1,390 @@
+# ===================================================================
+# --- ヘッドレス実行 (Headless Daemon) ---
+# GUIを一切使わず、カメラの最大レートでトラッキングだけを行う。
+# キオスク端末など、画面を見る人がいない環境向け。
+#
+#   python headless.py --config kiosk.json
+#   python headless.py --camera 0 --serial-port COM12 --set alpha_normal=0.5
+#   python headless.py --record rec/session1                 # 入力を記録しながら実行
+#   python headless.py --replay rec/session1 --dry-run       # 記録を実時間で再生
+#   python headless.py --config kiosk.json --calibrate-glare 5 # 照明などの映り込みを学習して保存
+#
+# 設定ファイルの 'trackers' にカメラ・IMUポート・カーソル出力の組を複数書くと、
+# それぞれを別スレッドで動かし、複数のポインタを同時に操作できる (config.py 参照)。
+#
+# パラメータは実行中も Webサーバーの /params から変更できる:
+#   curl -X POST -H "Content-Type: application/json" -d '{"alpha_normal": 0.3}' http://<IP>:5000/params
+# SIGTERM / Ctrl+C で後片付けをして終了する。
+# ===================================================================
+import argparse
+import signal
+import time
+from threading import Thread, Event
+
+import cv2
+import serial
+
+from capture import FrameGrabber
+from capture_profile import resolve_profile, parse_profile, parse_target
+from cursor import open_cursor_output, CURSOR_BACKENDS
+from config import load_config, save_config, coerce_value, engine_params, tracker_configs, DEFAULT_CONFIG
+from detector_process import ProcessSpotDetector, detector_kind, make_detector
+from engine import TrackingEngine, EngineParams
+from glare_mask import GlareMask
+from imu_reader import IMUReader, open_imu_serial, find_serial_port
+from relay import CommandRelay, run_flask_app
+
+
+def open_imu(config, log=print):
+    """設定に従ってIMUのシリアルポートを開く。使えなければ (None, None)"""
+    port = config['serial_port']
+    if not port or str(port).lower() == 'none':
+        return None, None
+    if str(port).lower() == 'auto':
+        port = find_serial_port()
+        if port is None:
+            log("⚠️ 警告: IMUが見つかりません。カメラのみで動作します。")
+            return None, None
+    try:
+        ser = open_imu_serial(port, config['baud_rate'])
+    except serial.SerialException as e:
+        log(f"⚠️ 警告: IMUポート '{port}' を開けません。カメラのみで動作します。\n   {e}")
+        return None, None
+    log(f"✅ IMU接続成功: '{port}' @ {config['baud_rate']} bps")
+    if not str(port).startswith('replay://'):
+        time.sleep(2) # Picoのリセット直後はデータが不安定なため待つ
+        ser.reset_input_buffer()
+    return ser, IMUReader(ser, wire_format=config['imu_format']).start()
+
+
+class Tracker:
+    """カメラ・IMU・トラッキングエンジンを1組まとめたもの (ポインタ1つ分)
+
+    状態はすべてインスタンスが持つので、複数作ってそれぞれのスレッドで run() を
+    呼べば、1つのプロセスで複数のポインタを同時に動かせる。
+    move_cursor(x, y) はカーソルを動かす関数。None ならカーソルは動かさない (ドライラン)。
+    recorder (recording.Recorder) を渡すと、カメラとIMUの入力を記録する。
+    """
+
+    def __init__(self, name, config, screen_size, move_cursor=None, recorder=None):
+        self.name = name
+        self.config = config
+        self.screen_size = screen_size
+        self.move_cursor = move_cursor
+        self.recorder = recorder
+        self.params = engine_params(config)
+        self.cap = None
+        self.ser = None
+        self.imu_reader = None
+        self.engine = None
+        self.glare = None
+        self.frames = 0
+        self.elapsed = 0.0
+
+    def log(self, message):
+        print(message if self.name == 'default' else f"[{self.name}] {message}")
+
+    def open(self):
+        """カメラとIMUを開く。カメラを開けなければ False
+
+        フレームの取得は run() で始める (IMUの待ちや他のトラッカーの準備の間に
+        誰も読まないフレームが溜まり、取りこぼしとして数えられないようにする)。
+        途中で例外が起きた場合は、それまでに開いたものを閉じてから例外を送出する。
+        """
+        try:
+            return self._open()
+        except BaseException:
+            self.close()
+            raise
+
+    def _open(self):
+        config = self.config
+        profile = resolve_profile(config['camera_source'], config['capture_profile'], config['capture_target'],
+                                  config['capture_cache'], config['capture_max_fps'], log=self.log)
+        self.cap = FrameGrabber(config['camera_source'], profile=profile)
+        if not self.cap.isOpened():
+            self.log("エラー: Webカメラを開けませんでした。")
+            return False
+        if self.recorder is not None:
+            self.cap.on_frame = self.recorder.add_frame
+
+        self.ser, self.imu_reader = open_imu(config, self.log)
+        if self.recorder is not None and self.imu_reader is not None:
+            self.imu_reader.on_raw = self.recorder.add_serial
+        self.params.use_imu = config['use_imu'] and self.imu_reader is not None
+
+        cam_width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        cam_height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.glare = GlareMask.load(config['glare_mask'], cam_width, cam_height,
+                                    update_interval=config['glare_update_interval'])
+        if self.glare is not None:
+            self.log(f"映り込みのマスクを読み込みました: {config['glare_mask']} "
+                     f"(画面の {self.glare.masked_fraction:.1%} を無視)")
+        kind = detector_kind(config['subpixel_detection'], config['roi_tracking'], config['blob_tracking'])
+        detector = (ProcessSpotDetector(kind, glare=self.glare) if config['detect_process']
+                    else make_detector(kind, self.glare))
+        screen_width, screen_height = self.screen_size
+        self.engine = TrackingEngine(cam_width, cam_height, screen_width, screen_height,
+                                     margin=config['margin'], params=self.params, detector=detector,
+                                     mirror=config['mirror'])
+        return True
+
+    def device(self):
+        """Webサーバーからこのトラッカーのデバイスにコマンドを送るための CommandRelay"""
+        return CommandRelay(self.imu_reader, self.params, self.name)
+
+    def run(self, stop_event):
+        """stop_event がセットされるか映像が途切れるまでトラッキングを行う"""
+        cap, imu_reader, params, engine = self.cap, self.imu_reader, self.params, self.engine
+        move_cursor = self.move_cursor
+        last_seq = 0
+        last_mode = None
+        cap.start()
+        start_time = time.monotonic()
+        try:
+            while not stop_event.is_set():
+                # --- 1. カメラデータの取得 (最新フレームのみ) ---
+                ret, frame, frame_time, seq = cap.read(last_seq=last_seq, timeout=0.5)
+                if not ret:
+                    self.log("カメラからの映像が途切れました。")
+                    break
+                if seq == last_seq:
+                    continue
+                last_seq = seq # 左右反転は engine の座標変換で行う
+
+                # --- 2. IMUデータの取得 ---
+                delta_h, delta_p = 0.0, 0.0
+                if imu_reader:
+                    imu = imu_reader.drain()
+                    if params.use_imu:
+                        delta_h, delta_p = imu.delta_h, imu.delta_p
+
+                # --- 3. 検出 & 4. フュージョン & 5. マウス移動 ---
+                target = engine.step(frame, delta_h, delta_p, timestamp=frame_time, imu_history=imu_reader)
+                if target is not None and move_cursor is not None:
+                    move_cursor(target[0], target[1])
+
+                self.frames += 1
+                if engine.mode != last_mode:
+                    self.log(engine.status[0])
+                    last_mode = engine.mode
+        finally:
+            self.elapsed += time.monotonic() - start_time
+
+    def close(self):
+        if self.elapsed > 0:
+            self.log(f"処理フレーム数: {self.frames} ({self.frames / self.elapsed:.1f} fps, "
+                     f"取りこぼし {self.cap.dropped})")
+        if self.cap is not None:
+            self.cap.release()
+        if self.engine is not None and isinstance(self.engine.detector, ProcessSpotDetector):
+            self.engine.detector.close() # 子プロセスで学習したマスクはここで self.glare に戻る
+        if self.glare is not None and self.glare.changed:
+            self.glare.save(self.config['glare_mask'])
+            self.log(f"照明の変化に合わせて更新した映り込みのマスクを保存しました: {self.config['glare_mask']}")
+        if self.imu_reader:
+            self.imu_reader.stop()
+        if self.ser and self.ser.is_open:
+            self.ser.close()
+            self.log("シリアルポートを閉じました。")
+        if self.recorder is not None:
+            self.recorder.close()
+            self.log(f"記録を保存しました: {self.recorder.path} ({self.recorder.frame_count} フレーム, "
+                     f"書き込みが追いつかず捨てたフレーム {self.recorder.dropped})")
+
+
+def run_many(trackers, stop_event, with_flask=True):
+    """複数のトラッカーをそれぞれのスレッドで、stop_event がセットされるまで動かす
+
+    Webサーバーは1つだけ起動し、/send/<トラッカー名>/... で各デバイスに振り分ける。
+    """
+    opened = []
+    try:
+        for tracker in trackers:
+            if tracker.open():
+                opened.append(tracker)
+            else:
+                tracker.close()
+        if not opened:
+            return 1
+        if with_flask:
+            config = opened[0].config
+            Thread(target=run_flask_app, args=(None, None, config['flask_port'], config['udp_port']),
+                   kwargs={'devices': [t.device() for t in opened]}, daemon=True).start()
+
+        print("ヘッドレスモードで開始しました。SIGTERM または Ctrl+C で終了します。")
+        threads = [Thread(target=t.run, args=(stop_event,), name=f"tracker-{t.name}", daemon=True)
+                   for t in opened]
+        for thread in threads:
+            thread.start()
+        # シグナルを受け取れるよう、メインスレッドは短い間隔で待つ
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=0.5)
+    finally:
+        print("\nクリーンアップ処理を実行しています...")
+        for tracker in opened:
+            tracker.close()
+        print("終了しました。")
+    return 0
+
+
+def run(config, stop_event, screen_size, move_cursor=None, with_flask=True, recorder=None):
+    """stop_event がセットされるまでトラッキングを行う (トラッカー1台)
+
+    move_cursor(x, y) はカーソルを動かす関数。None ならカーソルは動かさない (ドライラン)。
+    recorder (recording.Recorder) を渡すと、カメラとIMUの入力を記録する。
+    """
+    tracker = Tracker('default', config, screen_size, move_cursor, recorder)
+    return run_many([tracker], stop_event, with_flask)
+
+
+def calibrate_glare(name, config, seconds, log=print):
+    """ポインタを映さずに seconds 秒カメラを回して映り込みのマスクを作り、保存したパスを返す"""
+    path = config['glare_mask'] or ('glare_mask.png' if name == 'default' else f"glare_mask_{name}.png")
+    profile = resolve_profile(config['camera_source'], config['capture_profile'], config['capture_target'],
+                              config['capture_cache'], config['capture_max_fps'], log=log)
+    cap = FrameGrabber(config['camera_source'], profile=profile)
+    if not cap.isOpened():
+        raise SystemExit("エラー: Webカメラを開けませんでした。")
+    try:
+        mask = GlareMask(int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        log(f"ポインタを映さないでください。{seconds:g} 秒間、映り込みを学習します...")
+        cap.start()
+        last_seq = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            ret, frame, _, seq = cap.read(last_seq=last_seq, timeout=0.5)
+            if not ret:
+                break
+            if seq != last_seq:
+                last_seq = seq
+                mask.add_calibration_frame(frame, config['bright_thresh'])
+    finally:
+        cap.release()
+    fraction = mask.finish_calibration()
+    mask.save(path)
+    log(f"映り込みのマスクを保存しました: {path} (画面の {fraction:.1%} を無視)")
+    return path
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="GUIなしでトラッキングを実行する")
+    parser.add_argument('--config', help="設定ファイル (JSON)")
+    parser.add_argument('--save-config', metavar='PATH', help="最終的な設定をJSONに保存して終了する")
+    parser.add_argument('--camera', help="カメラ番号・動画ファイル・'synthetic'")
+    parser.add_argument('--capture-profile', metavar='PROFILE',
+                        help="カメラの取得設定 ('auto' で計測して選ぶ / 例: 640x480@60/MJPG#1)")
+    parser.add_argument('--serial-port', help="IMUのシリアルポート ('auto' / 'none' / 'loop://' も可)")
+    parser.add_argument('--flask-port', type=int)
+    parser.add_argument('--no-flask', action='store_true', help="Webサーバーを起動しない")
+    parser.add_argument('--dry-run', action='store_true', help="カーソルを動かさない")
+    parser.add_argument('--cursor', choices=CURSOR_BACKENDS, help="カーソル出力の方式")
+    parser.add_argument('--cursor-rate', type=float, metavar='HZ',
+                        help="カーソルの更新レート (例: 画面のリフレッシュレート。0でフレームごと)")
+    parser.add_argument('--record', metavar='DIR', help="カメラとIMUの入力を記録する")
+    parser.add_argument('--record-jpeg', action='store_true',
+                        help="フレームを JPEG で記録する (既定は無圧縮。容量は約1/8になるが非可逆で、再生時の検出結果がわずかに変わる)")
+    parser.add_argument('--replay', metavar='DIR', help="記録した入力を実時間で再生する (カメラ・IMUの代わり)")
+    parser.add_argument('--calibrate-glare', type=float, metavar='SECONDS',
+                        help="ポインタを映さずに指定秒数カメラを回し、映り込みのマスクを作って終了する")
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help=f"トラッキングパラメータを指定する ({', '.join(EngineParams.__slots__)})")
+    return parser.parse_args(argv)
+
+
+def build_config(args):
+    """設定ファイルとコマンドライン引数から設定を組み立てる"""
+    config = load_config(args.config)
+    if args.camera is not None:
+        config['camera_source'] = args.camera
+    if args.capture_profile is not None:
+        config['capture_profile'] = args.capture_profile
+    if args.serial_port is not None:
+        config['serial_port'] = args.serial_port
+    if args.flask_port is not None:
+        config['flask_port'] = args.flask_port
+    if args.cursor is not None:
+        config['cursor_backend'] = args.cursor
+    if args.cursor_rate is not None:
+        config['cursor_rate'] = args.cursor_rate
+    if args.replay:
+        config['camera_source'] = 'replay://' + args.replay
+        config['serial_port'] = 'replay://' + args.replay
+    for item in args.set:
+        name, sep, value = item.partition('=')
+        if not sep or name not in EngineParams.__slots__:
+            raise SystemExit(f"--set の指定が不正です: {item}")
+        config[name] = coerce_value(DEFAULT_CONFIG[name], value)
+    try:
+        for _, tracker_config in tracker_configs(config):
+            engine_params(tracker_config)
+            parse_target(tracker_config['capture_target'])
+            if tracker_config['capture_profile'] not in ('', 'auto'):
+                parse_profile(tracker_config['capture_profile'])
+    except (ValueError, TypeError) as e:
+        raise SystemExit(f"設定が不正です: {e}")
+    return config
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = build_config(args)
+    if args.save_config:
+        save_config(config, args.save_config)
+        print(f"設定を保存しました: {args.save_config}")
+        return 0
+    configs = tracker_configs(config)
+    if args.calibrate_glare is not None:
+        for index, (name, tracker_config) in enumerate(configs):
+            prefix = "" if name == 'default' else f"[{name}] "
+            path = calibrate_glare(name, tracker_config, args.calibrate_glare, log=lambda m: print(prefix + m))
+            if config['trackers']:
+                config['trackers'][index]['glare_mask'] = path
+            else:
+                config['glare_mask'] = path
+        if args.config: # 次回の起動ではマスクを読み込むだけにする
+            save_config(config, args.config)
+            print(f"設定にマスクのパスを書き込みました: {args.config}")
+        return 0
+    if len(configs) > 1 and (args.record or args.replay):
+        raise SystemExit("--record / --replay はトラッカー1台のときだけ使えます")
+
+    # --- SIGTERM / Ctrl+C で安全に終了する ---
+    stop_event = Event()
+    def request_stop(signum, frame):
+        stop_event.set()
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    recorder = None
+    if args.record:
+        from recording import Recorder
+        recorder = Recorder(args.record, frame_format='jpeg' if args.record_jpeg else 'raw')
+
+    cursors = []
+    trackers = []
+    try:
+        for name, tracker_config in configs:
+            cursor = None
+            screen_size = (1920, 1080)
+            if not args.dry_run:
+                cursor = open_cursor_output(tracker_config['cursor_backend'], tracker_config['cursor_rate'],
+                                            tracker_config['cursor_mode'], tracker_config['cursor_max_overshoot'],
+                                            display=tracker_config['cursor_display'])
+                cursors.append(cursor)
+                rate = (f", {tracker_config['cursor_rate']:g} Hz ({tracker_config['cursor_mode']})"
+                        if tracker_config['cursor_rate'] else "")
+                prefix = "" if name == 'default' else f"[{name}] "
+                print(f"{prefix}カーソル出力: {getattr(cursor, 'sink', cursor).name}{rate}")
+                screen_size = cursor.size()
+            trackers.append(Tracker(name, tracker_config, screen_size,
+                                    move_cursor=cursor.move if cursor else None, recorder=recorder))
+        return run_many(trackers, stop_event, with_flask=not args.no_flask)
+    finally:
+        for cursor in cursors:
+            cursor.close()
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,398 @@
+# ===================================================================
+# --- IMU受信スレッド (Background IMU Serial Reader) ---
+# BNO055 (Pico) から届くCSV行を専用スレッドですべて読み取り、
+# 前回の取り出し以降の delta_h / delta_p を合計して保持する。
+# カメラより速いIMUの送信レートでもバックログが溜まらない。
+# 直近のサンプルは受信時刻付きで残し、任意の時刻以降の移動量も求められる。
+#
+# シリアルポートへの書き込み (Webサーバーからのクリック指示) も同じスレッドが行う。
+# write() は送信待ちに入れてすぐに戻り、受信スレッドが1回の受信ごとに
+# 溜まった分をまとめて1回で書き込む (読み込みと書き込みが交互になる)。
+#
+# 受信形式は届いたデータから自動で判別する (チェックサムまで正しいパケットがあればバイナリ、
+# 無ければ改行でCSV)。REDETECT_ERRORS 回続けて解析に失敗したら判別し直す
+# (ポートを開いた直後のノイズや起動時の UTF-8 の文字に 0xA5 が含まれることがあるため):
+#   CSV     "delta_h,x,delta_p,x,x,x\n" (従来のファームウェア)
+#   バイナリ 11バイト固定長のパケット (リトルエンディアン)
+#             0xA5 | 連番 uint8 | delta_h float32 | delta_p float32 | チェックサム uint8
+#             チェックサムは連番〜delta_p の9バイトの和の下位8ビット
+#           バイナリはまとめて受信した分を NumPy で一括デコードする。
+# ===================================================================
+import struct
+import time
+from collections import namedtuple, deque
+from threading import Thread, Lock
+from weakref import WeakSet
+
+import numpy as np
+import serial
+import serial.tools.list_ports
+
+from metrics import METRICS, now
+
+_PARSE_TIME = METRICS.histogram('imu_parse', "IMU受信データの解析時間 (CSVは1行、バイナリは1回の受信分)")
+_PARSE_ERRORS = METRICS.counter('serial_parse_errors', "形式が不正だったIMUの受信行の数")
+_IMU_SAMPLES = METRICS.counter('imu_samples', "受信したIMUサンプル数")
+_WRITE_TIME = METRICS.histogram('serial_write', "シリアル送信の遅れ (送信待ちに入れてから書き込み完了まで)")
+_WRITES_DROPPED = METRICS.counter('serial_writes_dropped', "送信待ちが一杯で受け付けなかった書き込みの数")
+_READERS = WeakSet() # 送信待ちの件数を数える IMUReader (破棄されたものは自動的に外れる)
+METRICS.gauge('serial_write_queue', lambda: sum(len(r._outbox) for r in list(_READERS)),
+              "シリアル送信待ちの件数 (全デバイスの合計)")
+
+# --- バイナリパケット ---
+PACKET_SYNC = 0xA5
+PACKET_STRUCT = struct.Struct('<BBffB')
+PACKET_SIZE = PACKET_STRUCT.size # 11
+PACKET_DTYPE = np.dtype([('sync', 'u1'), ('seq', 'u1'), ('delta_h', '<f4'), ('delta_p', '<f4'), ('checksum', 'u1')])
+WIRE_FORMATS = ('auto', 'csv', 'binary')
+_SYNC_BYTE = bytes((PACKET_SYNC,))
+_BATCH_PACKETS = 32 # これ以上のパケットがまとめて届いたら NumPy で一括デコードする
+_MAX_PENDING = 4096 # 形式が判別できないまま溜める受信データの上限 (バイト)
+REDETECT_ERRORS = 16 # 'auto' でこの回数続けて解析に失敗したら受信形式を判別し直す
+MAX_OUTBOX = 64     # 送信待ちの書き込みの上限 (件)
+MAX_WRITE_DELAY = 0.01 # 受信の待ち時間の上限 (秒)。送信待ちの書き込みはこれ以上待たされない
+
+# drain() の戻り値: 前回以降の合計移動量・サンプル数・最新サンプルの時刻
+IMUDelta = namedtuple('IMUDelta', ['delta_h', 'delta_p', 'samples', 'last_time'])
+
+EMPTY_DELTA = IMUDelta(0.0, 0.0, 0, 0.0)
+
+
+class WriteQueueFull(Exception):
+    """送信待ちが一杯で書き込みを受け付けられない"""
+
+
+def open_imu_serial(port, baudrate, timeout=0.1):
+    """シリアルポートを開く
+
+    'COM12' や '/dev/ttyACM0' のほか、pyserialのURL ('loop://' など) も指定できる。
+    'replay://DIR' なら recording.py で記録したデータを再生する。
+    """
+    if port.startswith('replay://'):
+        from recording import ReplaySerial
+        return ReplaySerial(port, timeout=timeout)
+    return serial.serial_for_url(port, baudrate=baudrate, timeout=timeout)
+
+
+def find_serial_port():
+    """利用可能なシリアルポートを探してPicoと思われるポートを返す"""
+    ports = serial.tools.list_ports.comports()
+    if not ports:
+        return None
+    for port in ports:
+        description = port.description.lower()
+        if 'pico' in description or 'usb serial' in description or 'usb シリアル' in description:
+            return port.device
+    return ports[0].device
+
+
+def parse_imu_line(line):
+    """CSV1行から (delta_h, delta_p) を取り出す。形式が不正なら None を返す"""
+    parts = line.split(',')
+    if len(parts) != 6:
+        return None
+    try:
+        # 1番目: delta_h, 3番目: delta_p を使います
+        return float(parts[0]), float(parts[2])
+    except ValueError:
+        return None
+
+
+def encode_packet(seq, delta_h, delta_p):
+    """バイナリパケットを1つ作る (ファームウェア側の仕様の参考・シミュレーション用)"""
+    body = PACKET_STRUCT.pack(PACKET_SYNC, seq & 0xFF, delta_h, delta_p, 0)[1:-1]
+    return bytes((PACKET_SYNC,)) + body + bytes((sum(body) & 0xFF,))
+
+
+def decode_packets(data):
+    """受信データに含まれるバイナリパケットをまとめてデコードする
+
+    戻り値は (delta_h の配列, delta_p の配列, 使ったバイト数, 破棄したパケット数)。
+    末尾の不完全なパケットは使わずに残す (次の受信データの先頭につなげる)。
+    同期バイトやチェックサムが合わない箇所は1バイトずつずらして同期をやり直す。
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    size = len(buf)
+    pos = 0
+    errors = 0
+    parts_h, parts_p = [], []
+    while True:
+        # 次の同期バイトを探す
+        if pos < size and buf[pos] != PACKET_SYNC:
+            hits = np.flatnonzero(buf[pos:] == PACKET_SYNC)
+            if len(hits) == 0:
+                pos = size
+                break
+            pos += int(hits[0])
+        count = (size - pos) // PACKET_SIZE
+        if count == 0:
+            break
+        raw = buf[pos:pos + count * PACKET_SIZE].reshape(count, PACKET_SIZE)
+        valid = (raw[:, 0] == PACKET_SYNC) & ((raw[:, 1:10].sum(axis=1, dtype=np.uint32) & 0xFF) == raw[:, 10])
+        good = count if valid.all() else int(np.argmin(valid)) # 先頭から連続して正しい数
+        if good:
+            packets = np.frombuffer(data, dtype=PACKET_DTYPE, count=good, offset=pos)
+            parts_h.append(packets['delta_h'])
+            parts_p.append(packets['delta_p'])
+            pos += good * PACKET_SIZE
+        if good < count:
+            errors += 1
+            pos += 1 # 壊れたパケットの同期バイトを飛ばして探し直す
+    if len(parts_h) == 1:
+        return parts_h[0], parts_p[0], pos, errors
+    if parts_h:
+        return np.concatenate(parts_h), np.concatenate(parts_p), pos, errors
+    empty = np.zeros(0, dtype=np.float32)
+    return empty, empty, pos, errors
+
+
+def find_packet(data):
+    """チェックサムまで正しいバイナリパケットの位置を返す (無ければ -1)
+
+    直後にデータが続く場合は、次のパケットの同期バイトも揃っていることを求める
+    (CSVの中の 0xA5 がたまたまチェックサムの合う並びになっても誤判別しない)。
+    """
+    size = len(data)
+    pos = data.find(_SYNC_BYTE)
+    while 0 <= pos <= size - PACKET_SIZE:
+        end = pos + PACKET_SIZE
+        if (sum(data[pos + 1:end - 1]) & 0xFF == data[end - 1]
+                and (end == size or data[end] == PACKET_SYNC)):
+            return pos
+        pos = data.find(_SYNC_BYTE, pos + 1)
+    return -1
+
+
+def _decode_few(data):
+    """数パケット分の受信データを struct で1つずつデコードする (NumPyの呼び出しより速い)
+
+    戻り値は (delta_h の合計, delta_p の合計, パケット数, 使ったバイト数, 破棄したパケット数)。
+    """
+    size = len(data)
+    pos = 0
+    sum_h = sum_p = 0.0
+    count = errors = 0
+    while pos + PACKET_SIZE <= size:
+        if data[pos] != PACKET_SYNC:
+            pos = data.find(_SYNC_BYTE, pos + 1)
+            if pos < 0:
+                return sum_h, sum_p, count, size, errors
+            continue
+        _, _, delta_h, delta_p, checksum = PACKET_STRUCT.unpack_from(data, pos)
+        if sum(data[pos + 1:pos + PACKET_SIZE - 1]) & 0xFF != checksum:
+            errors += 1
+            pos += 1
+            continue
+        sum_h += delta_h
+        sum_p += delta_p
+        count += 1
+        pos += PACKET_SIZE
+    return sum_h, sum_p, count, pos, errors
+
+
+class IMUReader:
+    """シリアルポートを専有し、受信したIMUサンプルを積算するクラス
+
+    is_open / write() を持つので、Webサーバーにはポートの代わりにこれを渡す。
+    """
+
+    def __init__(self, ser, history_size=1024, wire_format='auto', max_outbox=MAX_OUTBOX):
+        if wire_format not in WIRE_FORMATS:
+            raise ValueError(f"不明な受信形式: {wire_format} ({' / '.join(WIRE_FORMATS)})")
+        self.ser = ser
+        self.wire_format = None if wire_format == 'auto' else wire_format # 判別前は None
+        self._auto_format = wire_format == 'auto'
+        self._error_run = 0 # 続けて解析に失敗した回数 (判別し直しの判断に使う)
+        self._pending = b'' # 行・パケットの途中で切れた受信データ
+        self._lock = Lock()
+        self._history = deque(maxlen=history_size) # (受信時刻, delta_h, delta_p)
+        self._sum_h = 0.0
+        self._sum_p = 0.0
+        self._samples = 0
+        self._last_time = 0.0
+        self._running = False
+        self._thread = None
+        self.total_samples = 0
+        self.parse_errors = 0
+        self.on_raw = None # 受信ごとに on_raw(生データ, timestamp) を呼ぶ (記録用)
+        self.max_outbox = max_outbox
+        self._outbox = deque() # (送信データ, 送信待ちに入れた時刻)
+        self._outbox_lock = Lock()
+        self.bytes_written = 0
+        self.write_batches = 0 # 実際の write 呼び出し回数 (まとめて書いた回数)
+        _READERS.add(self)
+
+    @property
+    def is_open(self):
+        return self.ser is not None and self.ser.is_open
+
+    def start(self):
+        """受信スレッドを開始する"""
+        if self._running:
+            return self
+        # 受信の待ち時間が送信待ちの書き込みの遅れになるので短くしておく
+        timeout = getattr(self.ser, 'timeout', None)
+        if timeout is None or timeout > MAX_WRITE_DELAY:
+            self.ser.timeout = MAX_WRITE_DELAY
+        self._running = True
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while self._running:
+            try:
+                if self._outbox:
+                    self._flush_writes()
+                # 受信済みの分をまとめて読む (無ければ1バイト目が届くかタイムアウトまで待つ)
+                raw = self.ser.read(self.ser.in_waiting or 1)
+            except (serial.SerialException, OSError, TypeError):
+                # ポートが閉じられた・切断された
+                self._running = False
+                break
+            if not raw:
+                continue
+            timestamp = time.monotonic()
+            if self.on_raw is not None:
+                self.on_raw(raw, timestamp)
+            self.feed_bytes(raw, timestamp)
+
+    def write(self, data):
+        """data (bytes) を送信待ちに入れてすぐに戻る
+
+        書き込みは受信スレッドが行う。送信待ちが max_outbox 件あれば WriteQueueFull。
+        受信スレッドを開始していなければその場で書き込む。
+        """
+        if not self._running:
+            return self.ser.write(data)
+        with self._outbox_lock:
+            if len(self._outbox) >= self.max_outbox:
+                _WRITES_DROPPED.inc()
+                raise WriteQueueFull(f"シリアル送信待ちが一杯です ({self.max_outbox} 件)")
+            self._outbox.append((bytes(data), now()))
+        return len(data)
+
+    def _flush_writes(self):
+        """送信待ちをすべて取り出し、1回の write でまとめて書き込む"""
+        with self._outbox_lock:
+            if not self._outbox:
+                return
+            items = list(self._outbox)
+            self._outbox.clear()
+        data = b''.join(chunk for chunk, _ in items)
+        self.ser.write(data)
+        done = now()
+        for _, queued in items:
+            _WRITE_TIME.observe(done - queued)
+        self.bytes_written += len(data)
+        self.write_batches += 1
+
+    def feed_bytes(self, data, timestamp):
+        """受信データ (行やパケットの途中で切れていてもよい) を解析して積算する"""
+        data = self._pending + data
+        if self.wire_format is None:
+            # 同期バイトだけでは決めない (ノイズや UTF-8 の文字にも 0xA5 は現れる)
+            if find_packet(data) >= 0:
+                self.wire_format = 'binary'
+            elif b'\n' in data:
+                self.wire_format = 'csv'
+            else:
+                self._pending = data[-_MAX_PENDING:]
+                return
+        elif (self.wire_format == 'csv' and self._auto_format and PACKET_SYNC in data
+              and find_packet(data) >= 0): # 最初の受信が短くCSVと誤判別していた
+            self.wire_format = 'binary'
+            self._error_run = 0
+        if self.wire_format == 'csv':
+            *lines, self._pending = data.split(b'\n')
+            for line in lines:
+                self.feed_line(line, timestamp)
+            if len(self._pending) > _MAX_PENDING: # 改行が来ないデータは捨てる
+                self._pending = b''
+                self._count_errors(1)
+            return
+        start = now()
+        if len(data) >= PACKET_SIZE * _BATCH_PACKETS:
+            delta_h, delta_p, used, errors = decode_packets(data)
+            count = len(delta_h)
+            sum_h, sum_p = (float(delta_h.sum()), float(delta_p.sum())) if count else (0.0, 0.0)
+        else:
+            sum_h, sum_p, count, used, errors = _decode_few(data)
+        self._pending = data[used:]
+        if errors:
+            self._count_errors(errors)
+        elif not count and used >= PACKET_SIZE: # パケットが1つも無いまま捨てた (CSVなど)
+            self._count_errors(0, run=1)
+        if count:
+            self._error_run = 0
+            self._add(sum_h, sum_p, count, timestamp)
+        _PARSE_TIME.since(start)
+
+    def _count_errors(self, errors, run=None):
+        """解析の失敗を数え、'auto' で続けて失敗したら受信形式を判別し直す"""
+        if errors:
+            self.parse_errors += errors
+            _PARSE_ERRORS.inc(errors)
+        self._error_run += errors if run is None else run
+        if self._auto_format and self._error_run >= REDETECT_ERRORS:
+            self.wire_format = None
+            self._error_run = 0
+
+    def feed_line(self, raw, timestamp):
+        """受信した1行を解析して積算する (テスト・リプレイからも呼び出せる)"""
+        start = now()
+        line = raw.decode('utf-8', 'ignore').strip() if isinstance(raw, bytes) else raw.strip()
+        if not line:
+            return
+        sample = parse_imu_line(line)
+        _PARSE_TIME.since(start)
+        if sample is None:
+            self._count_errors(1)
+            return
+        self._error_run = 0
+        self._add(sample[0], sample[1], 1, timestamp)
+
+    def _add(self, delta_h, delta_p, samples, timestamp):
+        """同時刻に受信した samples 個分の移動量を積算する"""
+        _IMU_SAMPLES.inc(samples)
+        with self._lock:
+            self._sum_h += delta_h
+            self._sum_p += delta_p
+            self._samples += samples
+            self._last_time = timestamp
+            self._history.append((timestamp, delta_h, delta_p))
+            self.total_samples += samples
+
+    def drain(self):
+        """前回の呼び出し以降に受信した移動量の合計を返し、積算値をリセットする"""
+        with self._lock:
+            delta = IMUDelta(self._sum_h, self._sum_p, self._samples, self._last_time)
+            self._sum_h = 0.0
+            self._sum_p = 0.0
+            self._samples = 0
+        return delta
+
+    def motion_since(self, since):
+        """時刻 since より後に受信したサンプルの移動量の合計 (delta_h, delta_p)
+
+        drain() とは独立で、積算値はリセットしない。履歴より古い時刻を指定した
+        場合は残っている分だけを合計する。
+        """
+        sum_h = sum_p = 0.0
+        with self._lock:
+            for timestamp, delta_h, delta_p in reversed(self._history):
+                if timestamp <= since:
+                    break
+                sum_h += delta_h
+                sum_p += delta_p
+        return sum_h, sum_p
+
+    def stop(self):
+        """受信スレッドを停止する (送信待ちは書き込んでから。ポートは閉じない)"""
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+        try:
+            self._flush_writes()
+        except (serial.SerialException, OSError, TypeError):
+            pass
@@ -0,0 +1,148 @@
+# ===================================================================
+# --- 計測 (Latency Metrics) ---
+# 処理段ごとの所要時間を固定メモリのヒストグラムに、
+# 取りこぼしフレーム数などをカウンタに集計する。
+# Webサーバーの /metrics から Prometheus のテキスト形式で取得できる。
+# ===================================================================
+import bisect
+import time
+from threading import Lock
+
+# ヒストグラムのバケット境界 (秒): 10us 〜 約1.3s を 1-2-5 系列で区切る
+DEFAULT_BUCKETS = tuple(m * 10.0 ** e for e in range(-5, 1) for m in (1, 2, 5))
+
+now = time.perf_counter
+
+
+class Histogram:
+    """固定バケットのヒストグラム (観測回数に関わらずメモリは一定)"""
+
+    __slots__ = ('name', 'help', 'bounds', 'counts', 'total', 'count', '_lock')
+
+    def __init__(self, name, help='', bounds=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1) # 最後は上限超え (+Inf)
+        self.total = 0.0
+        self.count = 0
+        self._lock = Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.total += value
+            self.count += 1
+
+    def since(self, start):
+        """start (perf_counter の値) からの経過時間を記録する"""
+        self.observe(now() - start)
+
+    def quantile(self, q):
+        """q (0〜1) 分位点の推定値 (該当バケットの上限値)"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank and c:
+                return self.bounds[index] if index < len(self.bounds) else float('inf')
+        return float('inf')
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+        }
+
+
+class Counter:
+    """単調増加するカウンタ (ラベルごとに値を持つ)"""
+
+    __slots__ = ('name', 'help', 'label_name', 'values', '_lock')
+
+    def __init__(self, name, help='', label_name='label'):
+        self.name = name
+        self.help = help
+        self.label_name = label_name
+        self.values = {}
+        self._lock = Lock()
+
+    def inc(self, amount=1, label=None):
+        with self._lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    def get(self, label=None):
+        return self.values.get(label, 0)
+
+
+class Registry:
+    """ヒストグラムとカウンタの登録先"""
+
+    def __init__(self, prefix='tracker_'):
+        self.prefix = prefix
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def histogram(self, name, help=''):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(name, help)
+        return self.histograms[name]
+
+    def counter(self, name, help='', label_name='label'):
+        if name not in self.counters:
+            self.counters[name] = Counter(name, help, label_name)
+        return self.counters[name]
+
+    def gauge(self, name, func, help=''):
+        """呼び出し時点の値を返す関数 func を登録する (キュー長など)"""
+        self.gauges[name] = (func, help)
+
+    def snapshot(self):
+        """全ての値を辞書にまとめる (JSON出力用)"""
+        return {
+            'histograms': {name: h.snapshot() for name, h in self.histograms.items()},
+            'counters': {name: {str(k): v for k, v in c.values.items()} for name, c in self.counters.items()},
+            'gauges': {name: func() for name, (func, _) in self.gauges.items()},
+        }
+
+    def render_prometheus(self):
+        """Prometheus のテキスト形式で出力する"""
+        lines = []
+        for name, h in self.histograms.items():
+            full = f"{self.prefix}{name}_seconds"
+            lines.append(f"# HELP {full} {h.help}")
+            lines.append(f"# TYPE {full} histogram")
+            cumulative = 0
+            for bound, c in zip(h.bounds, h.counts):
+                cumulative += c
+                lines.append(f'{full}_bucket{{le="{bound:g}"}} {cumulative}')
+            lines.append(f'{full}_bucket{{le="+Inf"}} {h.count}')
+            lines.append(f"{full}_sum {h.total:.9f}")
+            lines.append(f"{full}_count {h.count}")
+        for name, c in self.counters.items():
+            full = f"{self.prefix}{name}_total"
+            lines.append(f"# HELP {full} {c.help}")
+            lines.append(f"# TYPE {full} counter")
+            if not c.values:
+                lines.append(f"{full} 0")
+            for label, value in sorted(c.values.items(), key=lambda kv: str(kv[0])):
+                if label is None:
+                    lines.append(f"{full} {value:g}")
+                else:
+                    lines.append(f'{full}{{{c.label_name}="{label}"}} {value:g}')
+        for name, (func, help) in self.gauges.items():
+            full = f"{self.prefix}{name}"
+            lines.append(f"# HELP {full} {help}")
+            lines.append(f"# TYPE {full} gauge")
+            lines.append(f"{full} {func():g}")
+        return "\n".join(lines) + "\n"
+
+
+# --- プロセス全体で共有するレジストリ ---
+METRICS = Registry()
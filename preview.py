@@ -0,0 +1,70 @@
+# ===================================================================
+# --- プレビュー表示 (Preview Rendering) ---
+# プレビュー画像の更新をトラッキングから切り離し、低いレートで間引いて行う。
+# 縮小・左右反転・オーバーレイは使い回すバッファの上で行い、カメラのフレームは書き換えない。
+# ===================================================================
+import time
+
+import cv2
+import numpy as np
+
+from engine import draw_overlay
+
+PREVIEW_SIZE = (640, 480)
+
+
+class PreviewThrottle:
+    """プレビュー更新のレート制限
+
+    fps 回/秒を上限として、更新してよいタイミングかどうかを返す。
+    fps が 0 以下ならプレビューを更新しない。
+    """
+
+    def __init__(self, fps):
+        self.fps = fps
+        self._next_time = 0.0
+
+    def due(self, now=None):
+        """今プレビューを更新してよければ True を返し、次の更新時刻を進める"""
+        if self.fps <= 0:
+            return False
+        if now is None:
+            now = time.monotonic()
+        if now < self._next_time:
+            return False
+        self._next_time = now + 1.0 / self.fps
+        return True
+
+
+class PreviewRenderer:
+    """カメラのフレームから表示用の画像を作る
+
+    render() はフレームを size に縮小し、engine.mirror なら左右反転し、
+    engine のマーカーを描き込んだ画像を返す。画像は毎回同じバッファ (image) に書くので、
+    次の render() までに表示に使う (必要ならコピーする)。
+    """
+
+    def __init__(self, size=PREVIEW_SIZE):
+        width, height = size
+        self.size = size
+        self._scaled = np.zeros((height, width, 3), dtype=np.uint8)
+        self.image = np.zeros((height, width, 3), dtype=np.uint8)
+
+    def render(self, frame, engine):
+        if engine.mirror:
+            cv2.resize(frame, self.size, dst=self._scaled, interpolation=cv2.INTER_NEAREST)
+            cv2.flip(self._scaled, 1, dst=self.image)
+        else:
+            cv2.resize(frame, self.size, dst=self.image, interpolation=cv2.INTER_NEAREST)
+        draw_overlay(self.image, engine)
+        return self.image
+
+
+def encode_ppm(frame, size=PREVIEW_SIZE):
+    """フレームを (size と違えば) 縮小し、無圧縮のPPM形式のバイト列にする
+
+    Tkの PhotoImage はPPMを直接読めるので、PNG圧縮のコストがかからない。
+    """
+    if (frame.shape[1], frame.shape[0]) != tuple(size):
+        frame = cv2.resize(frame, size, interpolation=cv2.INTER_NEAREST)
+    return cv2.imencode('.ppm', frame)[1].tobytes()
@@ -0,0 +1,479 @@
+# ===================================================================
+# --- 記録と再生 (Record & Replay) ---
+# カメラのフレームとIMUのシリアル受信データを時刻付きで保存し、
+# 実機なしで同じ検出・フュージョン処理に流し込めるようにする。
+#
+# 保存形式 (ディレクトリ):
+#   meta.json        フレームサイズ・フレーム数・フレームの形式など
+#   frames.u8        フレームの生データを連結したもの (frame_format が 'raw'。既定。np.memmap で読める)
+#   frames.bin       JPEG に圧縮したフレームを連結したもの (frame_format が 'jpeg')
+#   frame_sizes.u4   frames.bin の各フレームのバイト数 (uint32)
+#   frame_times.f8   各フレームの取得時刻 (float64, 記録開始からの秒)
+#   serial.bin       シリアル受信データ (時刻 float64 + 長さ uint32 + 生バイト列 の繰り返し)
+#
+# フレームの圧縮と書き込みは専用スレッドで行い、カメラの取得スレッドを待たせない。
+# 書き込みが追いつかずキューが一杯のときはフレームを捨てて数える (recording_dropped)。
+# 既定は無圧縮で、再生すると記録時と同じ画素がそのまま検出器に入る。ただし 640x480 で約27MB/秒
+# (1080p で約186MB/秒) になる。'jpeg' (品質95。約1/8) は容量と帯域を抑えられるが非可逆で、
+# 輝点の周囲の輝度やサブピクセル検出の結果が記録時とわずかに変わる (PNG は 1080p で1枚200ms以上かかり間に合わない)。
+#
+#   python recording.py info DIR
+#   python recording.py replay DIR          # 決定的に最速で再生し、処理時間を表示する
+# ===================================================================
+import argparse
+import bisect
+import json
+import os
+import struct
+import time
+from queue import Queue, Full
+from threading import Lock, Thread
+
+import cv2
+import numpy as np
+
+from metrics import METRICS
+
+FORMAT_VERSION = 2
+FRAME_FORMATS = ('jpeg', 'raw')
+JPEG_QUALITY = 95
+QUEUE_SIZE = 32 # 書き込み待ちにできるフレーム数 (これを超えたら捨てる)
+_SERIAL_HEADER = struct.Struct('<dI')
+REPLAY_SCHEME = 'replay://'
+
+_WRITE_TIME = METRICS.histogram('recording_write', "記録スレッドでフレーム1枚を圧縮・書き込む時間")
+_REC_DROPPED = METRICS.counter('recording_dropped', "書き込みが追いつかず記録しなかったフレーム数")
+
+
+class Recorder:
+    """フレームとシリアル受信データをディスクに書き出すクラス
+
+    FrameGrabber.on_frame / IMUReader.on_raw にメソッドを登録して使う。
+    frame_format は 'raw' (無圧縮。既定) か 'jpeg' (非可逆。ディスクの容量・帯域が足りない場合)。
+    """
+
+    def __init__(self, path, frame_format='raw', queue_size=QUEUE_SIZE):
+        if frame_format not in FRAME_FORMATS:
+            raise ValueError(f"不明なフレームの形式: {frame_format} ({' / '.join(FRAME_FORMATS)})")
+        self.path = path
+        self.frame_format = frame_format
+        os.makedirs(path, exist_ok=True)
+        self._lock = Lock()
+        self._frames = open(os.path.join(path, 'frames.u8' if frame_format == 'raw' else 'frames.bin'), 'wb')
+        self._frame_sizes = None if frame_format == 'raw' else open(os.path.join(path, 'frame_sizes.u4'), 'wb')
+        self._frame_times = open(os.path.join(path, 'frame_times.f8'), 'wb')
+        self._serial = open(os.path.join(path, 'serial.bin'), 'wb')
+        self._t0 = time.monotonic()
+        self.shape = None
+        self.frame_count = 0
+        self.serial_count = 0
+        self.dropped = 0 # 書き込みが追いつかず捨てたフレーム数
+        self._closed = False
+        self._queue = Queue(maxsize=queue_size)
+        self._writer = Thread(target=self._write_frames, name='recorder', daemon=True)
+        self._writer.start()
+
+    def add_frame(self, frame, timestamp):
+        """フレームを書き込み待ちに加える (取得スレッドから呼ばれるので待たない)
+
+        frame は書き込みが終わるまで変更しないこと (FrameGrabber のフレームは毎回新しい配列)。
+        サイズが途中で変わったフレームは記録しない。
+        """
+        if self._closed:
+            return
+        if self.shape is None:
+            self.shape = frame.shape
+        elif frame.shape != self.shape:
+            return
+        try:
+            self._queue.put_nowait((frame, timestamp))
+        except Full:
+            self.dropped += 1
+            _REC_DROPPED.inc()
+
+    def _write_frames(self):
+        """書き込みスレッドの本体。None が届くまでフレームを圧縮して書き込む"""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            frame, timestamp = item
+            start = time.perf_counter()
+            if self.frame_format == 'raw':
+                self._frames.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+            else:
+                ok, data = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+                if not ok:
+                    continue
+                self._frames.write(data.tobytes())
+                self._frame_sizes.write(struct.pack('<I', len(data)))
+            self._frame_times.write(struct.pack('<d', timestamp - self._t0))
+            self.frame_count += 1
+            _WRITE_TIME.observe(time.perf_counter() - start)
+
+    def add_serial(self, data, timestamp):
+        """シリアルから受信した生データを記録する"""
+        with self._lock:
+            if self._serial.closed:
+                return
+            self._serial.write(_SERIAL_HEADER.pack(timestamp - self._t0, len(data)))
+            self._serial.write(data)
+            self.serial_count += 1
+
+    def close(self):
+        """書き込み待ちのフレームを書き終えてからファイルを閉じる"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._writer.join()
+        with self._lock:
+            for f in (self._frames, self._frame_sizes, self._frame_times, self._serial):
+                if f is not None:
+                    f.close()
+            height, width = self.shape[:2] if self.shape else (0, 0)
+            channels = self.shape[2] if self.shape and len(self.shape) == 3 else 1
+            meta = {
+                'version': FORMAT_VERSION,
+                'width': width,
+                'height': height,
+                'channels': channels,
+                'frame_format': self.frame_format,
+                'frames': self.frame_count,
+                'dropped': self.dropped,
+                'serial_chunks': self.serial_count,
+            }
+            with open(os.path.join(self.path, 'meta.json'), 'w', encoding='utf-8') as f:
+                json.dump(meta, f, indent=2)
+
+
+class Recording:
+    """記録済みデータを読み込むクラス (フレームはメモリマップで参照する)"""
+
+    def __init__(self, path):
+        if path.startswith(REPLAY_SCHEME):
+            path = path[len(REPLAY_SCHEME):]
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.width = self.meta['width']
+        self.height = self.meta['height']
+        count = self.meta['frames']
+        shape = (count, self.height, self.width, self.meta['channels'])
+        if not count:
+            self.frames = np.zeros(shape, dtype=np.uint8)
+        elif self.meta.get('frame_format', 'raw') == 'raw': # version 1 の記録は無圧縮
+            self.frames = np.memmap(os.path.join(path, 'frames.u8'), dtype=np.uint8, mode='r', shape=shape)
+        else:
+            sizes = np.fromfile(os.path.join(path, 'frame_sizes.u4'), dtype='<u4')[:count]
+            self.frames = EncodedFrames(os.path.join(path, 'frames.bin'), sizes, self.meta['channels'])
+        self.frame_times = np.fromfile(os.path.join(path, 'frame_times.f8'), dtype='<f8')[:count]
+        self.serial = self._load_serial(os.path.join(path, 'serial.bin'))
+
+    @staticmethod
+    def _load_serial(path):
+        chunks = []
+        if not os.path.exists(path):
+            return chunks
+        with open(path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + _SERIAL_HEADER.size <= len(data):
+            timestamp, length = _SERIAL_HEADER.unpack_from(data, offset)
+            offset += _SERIAL_HEADER.size
+            chunks.append((timestamp, data[offset:offset + length]))
+            offset += length
+        return chunks
+
+    def __len__(self):
+        return len(self.frame_times)
+
+    def events(self):
+        """フレームとシリアル受信を時刻順に並べて返す
+
+        ('serial', 時刻, バイト列) または ('frame', 時刻, フレーム番号) を順に返す。
+        同時刻ならシリアルを先に返す (フレーム処理の前に受信済みだったとみなす)。
+        """
+        serial_index = 0
+        for index, frame_time in enumerate(self.frame_times):
+            while serial_index < len(self.serial) and self.serial[serial_index][0] <= frame_time:
+                timestamp, data = self.serial[serial_index]
+                yield 'serial', timestamp, data
+                serial_index += 1
+            yield 'frame', float(frame_time), index
+        for timestamp, data in self.serial[serial_index:]:
+            yield 'serial', timestamp, data
+
+
+class EncodedFrames:
+    """圧縮したフレームの列。frames[i] で i 番目のフレームを展開して返す"""
+
+    def __init__(self, path, sizes, channels=3):
+        self._data = np.memmap(path, dtype=np.uint8, mode='r')
+        self._offsets = np.concatenate(([0], np.cumsum(sizes, dtype=np.int64)))
+        self._flags = cv2.IMREAD_COLOR if channels == 3 else cv2.IMREAD_GRAYSCALE
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError(index)
+        index %= len(self)
+        start, end = self._offsets[index], self._offsets[index + 1]
+        return cv2.imdecode(self._data[start:end], self._flags)
+
+
+class _ReplayClock:
+    """再生開始からの経過時間を記録時の時刻に対応させる
+
+    seek() で再生位置を戻すと lap が増える。同じ時計を使うソースは lap の変化を見て自分の位置も合わせる。
+    """
+
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self._start = None
+        self.lap = 0        # seek() された回数
+        self.position = 0.0 # 直近の seek() の記録時刻
+
+    def seek(self, timestamp):
+        """記録時刻 timestamp から再生し直す"""
+        self._start = time.monotonic() - timestamp / self.speed
+        self.position = timestamp
+        self.lap += 1
+
+    def wait_until(self, timestamp, timeout=None):
+        """記録時刻 timestamp になるまで待つ。timeout 秒以内に届かなければ False"""
+        now = time.monotonic()
+        if self._start is None:
+            self._start = now - timestamp / self.speed
+        delay = self._start + timestamp / self.speed - now
+        if delay <= 0:
+            return True
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            return False
+        time.sleep(delay)
+        return True
+
+
+_shared_clocks = {} # (記録のパス, 速度) -> [時計, 使っているソースの数]
+_shared_clocks_lock = Lock()
+
+
+def _shared_clock(recording, speed):
+    """同じ記録を再生するカメラとシリアルで時計を共有する (先に読んだ方で開始)
+
+    使い終わったら _release_clock() を呼ぶ。全員が返すと時計は捨てられ、
+    同じ記録をもう一度再生するときは新しい時計で始まる。
+    """
+    key = (os.path.abspath(recording.path), speed)
+    with _shared_clocks_lock:
+        entry = _shared_clocks.setdefault(key, [_ReplayClock(speed), 0])
+        entry[1] += 1
+        return key, entry[0]
+
+
+def _release_clock(key):
+    with _shared_clocks_lock:
+        entry = _shared_clocks.get(key)
+        if entry is not None:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del _shared_clocks[key]
+
+
+class ReplayCapture:
+    """記録したフレームを cv2.VideoCapture と同じ形で返すソース
+
+    realtime=True なら記録時の間隔で、False なら待たずに返す。
+    """
+
+    def __init__(self, recording, realtime=True, speed=1.0):
+        self.recording = recording if isinstance(recording, Recording) else Recording(recording)
+        self.realtime = realtime
+        self._clock_key, self._clock = _shared_clock(self.recording, speed)
+        self._index = 0
+        self._opened = True
+
+    def read(self):
+        if not self._opened or self._index >= len(self.recording):
+            return False, None
+        if self.realtime:
+            self._clock.wait_until(float(self.recording.frame_times[self._index]))
+        frame = self.recording.frames[self._index]
+        self._index += 1
+        return True, frame
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.recording.width)
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.recording.height)
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return float(len(self.recording))
+        return 0.0
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            # 共有の時計ごと巻き戻す (ReplaySerial も同じ時刻まで戻る)
+            self._index = min(max(int(value), 0), len(self.recording))
+            position = float(self.recording.frame_times[self._index]) if self._index < len(self.recording) else 0.0
+            self._clock.seek(position)
+            return True
+        return False
+
+    def isOpened(self):
+        return self._opened
+
+    def release(self):
+        if self._opened:
+            _release_clock(self._clock_key)
+        self._opened = False
+
+
+class ReplaySerial:
+    """記録したシリアル受信データを serial.Serial と同じ形で返す
+
+    readline() / read() は記録時の間隔でデータを返す。write() は sent に溜めるだけ。
+    ReplayCapture が再生位置を戻すと (FrameGrabber の loop)、シリアルも同じ時刻まで戻る。
+    """
+
+    def __init__(self, recording, realtime=True, speed=1.0, timeout=0.1):
+        self.recording = recording if isinstance(recording, Recording) else Recording(recording)
+        self.realtime = realtime
+        self.timeout = timeout
+        self._clock_key, self._clock = _shared_clock(self.recording, speed)
+        self._lap = self._clock.lap
+        self._index = 0
+        self._buffer = b''
+        self.is_open = True
+        self.sent = []
+
+    def _fill(self):
+        """次の記録データが受信時刻になっていればバッファに追加する"""
+        if self._lap != self._clock.lap: # カメラ側で巻き戻された
+            self._lap = self._clock.lap
+            times = [timestamp for timestamp, _ in self.recording.serial]
+            self._index = bisect.bisect_left(times, self._clock.position)
+            self._buffer = b''
+        if self._index >= len(self.recording.serial):
+            if not self._buffer:
+                time.sleep(self.timeout) # 実ポートと同様にタイムアウトぶん待つ
+            return False
+        timestamp, data = self.recording.serial[self._index]
+        if self.realtime and not self._clock.wait_until(timestamp, self.timeout):
+            return False
+        self._buffer += data
+        self._index += 1
+        return True
+
+    @property
+    def in_waiting(self):
+        return len(self._buffer)
+
+    def readline(self):
+        while b'\n' not in self._buffer:
+            if not self.is_open or not self._fill():
+                break
+        line, sep, rest = self._buffer.partition(b'\n')
+        if not sep:
+            return b''
+        self._buffer = rest
+        return line + sep
+
+    def read(self, size=1):
+        if not self._buffer and self.is_open:
+            self._fill()
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def write(self, data):
+        self.sent.append(bytes(data))
+        return len(data)
+
+    def reset_input_buffer(self):
+        pass
+
+    flushInput = reset_input_buffer
+
+    def close(self):
+        if self.is_open:
+            _release_clock(self._clock_key)
+        self.is_open = False
+
+
+def replay(recording, engine, imu_reader=None):
+    """記録を決定的に最速で再生し、各フレームの結果を返す
+
+    シリアルデータは imu_reader.feed_bytes() に、フレームは engine.step() に
+    記録時刻の順で渡す (左右反転は engine.mirror で行う)。戻り値は (時刻, 目標座標, モード, 処理時間[秒]) のリスト。
+    """
+    results = []
+    for kind, timestamp, payload in recording.events():
+        if kind == 'serial':
+            if imu_reader is not None:
+                imu_reader.feed_bytes(payload, timestamp)
+            continue
+        frame = recording.frames[payload] # 展開の時間は処理時間に含めない
+        start = time.perf_counter()
+        delta_h = delta_p = 0.0
+        if imu_reader is not None:
+            imu = imu_reader.drain()
+            if engine.params.use_imu:
+                delta_h, delta_p = imu.delta_h, imu.delta_p
+        target = engine.step(frame, delta_h, delta_p, timestamp=timestamp, imu_history=imu_reader)
+        results.append((timestamp, target, engine.mode, time.perf_counter() - start))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="記録データの確認と再生")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('info', help="記録の内容を表示する")
+    p.add_argument('path')
+    p = sub.add_parser('replay', help="記録を最速で再生し、処理時間を表示する")
+    p.add_argument('path')
+    p.add_argument('--config', help="設定ファイル (JSON)")
+    p.add_argument('--out', help="各フレームの結果をCSVに保存する")
+    args = parser.parse_args()
+
+    recording = Recording(args.path)
+    duration = float(recording.frame_times[-1]) if len(recording) else 0.0
+    print(f"{recording.width}x{recording.height}, {len(recording)} フレーム, "
+          f"シリアル {len(recording.serial)} 件, {duration:.1f} 秒")
+    if args.command == 'info':
+        return
+
+    from config import load_config, engine_params
+    from detector_process import detector_kind, make_detector
+    from engine import TrackingEngine
+    from glare_mask import GlareMask
+    from imu_reader import IMUReader
+
+    config = load_config(args.config)
+    params = engine_params(config)
+    params.use_imu = config['use_imu'] and bool(recording.serial)
+    glare = GlareMask.load(config['glare_mask'], recording.width, recording.height,
+                           update_interval=config['glare_update_interval']) # 再生中の学習は保存しない
+    detector = make_detector(detector_kind(config['subpixel_detection'], config['roi_tracking'], config['blob_tracking']),
+                             glare)
+    engine = TrackingEngine(recording.width, recording.height, 1920, 1080,
+                            margin=config['margin'], params=params, detector=detector, mirror=config['mirror'])
+    imu_reader = IMUReader(None) if recording.serial else None
+    results = replay(recording, engine, imu_reader)
+    if not results:
+        return
+    costs = sorted(r[3] for r in results)
+    print(f"処理時間: 平均 {sum(costs) / len(costs) * 1000:.3f} ms, "
+          f"p50 {costs[len(costs) // 2] * 1000:.3f} ms, p99 {costs[int(len(costs) * 0.99)] * 1000:.3f} ms")
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write("time,x,y,mode\n")
+            for timestamp, target, mode, _ in results:
+                x, y = target if target is not None else ('', '')
+                f.write(f"{timestamp:.6f},{x},{y},{mode}\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+# ===================================================================
+# --- Webサーバー (Flask Relay) ---
+# スマートフォン等からのリクエストをシリアル経由でデバイスに中継する。
+# トラッキングパラメータの参照・変更にも使う。
+#
+#   GET  /send/<data>   1件ずつ送る (従来どおり)
+#   POST /send          複数件をまとめて送る (本文: "1212" / ["1", "2"] / {"commands": [...]})
+#   UDP  :5001          データグラム1つに1件以上のコマンド ("1" / "12")。応答は "OK <件数>"
+#
+# 複数のトラッカーを動かすときは /send/<デバイス名>/<data>、POST /send/<デバイス名>、
+# UDP の "<デバイス名>:12" で送り先を選ぶ (省略すると先頭のデバイス)。
+#
+# waitress がインストールされていればそれで、無ければ Werkzeug の開発用サーバーで動かす。
+# シリアルポートには imu_reader.IMUReader を渡す。書き込みは受信スレッドが行い、
+# リクエストは送信待ちに入れた時点で応答を返す。
+# ===================================================================
+import socket
+from threading import Lock, Thread
+
+import serial
+from flask import Flask, Response, jsonify, request
+
+from config import coerce_value
+from imu_reader import WriteQueueFull
+from metrics import METRICS, now
+
+FLASK_PORT = 5000
+UDP_PORT = 5001
+COMMANDS = ('1', '2')
+MAX_BATCH = 256       # 1回のリクエストで受け付けるコマンド数の上限
+SERVER_THREADS = 8    # waitress の処理スレッド数
+
+_WRITE_TIME = METRICS.histogram('relay_write', "デバイスへのコマンド書き込みの依頼 (送信待ちに入れるまで) の時間")
+_COMMANDS = METRICS.counter('relay_commands', "デバイスに送ったコマンド数", label_name='channel')
+
+
+class DeviceUnavailable(Exception):
+    """シリアルデバイスが接続されていない"""
+
+
+def get_ip_address():
+    """ローカルIPアドレスを取得する"""
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.connect(("8.8.8.8", 80))
+        ip = s.getsockname()[0]
+        s.close()
+        return ip
+    except Exception:
+        return "127.0.0.1"
+
+
+def parse_commands(payload):
+    """リクエストの本文からコマンドの列を取り出す
+
+    文字列 ("12" / "1,2" / "1 2")、リスト (["1", 2])、{"commands": [...]} を受け付ける。
+    不正なコマンドを含む・空・MAX_BATCH件を超える場合は ValueError。
+    """
+    if isinstance(payload, dict):
+        payload = payload.get('commands')
+    if isinstance(payload, (bytes, bytearray)):
+        payload = payload.decode('ascii', errors='replace')
+    if isinstance(payload, str):
+        commands = [c for c in payload if c not in ', \t\r\n']
+    elif isinstance(payload, list):
+        commands = [str(c) for c in payload]
+    else:
+        raise ValueError("コマンドの文字列またはリストを送信してください")
+    if not commands:
+        raise ValueError("コマンドがありません")
+    if len(commands) > MAX_BATCH:
+        raise ValueError(f"コマンドが多すぎます ({len(commands)} > {MAX_BATCH})")
+    invalid = [c for c in commands if c not in COMMANDS]
+    if invalid:
+        raise ValueError(f"無効なコマンド: {invalid[0]}")
+    return commands
+
+
+class CommandRelay:
+    """コマンドをシリアルに書き込む (HTTP / UDP の各スレッドから共有する)
+
+    ser_instance は IMUReader (送信待ちに入れるだけ) か serial.Serial (直接書き込む)。
+    書き込みはロックで1つずつ行い、複数のコマンドは1回の write にまとめる。
+    複数のトラッカーを動かすときは name でデバイスを区別し、params はそのトラッカーの
+    パラメータ (/params/<name> で参照・変更する)。
+    """
+
+    def __init__(self, ser_instance, params=None, name='default'):
+        self.ser = ser_instance
+        self.params = params
+        self.name = name
+        self._lock = Lock()
+
+    @property
+    def available(self):
+        return bool(self.ser and self.ser.is_open)
+
+    def send(self, commands, channel):
+        """commands (検証済みのリスト) を送る
+
+        失敗時は DeviceUnavailable / WriteQueueFull / SerialException。
+        """
+        if not self.available:
+            raise DeviceUnavailable("サーバー側でシリアルデバイスが接続されていません。")
+        data = ''.join(commands).encode('ascii')
+        start = now()
+        with self._lock:
+            self.ser.write(data)
+        _WRITE_TIME.since(start)
+        _COMMANDS.inc(len(commands), label=channel)
+        return len(commands)
+
+
+def create_app(ser_instance, params=None, relay=None, devices=None):
+    """Flaskアプリを作成する
+
+    params (engine.EngineParams) を渡すと /params でパラメータの参照・変更ができる。
+    relay (CommandRelay) を渡すと UDP の受信と書き込みを共有する。
+    devices (CommandRelay のリスト) を渡すと /send/<name>/... で送り先を選べる
+    (名前を省略したときは先頭のデバイス。ser_instance / params / relay は使わない)。
+    """
+    app = Flask(__name__)
+    if devices is None:
+        devices = [relay or CommandRelay(ser_instance, params)]
+    by_name = {d.name: d for d in devices}
+    default = devices[0]
+
+    def lookup(device):
+        if device is None:
+            return default
+        return by_name.get(device)
+
+    @app.route('/send/<data>')
+    @app.route('/send/<device>/<data>')
+    def send_data(data, device=None):
+        relay = lookup(device)
+        if relay is None:
+            return f"<h1>不明なデバイスです: {device}</h1>", 404
+        if not relay.available:
+            return "<h1>送信エラー</h1><p>サーバー側でシリアルデバイスが接続されていません。</p>", 503
+        if data not in COMMANDS:
+            return "<h1>無効なリクエストです</h1>", 400
+        try:
+            relay.send([data], 'get')
+        except WriteQueueFull as e:
+            return f"<h1>送信エラー</h1><p>{e}</p>", 503
+        except serial.SerialException as e:
+            return f"<h1>送信エラー</h1><p>{e}</p>", 500
+        print(f"📨 [Web] デバイス {relay.name} に '{data}' を送信しました。")
+        return f"<h1>'{data}' をデバイスに送信しました</h1>"
+
+    @app.route('/send', methods=['POST'])
+    @app.route('/send/<device>', methods=['POST'])
+    def send_batch(device=None):
+        """複数のコマンドを1回のシリアル書き込みで送る"""
+        relay = lookup(device)
+        if relay is None:
+            return jsonify(error=f"不明なデバイス: {device}"), 404
+        payload = request.get_json(silent=True)
+        if payload is None:
+            payload = request.get_data()
+        try:
+            count = relay.send(parse_commands(payload), 'batch')
+        except ValueError as e:
+            return jsonify(error=str(e)), 400
+        except (DeviceUnavailable, WriteQueueFull) as e:
+            return jsonify(error=str(e)), 503
+        except serial.SerialException as e:
+            return jsonify(error=str(e)), 500
+        return jsonify(sent=count)
+
+    @app.route('/devices')
+    def device_list():
+        """送り先として選べるデバイスの一覧"""
+        return jsonify([{'name': d.name, 'connected': d.available} for d in devices])
+
+    @app.route('/metrics')
+    def metrics():
+        """処理段ごとの所要時間とカウンタ (?format=json でJSON)"""
+        if request.args.get('format') == 'json':
+            return jsonify(METRICS.snapshot())
+        return Response(METRICS.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/params', methods=['GET', 'POST'])
+    @app.route('/params/<device>', methods=['GET', 'POST'])
+    def tracking_params(device=None):
+        """GET: 現在のパラメータ / POST: JSONで指定した項目を変更
+
+        POST でエラーがあれば何も変更せず 400 を返す (本文の params は変更されていない現在の値)。
+        """
+        relay = lookup(device)
+        if relay is None or relay.params is None:
+            return jsonify(error=f"パラメータがありません: {device or default.name}"), 404
+        params = relay.params
+        if request.method == 'POST':
+            values = request.get_json(silent=True)
+            if not isinstance(values, dict):
+                return jsonify(error="JSONオブジェクトを送信してください"), 400
+            current = params.as_dict()
+            try:
+                # 元の値と同じ型に変換してから反映する (update は全項目を確認してから変更する)
+                converted = {name: coerce_value(current[name], value) for name, value in values.items()}
+                if converted.get('use_imu') and relay.ser is None:
+                    # IMUの無いトラッカーでフュージョンにすると、移動量0のIMUを信じてカーソルが鈍くなる
+                    raise ValueError(f"{relay.name} にはIMUが接続されていないため use_imu は有効にできません")
+                params.update(**converted)
+            except KeyError as e:
+                return jsonify(error=f"不明なパラメータ: {e.args[0]}", params=current), 400
+            except (TypeError, ValueError) as e:
+                return jsonify(error=str(e), params=current), 400
+            print(f"⚙️ [Web] {relay.name} のパラメータを変更しました: {converted}")
+        return jsonify(params.as_dict())
+
+    return app
+
+
+# ===================================================================
+# --- UDP受信 (Datagram Relay) ---
+# HTTPのヘッダ処理を省いた最小遅延の経路。1データグラム = 1回の書き込み。
+# ===================================================================
+
+def open_udp_socket(host='0.0.0.0', port=UDP_PORT):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def serve_udp(devices, sock):
+    """UDPでコマンドを受け取り、送信者に "OK <件数>" / "ERR <理由>" を返す
+
+    devices は CommandRelay のリスト。"p2:12" のように "名前:" を付けると
+    そのデバイスに、付けなければ先頭のデバイスに送る。
+    sock を閉じると終了する。応答は遅延の計測用で、読まずに捨ててもよい。
+    """
+    by_name = {d.name.encode('utf-8'): d for d in devices}
+    while True:
+        try:
+            data, address = sock.recvfrom(MAX_BATCH + 64)
+        except OSError: # ソケットが閉じられた
+            break
+        relay = devices[0]
+        if b':' in data:
+            name, _, data = data.partition(b':')
+            relay = by_name.get(name)
+        try:
+            if relay is None:
+                raise ValueError(f"不明なデバイス: {name.decode('utf-8', 'replace')}")
+            reply = f"OK {relay.send(parse_commands(data), 'udp')}"
+        except (ValueError, DeviceUnavailable, WriteQueueFull, serial.SerialException) as e:
+            reply = f"ERR {e}"
+        try:
+            sock.sendto(reply.encode('utf-8'), address)
+        except OSError:
+            pass
+
+
+def serve_http(app, host='0.0.0.0', port=FLASK_PORT, threads=SERVER_THREADS):
+    """並行処理できるサーバーで app を動かす (戻らない)
+
+    waitress があれば使う。無ければ Werkzeug の開発用サーバー (スレッド版) で代用する。
+    """
+    try:
+        from waitress import serve
+    except ImportError:
+        print("⚠️ waitress が無いため Werkzeug の開発用サーバーで動かします (pip install waitress)")
+        app.run(host=host, port=port, debug=False, use_reloader=False, threaded=True)
+        return
+    serve(app, host=host, port=port, threads=threads)
+
+
+def run_flask_app(ser_instance, params=None, port=FLASK_PORT, udp_port=UDP_PORT, devices=None):
+    """Webサーバーを起動してシリアル通信を中継する (udp_port=0 でUDPは使わない)
+
+    devices (CommandRelay のリスト) を渡すと複数のデバイスに振り分ける。
+    """
+    if devices is None:
+        devices = [CommandRelay(ser_instance, params)]
+    app = create_app(None, devices=devices)
+    local_ip = get_ip_address()
+    if udp_port:
+        try:
+            udp_sock = open_udp_socket(port=udp_port)
+        except OSError as e:
+            print(f"⚠️ 警告: UDPポート {udp_port} を開けません: {e}")
+            udp_port = 0
+        else:
+            Thread(target=serve_udp, args=(devices, udp_sock), daemon=True).start()
+    print("\n" + "="*50)
+    print("🚀 Webサーバーが起動しました。")
+    print(f"   URLにアクセスしてクリック操作ができます:")
+    print(f"   - http://{local_ip}:{port}/send/1 (左クリック相当)")
+    print(f"   - http://{local_ip}:{port}/send/2 (右クリック相当)")
+    print(f"   - POST http://{local_ip}:{port}/send (複数のコマンドをまとめて送信)")
+    if len(devices) > 1:
+        names = ' / '.join(d.name for d in devices)
+        print(f"   - http://{local_ip}:{port}/send/<デバイス>/1 (送り先を指定: {names})")
+    if udp_port:
+        print(f"   - udp://{local_ip}:{udp_port} (データグラムでコマンドを送信)")
+    if any(d.params is not None for d in devices):
+        print(f"   - http://{local_ip}:{port}/params (パラメータの参照・変更)")
+    print(f"   - http://{local_ip}:{port}/metrics (処理時間の計測値)")
+    print("="*50 + "\n")
+    serve_http(app, port=port)
@@ -0,0 +1,106 @@
+# ===================================================================
+# --- 中継サーバーへの送信クライアント (Relay Client) ---
+# ゲームなどから /send/<data> を呼び出すためのクライアント。
+# 送信は専用スレッドで行い、呼び出し側 (ゲームループ) は待たされない。
+# 接続は1本を使い回し (HTTP keep-alive)、サーバーが落ちている間は
+# 送信要求を溜めずに捨てる。結果は print せずにカウンタに数える。
+# ===================================================================
+import time
+from collections import deque
+from threading import Thread, Condition
+
+import requests
+
+from metrics import METRICS, now
+
+_SEND_TIME = METRICS.histogram('relay_client_send', "中継サーバーへの送信 (HTTPの往復) の時間")
+_QUEUE_TIME = METRICS.histogram('relay_client_queue', "送信要求が送られるまでの待ち時間")
+_RESULTS = METRICS.counter('relay_client_requests', "中継サーバーへの送信要求の結果", label_name='result')
+
+
+class RelayClient:
+    """/send/<data> をバックグラウンドで送るクライアント
+
+    send() はすぐに戻る。未送信の要求は max_pending 件までで、溢れたら古いものから
+    捨てる。送信に失敗 (接続できない・タイムアウト) したら retry_interval 秒の間は
+    サーバーが落ちているとみなし、その間の要求は送らずに捨てる。
+    """
+
+    def __init__(self, base_url='http://localhost:5000', max_pending=8, timeout=0.5, retry_interval=2.0):
+        self.base_url = base_url.rstrip('/')
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self._pending = deque()
+        self._cond = Condition()
+        self._down_until = 0.0
+        self._running = True
+        self.sent = 0     # 送信できた数
+        self.failed = 0   # 送信に失敗した数 (エラー応答を含む)
+        self.dropped = 0  # 送らずに捨てた数
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def send(self, data):
+        """送信を依頼する (待たない)。捨てた場合は False"""
+        queued = time.monotonic()
+        with self._cond:
+            if queued < self._down_until:
+                self._drop()
+                return False
+            if len(self._pending) >= self.max_pending:
+                self._pending.popleft()
+                self._drop()
+            self._pending.append((str(data), queued))
+            self._cond.notify()
+        return True
+
+    def _drop(self, count=1):
+        self.dropped += count
+        _RESULTS.inc(count, label='dropped')
+
+    def _run(self):
+        session = requests.Session() # 同じ接続を使い回す
+        while True:
+            with self._cond:
+                while self._running and not self._pending:
+                    self._cond.wait()
+                if not self._pending:
+                    break
+                data, queued = self._pending.popleft()
+            _QUEUE_TIME.observe(time.monotonic() - queued)
+            start = now()
+            try:
+                response = session.get(f"{self.base_url}/send/{data}", timeout=self.timeout)
+                ok = response.status_code < 400
+            except requests.RequestException:
+                ok = None
+            _SEND_TIME.since(start)
+            if ok:
+                self.sent += 1
+                _RESULTS.inc(label='sent')
+                continue
+            self.failed += 1
+            _RESULTS.inc(label='failed')
+            if ok is None: # サーバーに届かない: しばらく送らず、溜まっていた分も捨てる
+                session.close()
+                with self._cond:
+                    self._down_until = time.monotonic() + self.retry_interval
+                    self._drop(len(self._pending))
+                    self._pending.clear()
+        session.close()
+
+    def close(self, timeout=1.0):
+        """未送信の要求を timeout 秒まで送ってから停止する"""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def summary(self):
+        """送信結果の要約 (終了時の表示用)"""
+        text = f"送信 {self.sent} / 失敗 {self.failed} / 破棄 {self.dropped}"
+        if _SEND_TIME.count:
+            text += (f" (送信時間 p50 {_SEND_TIME.quantile(0.5) * 1000:.0f} ms 以下,"
+                     f" p99 {_SEND_TIME.quantile(0.99) * 1000:.0f} ms 以下)")
+        return text
@@ -1,8 +1,8 @@
 import pygame
 import sys
 import random
-import requests
 import math # 爆弾の当たり判定で使用
+from relay_client import RelayClient # 中継サーバーへの送信 (ゲームループを止めない)
 
 # 1. ゲームの初期化
 pygame.init()
@@ -25,6 +25,9 @@ MAGENTA = (255, 0, 255) # 【新機能】ビーム用
 # マウスカーソルを非表示にする
 pygame.mouse.set_visible(False)
 
+# --- 中継サーバー (命中時にデバイスへ '2' を送る) ---
+relay = RelayClient("http://localhost:5000")
+
 # --- フォント関連 ---
 score_font = pygame.font.Font(None, 50)
 ammo_font = pygame.font.Font(None, 50)
@@ -187,13 +190,7 @@ while running:
                             score += 1
                             enemy_speed += 0.2
                             add_enemy()
-                            try:
-                                requests.get("http://localhost:5000/send/2")
-                                print("Request sent to localhost/send/2")
-                            except requests.exceptions.ConnectionError:
-                                print("Error: Could not connect to localhost.")
-                            except Exception as e:
-                                print(f"An unexpected error occurred: {e}")
+                            relay.send(2) # バックグラウンドで送信 (結果は終了時に表示)
                             break
 
             # --- 【変更点】右クリックの処理 ---
@@ -297,5 +294,7 @@ while running:
     clock.tick(60)
 
 # 6. 終了処理
+relay.close()
+print(f"中継サーバーへの送信: {relay.summary()}")
 pygame.quit()
 sys.exit()
\ No newline at end of file
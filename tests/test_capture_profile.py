@@ -0,0 +1,58 @@
+# 取得設定の選択を疑似ドライバ (FakeCamera) で確かめる
+import cv2
+import pytest
+
+from capture_profile import CaptureProfile, FakeCamera, negotiate, parse_profile, same_mode
+
+MODES = {('MJPG', 640, 480): 60, ('YUYV', 640, 480): 30}
+
+
+class NTSCCamera(FakeCamera):
+    """FPS を 59.94 のように 1000/1001 倍で読み戻すドライバ"""
+
+    def get(self, prop):
+        value = super().get(prop)
+        return value * 1000 / 1001 if prop == cv2.CAP_PROP_FPS else value
+
+
+def test_same_mode_tolerates_fps_read_back():
+    requested = CaptureProfile(640, 480, 30.0, 'MJPG', 1)
+    assert same_mode(requested, requested._replace(fps=29.97003))
+    assert same_mode(requested, requested._replace(fps=0.0)) # FPS を返さないバックエンド
+    assert not same_mode(requested, requested._replace(fps=15.0))
+    assert not same_mode(requested, requested._replace(width=320, height=240))
+
+
+def test_parse_profile():
+    assert parse_profile('1280x720@60/MJPG#1') == CaptureProfile(1280, 720, 60.0, 'MJPG', 1)
+    assert parse_profile('640x480@30') == CaptureProfile(640, 480, 30.0, None, None)
+
+
+def test_negotiate_picks_low_latency_mode_and_caches(tmp_path):
+    cache_path = str(tmp_path / 'profiles.json')
+    opened = []
+
+    def open_capture():
+        opened.append(1)
+        return NTSCCamera(modes=MODES)
+
+    profile = negotiate(0, (640, 480, 60), cache_path=cache_path, open_capture=open_capture,
+                        frames=10, max_fps=60, log=lambda *args: None)
+    # YUYV は 30 fps までしか出ず、バッファ1つの MJPG が最も遅れが小さい
+    assert profile == CaptureProfile(640, 480, 60.0, 'MJPG', 1) # 59.94 ではなく要求した FPS を保存する
+    assert len(opened) > 1
+
+    opened.clear()
+    cached = negotiate(0, (640, 480, 60), cache_path=cache_path, open_capture=open_capture,
+                       frames=10, max_fps=60, log=lambda *args: None)
+    assert cached == profile
+    assert len(opened) == 1 # キャッシュのキーを作るために開くだけで、計測しない
+
+
+def test_negotiate_reports_unmet_target(tmp_path):
+    messages = []
+    profile = negotiate(0, (640, 480, 120), cache_path=str(tmp_path / 'profiles.json'),
+                        open_capture=lambda: FakeCamera(modes={('YUYV', 640, 480): 30}),
+                        frames=10, max_fps=120, log=messages.append)
+    assert profile is not None and profile.fps == pytest.approx(30.0)
+    assert any('満たす設定がありません' in m for m in messages)
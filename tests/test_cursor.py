@@ -0,0 +1,80 @@
+# カーソル出力の確認。XTest の着地確認は Xサーバー (DISPLAY か Xvfb) が無ければ省略する
+import os
+import shutil
+import subprocess
+import time
+
+import pytest
+
+from cursor import CursorScheduler, RecordingSink
+
+
+@pytest.fixture(scope='module')
+def x_display():
+    """使える X ディスプレイ名。DISPLAY が無ければ Xvfb を起動する"""
+    pytest.importorskip('Xlib')
+    if os.environ.get('DISPLAY'):
+        yield os.environ['DISPLAY']
+        return
+    if shutil.which('Xvfb') is None:
+        pytest.skip("DISPLAY も Xvfb も無い")
+    name = f":{90 + os.getpid() % 100}"
+    server = subprocess.Popen(['Xvfb', name, '-screen', '0', '1280x720x24', '-nolisten', 'tcp'],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        from Xlib import display, error
+        deadline = time.monotonic() + 5.0
+        while True: # 起動して接続を受け付けるまで待つ
+            try:
+                display.Display(name).close()
+                break
+            except (error.DisplayError, ConnectionError):
+                if server.poll() is not None or time.monotonic() > deadline:
+                    pytest.skip("Xvfb を起動できない")
+                time.sleep(0.05)
+        yield name
+    finally:
+        server.terminate()
+        server.wait(timeout=5)
+
+
+def test_xtest_lands_on_target(x_display):
+    from benchmark import check_landing
+    from cursor import XTestSink
+    sink = XTestSink(x_display)
+    try:
+        assert check_landing(sink, count=50) == 0
+    finally:
+        sink.close()
+
+
+def test_move_skips_unchanged_position():
+    sink = RecordingSink()
+    assert sink.move(10.2, 20.4)
+    assert not sink.move(9.8, 19.6) # 丸めると同じ位置
+    assert sink.history == [(10, 20)]
+    assert sink.skipped == 1
+
+
+def test_reset_sends_same_position_again():
+    # 一時停止中に手で動かされたカーソルを、再開後は同じ位置でも動かし直す
+    sink = RecordingSink()
+    sink.move(10, 20)
+    sink.reset()
+    assert sink.move(10, 20)
+    assert sink.history == [(10, 20), (10, 20)]
+
+
+def test_scheduler_reset_drops_held_segment():
+    scheduler = CursorScheduler(RecordingSink(), rate=500).start()
+    try:
+        scheduler.move(10, 10)
+        time.sleep(0.05)
+        scheduler.reset()
+        time.sleep(0.05) # 再開前の位置を出し続けない
+        assert scheduler.sink.history == [(10, 10)]
+        scheduler.move(30, 40)
+        time.sleep(0.05)
+    finally:
+        scheduler.close()
+    assert scheduler.sink.history == [(10, 10), (30, 40)]
@@ -0,0 +1,91 @@
+# IMUReader の受信・解析を pyserial の loop:// (書いたデータがそのまま読める仮想ポート) で確かめる
+import time
+
+import pytest
+
+from imu_reader import IMUReader, encode_packet, open_imu_serial
+
+
+@pytest.fixture
+def loop_port():
+    ser = open_imu_serial('loop://', 115200)
+    yield ser
+    ser.close()
+
+
+def wait_samples(reader, count, timeout=2.0):
+    """受信スレッドが count サンプルを積算するまで待つ"""
+    deadline = time.monotonic() + timeout
+    while reader.total_samples < count and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return reader.total_samples
+
+
+def run_reader(ser, chunks, count, wire_format='auto'):
+    """chunks をポートに流し、count サンプル分の積算結果と IMUReader を返す"""
+    reader = IMUReader(ser, wire_format=wire_format).start()
+    try:
+        for chunk in chunks:
+            ser.write(chunk)
+        assert wait_samples(reader, count) == count
+        return reader.drain(), reader
+    finally:
+        reader.stop()
+
+
+def test_csv_lines(loop_port):
+    lines = [f"{i * 0.5},0,{-i * 0.25},0,0,0\n".encode() for i in range(1, 11)]
+    delta, reader = run_reader(loop_port, lines, 10)
+    assert reader.wire_format == 'csv'
+    assert delta.samples == 10
+    assert delta.delta_h == pytest.approx(sum(i * 0.5 for i in range(1, 11)))
+    assert delta.delta_p == pytest.approx(-sum(i * 0.25 for i in range(1, 11)))
+    assert reader.parse_errors == 0
+
+
+def test_csv_line_split_across_reads(loop_port):
+    data = b"1.5,0,2.5,0,0,0\n" * 4
+    delta, reader = run_reader(loop_port, [data[:5], data[5:23], data[23:]], 4)
+    assert (delta.delta_h, delta.delta_p) == pytest.approx((6.0, 10.0))
+    assert reader.parse_errors == 0
+
+
+def test_binary_packets(loop_port):
+    # 一括デコード (_BATCH_PACKETS 以上) と少数のパケットの両方の経路を通す
+    packets = [encode_packet(i, 0.5, -0.25) for i in range(100)]
+    chunks = [b''.join(packets[:64]), b''.join(packets[64:70]), b''.join(packets[70:])]
+    delta, reader = run_reader(loop_port, chunks, 100)
+    assert reader.wire_format == 'binary'
+    assert (delta.delta_h, delta.delta_p) == pytest.approx((50.0, -25.0))
+    assert reader.parse_errors == 0
+
+
+def test_binary_after_startup_noise(loop_port):
+    # 起動メッセージ (UTF-8 に 0xA5 を含む) の後にパケットが続いてもバイナリと判別する
+    noise = "起動ュ\r\n".encode()
+    packets = b''.join(encode_packet(i, 1.0, 2.0) for i in range(20))
+    delta, reader = run_reader(loop_port, [noise, packets], 20)
+    assert reader.wire_format == 'binary'
+    assert (delta.delta_h, delta.delta_p) == pytest.approx((20.0, 40.0))
+
+
+def test_corrupted_packet_is_dropped(loop_port):
+    good = [encode_packet(i, 1.0, 1.0) for i in range(10)]
+    bad = bytearray(encode_packet(10, 100.0, 100.0))
+    bad[-1] ^= 0xFF # チェックサムを壊す
+    delta, reader = run_reader(loop_port, [b''.join(good[:5]) + bytes(bad) + b''.join(good[5:])], 10, 'binary')
+    assert (delta.delta_h, delta.delta_p) == pytest.approx((10.0, 10.0))
+    assert reader.parse_errors >= 1
+
+
+def test_write_goes_through_outbox(loop_port):
+    # 受信スレッドの動作中の write() は送信待ちを経由して書き込まれる (loop:// なので受信側に戻る)
+    reader = IMUReader(loop_port).start()
+    try:
+        for i in range(5):
+            reader.write(f"{i},0,{i},0,0,0\n".encode())
+        assert wait_samples(reader, 5) == 5
+        assert reader.bytes_written > 0
+    finally:
+        reader.stop()
+    assert reader.drain().delta_h == pytest.approx(10.0)